@@ -1,29 +1,75 @@
+import anyio
 import argparse
-import markdown2
+import asyncio
+import functools
+import hashlib
+import importlib
+import json
 import os
+import shutil
 import sys
+import tempfile
+import time
 import uvicorn
 
+from contextlib import asynccontextmanager
 from pathlib import Path
 from typing import Union
 
-from fastapi import FastAPI, Depends, HTTPException
-from fastapi.responses import HTMLResponse
+from fastapi import FastAPI, Depends, Header, HTTPException, Response
+from fastapi.responses import HTMLResponse, PlainTextResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel, Field
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
 from sse_starlette.sse import EventSourceResponse, ServerSentEvent
 from tclogger import logger
 
 from constants.models import AVAILABLE_MODELS_DICTS, PRO_MODELS
-from constants.envs import CONFIG, SECRETS
-from networks.exceptions import HfApiException, INVALID_API_KEY_ERROR
+from constants.envs import CONFIG, SECRETS, get_config
+from networks.exceptions import (
+    DeadlineExceeded,
+    HfApiException,
+    INVALID_API_KEY_ERROR,
+)
 
+from messagers.context_window import ContextWindowFitter
 from messagers.message_composer import MessageComposer
+from messagers.message_outputer import to_sse_frame
+from messagers.prompt_templates import PROMPT_TEMPLATES
+from messagers.token_checker import TOKEN_COUNT_CACHE
+from messagers.tokenizer_pool import TOKENIZER_POOL
+from messagers.tokenizer_registry import TOKENIZER_REGISTRY
+from metrics.chat_metrics import (
+    DEADLINES_EXCEEDED_TOTAL,
+    PROMPT_TOKENS,
+    REQUEST_DURATION_SECONDS,
+    REQUEST_ERRORS_TOTAL,
+    REQUESTS_TOTAL,
+    UPSTREAM_RESPONSES_TOTAL,
+    track_stream,
+)
+from metrics.collectors import METRICS_REGISTRY
+from metrics.phase_timer import PhaseTimer
+from metrics.request_log import REQUEST_LOG
 from mocks.stream_chat_mocker import stream_chat_mock
 
+from networks.connection_pools import (
+    ASYNC_CLIENT_POOL,
+    SESSION_POOL,
+    get_pools_stats,
+    preconnect_pools,
+)
+from networks.deadlines import Deadline, is_timeout_error
 from networks.huggingface_streamer import HuggingfaceStreamer
-from networks.huggingchat_streamer import HuggingchatStreamer
-from networks.openai_streamer import OpenaiStreamer
+from networks.request_coalescer import REQUEST_COALESCER
+from networks.response_cache import RESPONSE_CACHE
+from networks.upstream_router import UPSTREAM_ROUTER
+
+BACKEND_MODULES = {
+    "huggingchat": "networks.huggingchat_streamer",
+    "openai": "networks.openai_streamer",
+}
 
 
 class ChatAPIApp:
@@ -33,9 +79,69 @@ class ChatAPIApp:
             title=CONFIG["app_name"],
             swagger_ui_parameters={"defaultModelsExpandDepth": -1},
             version=CONFIG["version"],
+            lifespan=self.lifespan,
         )
         self.setup_routes()
 
+    @asynccontextmanager
+    async def lifespan(self, app: FastAPI):
+        if get_config("warmup", False):
+            await run_in_threadpool(self.warmup)
+        elif get_config("prewarm_tokenizers", False):
+            await run_in_threadpool(TOKENIZER_REGISTRY.prewarm)
+        if get_config("http_preconnect", False):
+            await preconnect_pools()
+        yield
+        await ASYNC_CLIENT_POOL.aclose()
+        SESSION_POOL.close()
+        await run_in_threadpool(REQUEST_LOG.close)
+        # only imported with the openai backend
+        proof_worker = sys.modules.get("networks.proof_worker")
+        if proof_worker is not None:
+            await run_in_threadpool(proof_worker.shutdown_process_pool)
+
+    def warmup(self):
+        # pay the lazy imports and tokenizer loads before serving requests
+        t1 = time.perf_counter()
+        for module_name in BACKEND_MODULES.values():
+            importlib.import_module(module_name)
+        importlib.import_module("markdown2")
+        TOKENIZER_REGISTRY.prewarm()
+        try:
+            # loads the tiktoken encoding
+            self.get_backend_module("openai").OpenaiStreamer()
+        except Exception as e:
+            logger.warn(f"Failed to warm up tiktoken: {e}")
+        t2 = time.perf_counter()
+        logger.success(f"> Warmed up in {t2 - t1:.2f}s")
+
+    def get_backend_module(self, backend: str):
+        # backends other than huggingface are imported on first use,
+        # as curl_cffi and tiktoken slow down the cold start
+        return importlib.import_module(BACKEND_MODULES[backend])
+
+    def get_streamer(self, model: str):
+        if model == "gpt-3.5-turbo":
+            return self.get_backend_module("openai").OpenaiStreamer()
+        elif model in PRO_MODELS:
+            module = self.get_backend_module("huggingchat")
+            return module.HuggingchatStreamer(model=model)
+        else:
+            return HuggingfaceStreamer(model=model)
+
+    async def create_streamer(self, model: str):
+        # the lazy backend imports and the tiktoken encoding load would block
+        # the event loop, the huggingface streamer is cheap to build on it
+        if model == "gpt-3.5-turbo" or model in PRO_MODELS:
+            return await run_in_threadpool(self.get_streamer, model)
+        return self.get_streamer(model)
+
+    def get_backend_stats(self, backend: str, pool_name: str):
+        module = sys.modules.get(BACKEND_MODULES[backend])
+        if module is None:
+            return None
+        return getattr(module, pool_name).stats()
+
     def get_available_models(self):
         return {"object": "list", "data": AVAILABLE_MODELS_DICTS}
 
@@ -92,51 +198,626 @@ class ChatAPIApp:
             default=True,
             description="(bool) Stream",
         )
+        truncate: Union[bool, None] = Field(
+            default=None,
+            description="(bool) Drop middle turns if the prompt exceeds the context window, defaults to config `context_truncation`",
+        )
 
-    def chat_completions(
-        self, item: ChatCompletionsPostItem, api_key: str = Depends(extract_api_key)
+    async def sse_frames(self, generator, timer: PhaseTimer = None):
+        is_first = True
+        async for chunk in generator:
+            yield to_sse_frame(chunk)
+            if is_first and timer:
+                timer.mark("first_chunk")
+            is_first = False
+        if timer:
+            timer.mark("stream")
+            if get_config("server_timing_sse_comment", False):
+                yield timer.to_sse_comment()
+
+    def event_source_response(
+        self,
+        generator,
+        headers: dict = None,
+        timer: PhaseTimer = None,
+        background: BackgroundTask = None,
     ):
+        if timer:
+            # phases until the response starts, the rest are in the final comment
+            headers = {**(headers or {}), "Server-Timing": timer.to_header()}
+        return EventSourceResponse(
+            self.sse_frames(generator, timer),
+            media_type="text/event-stream",
+            ping=2000,
+            ping_message_factory=lambda: ServerSentEvent(**{"comment": ""}),
+            headers=headers,
+            background=background,
+        )
+
+    async def replay_chunks(self, streamer, content: str):
+        yield streamer.message_outputer.output(content=content)
+        yield streamer.message_outputer.output(content="", content_type="Finished")
+
+    async def cache_chunks(self, generator, streamer, cache_key: str, status_code: int):
+        contents = []
+        is_finished = False
+        async for chunk in generator:
+            yield chunk
+            choice = json.loads(chunk)["choices"][0]
+            content = choice["delta"].get("content")
+            if content:
+                contents.append(content)
+            if choice["finish_reason"] == "stop":
+                is_finished = True
+        if is_finished and status_code == 200:
+            # cached as non-stream requests would, so that their hits return the same
+            data_response = self.finalize_completion(streamer, "".join(contents))
+            content = data_response["choices"][0]["message"]["content"]
+            await run_in_threadpool(RESPONSE_CACHE.set, cache_key, content)
+
+    def finalize_completion(self, streamer, content: str) -> dict:
+        # the same final content as `chat_return_dict()` of the streamer
+        if isinstance(streamer, HuggingfaceStreamer):
+            return streamer.finalize_content(streamer.init_final_output(), content)
+        return streamer.message_outputer.output_completion(content.strip())
+
+    async def collect_completion(self, streamer, generator) -> dict:
+        """
+        Non-stream response from stream chunks, as returned by `chat_return_dict()`.
+        """
+        contents = []
+        finish_reason = None
+        async for chunk in generator:
+            choice = json.loads(chunk)["choices"][0]
+            content = choice["delta"].get("content")
+            if content:
+                contents.append(content)
+            finish_reason = choice["finish_reason"]
+        data_response = self.finalize_completion(streamer, "".join(contents))
+        data_response["choices"][0]["finish_reason"] = finish_reason
+        return data_response
+
+    def fit_context_window(
+        self, composer: MessageComposer, messages: list[dict], max_tokens: int = None
+    ) -> ContextWindowFitter:
+        # the fitter loads the tokenizer of the model, so it is built in the pool too
+        fitter = ContextWindowFitter(composer)
+        fitter.fit(messages=messages, max_tokens=max_tokens)
+        return fitter
+
+    async def run_until_deadline(
+        self, deadline: Deadline, phase: str, func, timeout: float = None
+    ):
+        # the thread is abandoned at the deadline, it ends with its upstream timeouts
+        return await deadline.wait_for(
+            anyio.to_thread.run_sync(func, abandon_on_cancel=True), phase, timeout
+        )
+
+    async def chat_response_sync(
+        self,
+        streamer,
+        item: ChatCompletionsPostItem,
+        timer: PhaseTimer,
+        deadline: Deadline,
+    ):
+        if streamer.backend == "openai":
+            await deadline.wait_for(
+                TOKENIZER_POOL.run(
+                    streamer.check_token_limit,
+                    item.messages,
+                    labels=(streamer.model, streamer.backend, "tokenize"),
+                ),
+                "tokenize",
+            )
+            timer.mark("tokenize")
+            func = functools.partial(
+                streamer.chat_response,
+                messages=item.messages,
+                is_token_limit_checked=True,
+                deadline=deadline,
+            )
+        else:
+            func = functools.partial(
+                streamer.chat_response, messages=item.messages, deadline=deadline
+            )
+        # curl_cffi only bounds reads of streams by a low-speed limit,
+        # so the wait for the first byte is also bounded here
+        stream_response = await self.run_until_deadline(
+            deadline,
+            "upstream",
+            func,
+            timeout=deadline.connect_timeout + deadline.first_byte_timeout,
+        )
+        # session setup and token checks of these backends are not split out
+        timer.mark("upstream")
+        return stream_response
+
+    def observe_upstream(self, streamer, status_code: int):
+        # also for the request log, which is written when streams end
+        streamer.upstream_status_code = status_code
+        labels = (streamer.model, streamer.backend)
+        UPSTREAM_RESPONSES_TOTAL.labels(*labels, str(status_code)).inc()
+        prompt_tokens = getattr(streamer, "prompt_tokens", None)
+        if prompt_tokens is not None:
+            PROMPT_TOKENS.labels(*labels).observe(prompt_tokens)
+
+    def count_deadline_exceeded(self, streamer, phase: str):
+        if streamer:
+            labels = (streamer.model, streamer.backend)
+        else:
+            labels = ("unknown", "unknown")
+        DEADLINES_EXCEEDED_TOTAL.labels(*labels, phase).inc()
+
+    def count_error(self, streamer, status_code: int):
+        if streamer:
+            labels = (streamer.model, streamer.backend)
+        else:
+            labels = ("unknown", "unknown")
+        REQUEST_ERRORS_TOTAL.labels(*labels, str(status_code)).inc()
+
+    def new_log_record(self, item: ChatCompletionsPostItem) -> dict:
+        return {
+            "time": round(time.time(), 3),
+            "model": item.model,
+            "backend": None,
+            "stream": item.stream,
+            "messages": len(item.messages),
+            "max_tokens": item.max_tokens,
+            "prompt_hash": None,
+            "prompt_tokens": None,
+            "status_code": None,
+            "upstream_status_code": None,
+            "finish_reason": None,
+        }
+
+    def get_stream_status_code(self, record: dict, streamer) -> int:
+        # streams send their 200 before the first chunk, so they are logged
+        # with the status of how they ended: 499 (as nginx) if the client left
+        if record.get("aborted"):
+            return 499
+        if record.get("error"):
+            return 500
+        if record["finish_reason"] == "timeout":
+            return 504
+        return getattr(streamer, "upstream_status_code", None) or 200
+
+    def log_request(self, record: dict, timer: PhaseTimer, streamer=None):
+        if streamer:
+            record["model"] = streamer.model
+            record["backend"] = streamer.backend
+            record["prompt_tokens"] = getattr(streamer, "prompt_tokens", None)
+            record["upstream_status_code"] = getattr(
+                streamer, "upstream_status_code", None
+            )
+        record["timings_ms"] = {
+            name: round(seconds * 1000, 2) for name, seconds in timer.phases.items()
+        }
+        record["duration_ms"] = round(
+            (time.perf_counter() - timer.started_at) * 1000, 2
+        )
+        REQUEST_LOG.log(record)
+
+    async def log_chunks(self, generator, record: dict, timer: PhaseTimer, streamer):
+        chunk_count = 0
+        last_chunk = None
         try:
-            api_key = self.auth_api_key(api_key)
+            async for chunk in generator:
+                chunk_count += 1
+                last_chunk = chunk
+                yield chunk
+        except (asyncio.CancelledError, GeneratorExit):
+            record["aborted"] = True
+            raise
+        except Exception as e:
+            record["error"] = str(e)
+            raise
+        finally:
+            record["completion_chunks"] = chunk_count
+            if last_chunk is not None:
+                # only the last chunk is parsed, it has the finish reason
+                record["finish_reason"] = json.loads(last_chunk)["choices"][0][
+                    "finish_reason"
+                ]
+            record["status_code"] = self.get_stream_status_code(record, streamer)
+            self.log_request(record, timer, streamer)
+
+    def track(
+        self,
+        generator,
+        streamer,
+        started_at: float,
+        record: dict = None,
+        timer: PhaseTimer = None,
+    ):
+        if record is not None:
+            generator = self.log_chunks(generator, record, timer, streamer)
+        return track_stream(generator, streamer.model, streamer.backend, started_at)
+
+    def close_sync_stream(self, generator, stream_response):
+        # unblocks the read of an abandoned thread, if any
+        stream_response.close()
+        try:
+            generator.close()
+        except ValueError:
+            # still running in that thread, it ends with the closed response
+            pass
 
-            if item.model == "gpt-3.5-turbo":
-                streamer = OpenaiStreamer()
-                stream_response = streamer.chat_response(messages=item.messages)
-            elif item.model in PRO_MODELS:
-                streamer = HuggingchatStreamer(model=item.model)
-                stream_response = streamer.chat_response(
-                    messages=item.messages,
+    async def iterate_sync_stream(self, streamer, stream_response):
+        """
+        Iterate `chat_return_generator()` of sync streamers in the threadpool.
+        * On client disconnect, a thread blocked on the upstream is abandoned,
+          and the upstream response is closed at once, not after its next chunk
+        """
+        generator = streamer.chat_return_generator(stream_response)
+        is_exhausted = False
+        try:
+            while True:
+                chunk = await anyio.to_thread.run_sync(
+                    next, generator, None, abandon_on_cancel=True
                 )
+                if chunk is None:
+                    is_exhausted = True
+                    break
+                yield chunk
+        finally:
+            if not is_exhausted:
+                with anyio.CancelScope(shield=True):
+                    await run_in_threadpool(
+                        self.close_sync_stream, generator, stream_response
+                    )
+
+    async def guard_stream(self, generator, streamer, deadline: Deadline):
+        """
+        End a stream with a `timeout` finish chunk, if the upstream sends no chunk
+        within the first-byte or idle timeout, or the request deadline passes.
+        """
+        timeout, phase = deadline.first_byte_timeout, "first_byte"
+        while True:
+            try:
+                async with asyncio.timeout(deadline.cap(timeout)):
+                    chunk = await anext(generator)
+            except StopAsyncIteration:
+                return
+            except Exception as e:
+                # also upstream read timeouts raised by the generator
+                if not is_timeout_error(e):
+                    raise
+                if deadline.is_expired():
+                    phase = "total"
+                break
+            yield chunk
+            timeout, phase = deadline.idle_timeout, "idle"
+        # no-op if the cancelled generator has already closed its upstream
+        await generator.aclose()
+        self.count_deadline_exceeded(streamer, phase)
+        logger.warn(f"> Stream timed out: {phase}")
+        yield streamer.message_outputer.output(
+            content="", content_type="Finished", finish_reason="timeout"
+        )
+
+    async def open_stream(
+        self,
+        streamer,
+        item,
+        composer,
+        api_key,
+        timer: PhaseTimer,
+        deadline: Deadline,
+        cache_key=None,
+    ):
+        if isinstance(streamer, HuggingfaceStreamer):
+            stream_response = await streamer.chat_response_async(
+                prompt=composer.merged_str,
+                prompt_segments=composer.segments,
+                temperature=item.temperature,
+                top_p=item.top_p,
+                max_new_tokens=item.max_tokens,
+                api_key=api_key,
+                use_cache=item.use_cache,
+                timer=timer,
+                deadline=deadline,
+            )
+            generator = streamer.chat_return_generator_async(stream_response)
+        else:
+            stream_response = await self.chat_response_sync(
+                streamer, item, timer, deadline
+            )
+            generator = self.iterate_sync_stream(streamer, stream_response)
+        self.observe_upstream(streamer, stream_response.status_code)
+        if cache_key:
+            generator = self.cache_chunks(
+                generator, streamer, cache_key, stream_response.status_code
+            )
+        return generator
+
+    def add_truncation(self, data_response: dict, truncation: dict = None):
+        if truncation:
+            data_response["truncation"] = truncation
+        return data_response
+
+    async def chat_completions(
+        self,
+        item: ChatCompletionsPostItem,
+        response: Response,
+        request_timeout: Union[float, None] = Header(
+            default=None,
+            alias="X-Request-Timeout",
+            description="(float) Seconds until the request deadline, defaults to config `request_timeout`",
+        ),
+        api_key: str = Depends(extract_api_key),
+    ):
+        timer = PhaseTimer()
+        started_at = timer.started_at
+        deadline = Deadline(request_timeout)
+        streamer = None
+        record = self.new_log_record(item)
+        # streams are logged when they end, in `log_chunks()`
+        is_stream_logged = False
+        try:
+            api_key = self.auth_api_key(api_key)
+            timer.mark("auth")
+
+            if item.truncate is None:
+                is_truncate = get_config("context_truncation", False)
             else:
-                streamer = HuggingfaceStreamer(model=item.model)
+                is_truncate = item.truncate
+
+            composer = None
+            fitter = None
+            streamer = await self.create_streamer(item.model)
+            if isinstance(streamer, HuggingfaceStreamer):
                 composer = MessageComposer(model=item.model)
-                composer.merge(messages=item.messages)
-                stream_response = streamer.chat_response(
+                labels = (streamer.model, streamer.backend, "compose")
+                if is_truncate:
+                    fitter = await deadline.wait_for(
+                        TOKENIZER_POOL.run(
+                            self.fit_context_window,
+                            composer,
+                            messages=item.messages,
+                            max_tokens=item.max_tokens,
+                            labels=labels,
+                        ),
+                        "compose",
+                    )
+                else:
+                    await deadline.wait_for(
+                        TOKENIZER_POOL.run(
+                            composer.merge, messages=item.messages, labels=labels
+                        ),
+                        "compose",
+                    )
+            timer.mark("compose")
+            REQUESTS_TOTAL.labels(
+                streamer.model, streamer.backend, str(item.stream).lower()
+            ).inc()
+
+            headers = {}
+            truncation = None
+            if fitter and fitter.dropped_messages:
+                headers["X-Truncated-Tokens"] = str(fitter.dropped_tokens)
+                truncation = {
+                    "dropped_messages": fitter.dropped_messages,
+                    "dropped_tokens": fitter.dropped_tokens,
+                }
+            response.headers.update(headers)
+            if fitter:
+                record["truncated_tokens"] = fitter.dropped_tokens
+
+            if isinstance(streamer, HuggingfaceStreamer):
+                prompt = composer.merged_str
+            else:
+                prompt = json.dumps(item.messages, ensure_ascii=False)
+            record["prompt_hash"] = hashlib.sha256(prompt.encode("utf-8")).hexdigest()[
+                :16
+            ]
+
+            is_cacheable = RESPONSE_CACHE.is_cacheable(item.use_cache)
+            is_coalescable = REQUEST_COALESCER.is_coalescable(
+                item.model, item.use_cache
+            )
+            request_key = None
+            if is_cacheable or is_coalescable:
+                request_key = RESPONSE_CACHE.get_key(
+                    model=streamer.model,
+                    prompt=prompt,
+                    temperature=item.temperature,
+                    top_p=item.top_p,
+                    max_tokens=item.max_tokens,
+                )
+            cache_key = request_key if is_cacheable else None
+
+            if cache_key:
+                content = await run_in_threadpool(RESPONSE_CACHE.get, cache_key)
+                timer.mark("cache")
+                record["cache"] = "miss" if content is None else "hit"
+                if content is not None:
+                    if item.stream:
+                        is_stream_logged = True
+                        return self.event_source_response(
+                            self.track(
+                                self.replay_chunks(streamer, content),
+                                streamer,
+                                started_at,
+                                record,
+                                timer,
+                            ),
+                            headers={**headers, "X-Cache": "HIT"},
+                            timer=timer,
+                        )
+                    else:
+                        data_response = streamer.message_outputer.output_completion(
+                            content
+                        )
+                        response.headers["Server-Timing"] = timer.to_header()
+                        record["status_code"] = 200
+                        record["finish_reason"] = "stop"
+                        return self.add_truncation(data_response, truncation)
+
+            if is_coalescable:
+                record["coalesced"] = True
+                subscription = REQUEST_COALESCER.join(
+                    REQUEST_COALESCER.get_key(request_key, api_key),
+                    # the flight outlives this request, so it has its own deadline
+                    lambda: self.open_stream(
+                        streamer,
+                        item,
+                        composer,
+                        api_key,
+                        PhaseTimer(),
+                        Deadline(),
+                        cache_key,
+                    ),
+                )
+                try:
+                    await deadline.wait_for(
+                        subscription.flight.wait_opened(), "upstream"
+                    )
+                    timer.mark("upstream")
+                    if item.stream:
+                        is_stream_logged = True
+                        return self.event_source_response(
+                            self.track(
+                                self.guard_stream(
+                                    subscription.chunks(), streamer, deadline
+                                ),
+                                streamer,
+                                started_at,
+                                record,
+                                timer,
+                            ),
+                            headers,
+                            timer,
+                            # also run if the client leaves before the first chunk
+                            background=BackgroundTask(subscription.leave),
+                        )
+                    else:
+                        data_response = await deadline.wait_for(
+                            self.collect_completion(streamer, subscription.chunks()),
+                            "body",
+                        )
+                        timer.mark("body")
+                        response.headers["Server-Timing"] = timer.to_header()
+                        record["status_code"] = 200
+                        record["finish_reason"] = data_response["choices"][0][
+                            "finish_reason"
+                        ]
+                        return self.add_truncation(data_response, truncation)
+                except BaseException:
+                    subscription.leave()
+                    raise
+
+            if item.stream:
+                generator = await self.open_stream(
+                    streamer, item, composer, api_key, timer, deadline, cache_key
+                )
+                is_stream_logged = True
+                return self.event_source_response(
+                    self.track(
+                        self.guard_stream(generator, streamer, deadline),
+                        streamer,
+                        started_at,
+                        record,
+                        timer,
+                    ),
+                    headers,
+                    timer,
+                )
+
+            if isinstance(streamer, HuggingfaceStreamer):
+                stream_response = await streamer.chat_response_async(
                     prompt=composer.merged_str,
+                    prompt_segments=composer.segments,
                     temperature=item.temperature,
                     top_p=item.top_p,
                     max_new_tokens=item.max_tokens,
                     api_key=api_key,
                     use_cache=item.use_cache,
+                    timer=timer,
+                    deadline=deadline,
                 )
-
-            if item.stream:
-                event_source_response = EventSourceResponse(
-                    streamer.chat_return_generator(stream_response),
-                    media_type="text/event-stream",
-                    ping=2000,
-                    ping_message_factory=lambda: ServerSentEvent(**{"comment": ""}),
+                data_response = await deadline.wait_for(
+                    streamer.chat_return_dict_async(stream_response), "body"
                 )
-                return event_source_response
             else:
-                data_response = streamer.chat_return_dict(stream_response)
-                return data_response
+                stream_response = await self.chat_response_sync(
+                    streamer, item, timer, deadline
+                )
+                try:
+                    data_response = await self.run_until_deadline(
+                        deadline,
+                        "body",
+                        functools.partial(streamer.chat_return_dict, stream_response),
+                    )
+                except DeadlineExceeded:
+                    # unblocks the abandoned thread
+                    await run_in_threadpool(stream_response.close)
+                    raise
+            timer.mark("body")
+            response.headers["Server-Timing"] = timer.to_header()
+            self.observe_upstream(streamer, stream_response.status_code)
+            if cache_key and stream_response.status_code == 200:
+                content = data_response["choices"][0]["message"]["content"]
+                await run_in_threadpool(RESPONSE_CACHE.set, cache_key, content)
+            record["status_code"] = stream_response.status_code
+            record["finish_reason"] = data_response["choices"][0]["finish_reason"]
+            return self.add_truncation(data_response, truncation)
         except HfApiException as e:
+            if isinstance(e, DeadlineExceeded):
+                self.count_deadline_exceeded(streamer, e.phase)
+            self.count_error(streamer, e.status_code)
+            record["status_code"] = e.status_code
+            record["error"] = str(e.detail)
             raise HTTPException(status_code=e.status_code, detail=e.detail)
         except Exception as e:
-            raise HTTPException(status_code=500, detail=str(e))
+            status_code, detail = 500, str(e)
+            if is_timeout_error(e):
+                # read timeouts of upstreams are capped by the time left
+                phase = "total" if deadline.is_expired() else "upstream"
+                self.count_deadline_exceeded(streamer, phase)
+                status_code, detail = 504, DeadlineExceeded(phase).detail
+            self.count_error(streamer, status_code)
+            record["status_code"] = status_code
+            record["error"] = detail
+            raise HTTPException(status_code=status_code, detail=detail)
+        finally:
+            # durations of streams are observed when they end, in `track_stream()`
+            if streamer and not item.stream:
+                REQUEST_DURATION_SECONDS.labels(
+                    streamer.model, streamer.backend, "false"
+                ).observe(time.perf_counter() - started_at)
+            if not is_stream_logged:
+                self.log_request(record, timer, streamer)
+
+    def get_stats(self):
+        return {
+            # with multiple workers, each one reports its own stats
+            "worker_pid": os.getpid(),
+            "tokenizers": TOKENIZER_REGISTRY.stats(),
+            "prompt_templates": PROMPT_TEMPLATES.stats(),
+            "token_counts": TOKEN_COUNT_CACHE.stats(),
+            "tokenizer_pool": TOKENIZER_POOL.stats(),
+            "http_pools": get_pools_stats(),
+            "upstreams": UPSTREAM_ROUTER.stats(),
+            "huggingchat_sessions": self.get_backend_stats(
+                "huggingchat", "HUGGINGCHAT_SESSION_POOL"
+            ),
+            "openai_credentials": self.get_backend_stats(
+                "openai", "OPENAI_CREDENTIAL_POOL"
+            ),
+            "response_cache": RESPONSE_CACHE.stats(),
+            "request_coalescer": REQUEST_COALESCER.stats(),
+            "request_log": REQUEST_LOG.stats(),
+        }
+
+    def get_metrics(self):
+        return PlainTextResponse(
+            METRICS_REGISTRY.render(),
+            media_type="text/plain; version=0.0.4; charset=utf-8",
+        )
 
     def get_readme(self):
+        import markdown2
+
         readme_path = Path(__file__).parents[1] / "README.md"
         with open(readme_path, "r", encoding="utf-8") as rf:
             readme_str = rf.read()
@@ -169,6 +850,16 @@ class ChatAPIApp:
             response_class=HTMLResponse,
             include_in_schema=False,
         )(self.get_readme)
+        self.app.get(
+            "/metrics",
+            summary="Prometheus metrics",
+            include_in_schema=False,
+        )(self.get_metrics)
+        self.app.get(
+            "/stats",
+            summary="Runtime stats of caches and pools",
+            include_in_schema=False,
+        )(self.get_stats)
 
 
 class ArgParser(argparse.ArgumentParser):
@@ -197,6 +888,20 @@ class ArgParser(argparse.ArgumentParser):
             action="store_true",
             help="Run in dev mode",
         )
+        self.add_argument(
+            "-n",
+            "--workers",
+            type=int,
+            default=1,
+            help="Number of worker processes, 0 for one per CPU core",
+        )
+        self.add_argument(
+            "-w",
+            "--warmup",
+            default=False,
+            action="store_true",
+            help="Load backends and tokenizers before serving requests",
+        )
 
         self.args = self.parse_args(sys.argv[1:])
 
@@ -205,10 +910,38 @@ app = ChatAPIApp().app
 
 if __name__ == "__main__":
     args = ArgParser().args
+    # env vars are inherited by the reloader's worker process
+    if args.warmup:
+        os.environ["warmup"] = "true"
     if args.dev:
+        # per-token console logs
+        os.environ["log_tokens"] = "true"
         uvicorn.run("__main__:app", host=args.host, port=args.port, reload=True)
+    elif args.workers != 1:
+        workers = args.workers or os.cpu_count() or 1
+        # caches and session pools are shared by workers in a SQLite (WAL) file,
+        # explicit paths in configs/config.json take precedence.
+        # the file holds sessions and credentials, so it is kept in a new 0700 dir,
+        # instead of a predictable path that other local users could create first
+        shared_db_dir = tempfile.mkdtemp(prefix=f"hf-llm-api-{args.port}-")
+        shared_db_path = Path(shared_db_dir) / "shared.db"
+        os.environ.setdefault("shared_state_path", str(shared_db_path))
+        os.environ.setdefault("response_cache_sqlite_path", str(shared_db_path))
+        # split cores between workers, instead of each running 2 tokenizer threads
+        os.environ.setdefault(
+            "tokenizer_pool_workers", str(max((os.cpu_count() or 1) // workers, 1))
+        )
+        logger.note(f"> Starting {workers} workers")
+        try:
+            uvicorn.run(
+                "apis.chat_api:app", host=args.host, port=args.port, workers=workers
+            )
+        finally:
+            shutil.rmtree(shared_db_dir, ignore_errors=True)
     else:
         uvicorn.run("__main__:app", host=args.host, port=args.port, reload=False)
 
     # python -m apis.chat_api      # [Docker] on product mode
     # python -m apis.chat_api -d   # [Dev]    on develop mode
+    # python -m apis.chat_api -w   # [Warmup] load backends and tokenizers on startup
+    # python -m apis.chat_api -n 0 # [Prod]   one worker per CPU core
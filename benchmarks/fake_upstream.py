@@ -0,0 +1,236 @@
+import argparse
+import asyncio
+import json
+import random
+import sys
+import uuid
+
+import uvicorn
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from constants.models import MODEL_MAP, STOP_SEQUENCES_MAP
+
+FULLNAME_STOP_SEQUENCES = {
+    MODEL_MAP[model]: stop_sequence
+    for model, stop_sequence in STOP_SEQUENCES_MAP.items()
+}
+
+
+class FakeUpstream:
+    """
+    Local stand-in for the upstreams, to benchmark without hitting Hugging Face.
+    * TGI streams of `/models/{org}/{model}`, for `HuggingfaceStreamer`
+    * HuggingChat conversations of `/chat/...`, for `HuggingchatStreamer`
+    * ChatGPT backend of `/backend-anon/...`, for `OpenaiStreamer`
+    * `ttft_ms` before the first token, `token_ms` between tokens,
+      and `error_rate` of requests answered with 503
+    * `aborted` counts streams closed by the client before their last chunk
+    """
+
+    def __init__(
+        self,
+        ttft_ms: float = 200,
+        token_ms: float = 20,
+        tokens: int = 64,
+        error_rate: float = 0.0,
+    ):
+        self.ttft_ms = ttft_ms
+        self.token_ms = token_ms
+        self.tokens = tokens
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+        self.aborted = 0
+        self.app = FastAPI(docs_url=None, redoc_url=None)
+        self.setup_routes()
+
+    def get_tokens(self) -> list[str]:
+        return [f" token{idx}" for idx in range(self.tokens)]
+
+    def is_error(self) -> bool:
+        self.requests += 1
+        if random.random() < self.error_rate:
+            self.errors += 1
+            return True
+        return False
+
+    def error_response(self):
+        return JSONResponse(
+            {"error": "Model is overloaded", "error_type": "overloaded"},
+            status_code=503,
+        )
+
+    async def iter_delays(self, items: list):
+        await asyncio.sleep(self.ttft_ms / 1000)
+        for idx, item in enumerate(items):
+            if idx > 0:
+                await asyncio.sleep(self.token_ms / 1000)
+            yield idx, item
+
+    async def track_aborts(self, chunks):
+        is_finished = False
+        try:
+            async for chunk in chunks:
+                yield chunk
+            is_finished = True
+        finally:
+            if not is_finished:
+                self.aborted += 1
+
+    async def tgi_generate(self, org: str, model: str, request: Request):
+        # https://huggingface.co/docs/text-generation-inference/conceptual/streaming
+        await request.body()
+        if self.is_error():
+            return self.error_response()
+        stop_sequence = FULLNAME_STOP_SEQUENCES.get(f"{org}/{model}", "</s>")
+        tokens = self.get_tokens() + [stop_sequence]
+
+        async def events():
+            async for idx, text in self.iter_delays(tokens):
+                is_last = idx == len(tokens) - 1
+                data = {
+                    "index": idx,
+                    "token": {
+                        "id": idx,
+                        "text": text,
+                        "logprob": 0.0,
+                        "special": is_last,
+                    },
+                    "generated_text": "".join(tokens[:-1]) if is_last else None,
+                    "details": None,
+                }
+                yield f"data:{json.dumps(data)}\n\n".encode("utf-8")
+
+        return StreamingResponse(
+            self.track_aborts(events()), media_type="text/event-stream"
+        )
+
+    async def huggingchat_settings(self, request: Request):
+        response = JSONResponse({})
+        response.set_cookie("hf-chat", str(uuid.uuid4()))
+        return response
+
+    async def huggingchat_conversation(self, request: Request):
+        return {"conversationId": uuid.uuid4().hex[:24]}
+
+    async def huggingchat_data(self, conversation_id: str, request: Request):
+        return {"nodes": [{}, {"data": [str(uuid.uuid4())]}]}
+
+    async def huggingchat_generate(self, conversation_id: str, request: Request):
+        await request.body()
+        if self.is_error():
+            return self.error_response()
+        tokens = self.get_tokens()
+
+        async def lines():
+            yield b'{"type":"status","status":"started"}\n'
+            async for idx, token in self.iter_delays(tokens):
+                yield (json.dumps({"type": "stream", "token": token}) + "\n").encode()
+            final = {"type": "finalAnswer", "text": "".join(tokens)}
+            yield (json.dumps(final) + "\n").encode("utf-8")
+
+        return StreamingResponse(
+            self.track_aborts(lines()), media_type="text/event-stream"
+        )
+
+    async def openai_requirements(self, request: Request):
+        # an easy difficulty, so that the proof token is found at once
+        return {
+            "token": uuid.uuid4().hex,
+            "proofofwork": {"required": True, "seed": "0.42", "difficulty": "ffffff"},
+        }
+
+    async def openai_conversation(self, request: Request):
+        await request.body()
+        if self.is_error():
+            return self.error_response()
+        tokens = self.get_tokens()
+        message_id = str(uuid.uuid4())
+
+        def message_event(content: str, status: str) -> bytes:
+            data = {
+                "message": {
+                    "id": message_id,
+                    "author": {"role": "assistant"},
+                    "content": {"content_type": "text", "parts": [content]},
+                    "status": status,
+                },
+                "conversation_id": message_id,
+                "error": None,
+            }
+            return f"data: {json.dumps(data)}\n\n".encode("utf-8")
+
+        async def events():
+            # the ChatGPT backend resends the accumulated message in each event
+            content = ""
+            async for idx, token in self.iter_delays(tokens):
+                content += token
+                yield message_event(content, "in_progress")
+            yield message_event(content, "finished_successfully")
+            yield b"data: [DONE]\n\n"
+
+        return StreamingResponse(
+            self.track_aborts(events()), media_type="text/event-stream"
+        )
+
+    def get_stats(self):
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "aborted": self.aborted,
+        }
+
+    def setup_routes(self):
+        self.app.post("/models/{org}/{model}")(self.tgi_generate)
+        self.app.post("/chat/settings")(self.huggingchat_settings)
+        self.app.post("/chat/conversation")(self.huggingchat_conversation)
+        self.app.post("/chat/conversation/{conversation_id}/__data.json")(
+            self.huggingchat_data
+        )
+        self.app.post("/chat/conversation/{conversation_id}")(self.huggingchat_generate)
+        self.app.post("/backend-anon/sentinel/chat-requirements")(
+            self.openai_requirements
+        )
+        self.app.post("/backend-anon/conversation")(self.openai_conversation)
+        self.app.get("/stats")(self.get_stats)
+
+
+class ArgParser(argparse.ArgumentParser):
+    def __init__(self, *args, **kwargs):
+        super(ArgParser, self).__init__(*args, **kwargs)
+
+        self.add_argument("-s", "--host", type=str, default="127.0.0.1")
+        self.add_argument("-p", "--port", type=int, default=23334)
+        self.add_argument(
+            "--ttft-ms", type=float, default=200, help="Delay before the first token"
+        )
+        self.add_argument(
+            "--token-ms", type=float, default=20, help="Delay between tokens"
+        )
+        self.add_argument(
+            "-n", "--tokens", type=int, default=64, help="Tokens per response"
+        )
+        self.add_argument(
+            "-e",
+            "--error-rate",
+            type=float,
+            default=0.0,
+            help="Ratio of requests answered with 503",
+        )
+
+        self.args = self.parse_args(sys.argv[1:])
+
+
+if __name__ == "__main__":
+    args = ArgParser().args
+    upstream = FakeUpstream(
+        ttft_ms=args.ttft_ms,
+        token_ms=args.token_ms,
+        tokens=args.tokens,
+        error_rate=args.error_rate,
+    )
+    uvicorn.run(upstream.app, host=args.host, port=args.port, log_level="warning")
+
+    # python -m benchmarks.fake_upstream --ttft-ms 200 --token-ms 20 -e 0.01
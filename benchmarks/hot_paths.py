@@ -0,0 +1,303 @@
+import argparse
+import json
+import platform
+import sys
+import time
+import timeit
+
+from pathlib import Path
+
+from tclogger import logger
+
+from constants.models import AVAILABLE_MODELS, STOP_SEQUENCES_MAP
+from messagers.message_composer import MessageComposer
+from messagers.message_outputer import OpenaiStreamOutputer
+from messagers.token_checker import TOKEN_COUNT_CACHE, TokenChecker
+from networks.huggingchat_streamer import HuggingchatStreamer
+from networks.huggingface_streamer import HuggingfaceStreamer
+from networks.openai_delta_extractor import build_synthetic_events
+from networks.openai_streamer import OpenaiStreamer
+from networks.proof_worker import ProofWorker
+
+STREAM_TOKENS = 256
+WORDS = ["Hello", " world", ",", " this", " is", ' "quoted"', " 你好", "\n"]
+MESSAGES = [
+    {"role": "system", "content": "You are a helpful assistant."},
+    {"role": "user", "content": "Hello, who are you?"},
+    {"role": "assistant", "content": "I am a bot."},
+    {"role": "user", "content": "What is your name?"},
+    {"role": "user", "content": "And what can you do?"},
+    {"role": "assistant", "content": "I can answer questions. " * 20},
+    {"role": "user", "content": "Tell me a joke about " + "robots " * 50},
+]
+
+
+class FakeStreamResponse:
+    """
+    Replays pre-built chunks, in place of a `requests` stream response.
+    """
+
+    status_code = 200
+
+    def __init__(self, chunks: list[bytes]):
+        self.chunks = chunks
+
+    def iter_content(self, chunk_size=None):
+        return iter(self.chunks)
+
+    def close(self):
+        pass
+
+
+def get_tokens(n: int = STREAM_TOKENS) -> list[str]:
+    return [WORDS[idx % len(WORDS)] for idx in range(n)]
+
+
+def build_tgi_chunks(n: int = STREAM_TOKENS, stop_sequence="<|im_end|>") -> list:
+    chunks = []
+    for idx, text in enumerate(get_tokens(n) + [stop_sequence]):
+        data = {
+            "index": idx,
+            "token": {"id": idx, "text": text, "logprob": -0.1, "special": False},
+            "generated_text": None,
+            "details": None,
+        }
+        chunks.append(f"data:{json.dumps(data)}\n\n".encode("utf-8"))
+    return chunks
+
+
+def build_huggingchat_chunks(n: int = STREAM_TOKENS) -> list:
+    tokens = get_tokens(n)
+    chunks = [b'{"type":"status","status":"started"}\n']
+    for token in tokens:
+        chunks.append(json.dumps({"type": "stream", "token": token}).encode() + b"\n")
+    final = {"type": "finalAnswer", "text": "".join(tokens)}
+    chunks.append(json.dumps(final).encode() + b"\n")
+    return chunks
+
+
+def build_openai_chunks(n: int = STREAM_TOKENS) -> list:
+    chunks = [b"data: " + event + b"\n\n" for event in build_synthetic_events(n)]
+    chunks.append(b"data: [DONE]\n\n")
+    return chunks
+
+
+class HotPathBenchmarks:
+    """
+    Micro-benchmarks of the code run per token or per request.
+    * Each case returns `(func, ops, unit)`, where one `func()` call runs `ops` ops
+    * Results are the best of `repeat` runs, in ns per op
+    """
+
+    def __init__(self, repeat: int = 5, name_filter: str = None):
+        self.repeat = repeat
+        self.name_filter = name_filter
+
+    def case_outputer_output(self):
+        outputer = OpenaiStreamOutputer()
+        tokens = get_tokens()
+
+        def func():
+            for token in tokens:
+                outputer.output(content=token)
+
+        return func, len(tokens), "token"
+
+    def case_parse_line(self):
+        streamer = HuggingfaceStreamer(model="nous-mixtral-8x7b")
+        lines = [chunk.strip() for chunk in build_tgi_chunks()]
+
+        def func():
+            for line in lines:
+                streamer.parse_line(line)
+
+        return func, len(lines), "token"
+
+    def case_concat_messages_by_role(self):
+        composer = MessageComposer(model="mixtral-8x7b")
+        return lambda: composer.concat_messages_by_role(MESSAGES), 1, "request"
+
+    def case_merge(self, model: str):
+        composer = MessageComposer(model=model)
+        composer.merge(MESSAGES)
+        return lambda: composer.merge(MESSAGES), 1, "request"
+
+    def case_token_checker(self, model: str = "nous-mixtral-8x7b"):
+        composer = MessageComposer(model=model)
+        composer.merge(MESSAGES)
+        prompt, segments = composer.merged_str, composer.segments
+        TokenChecker(prompt, model, segments).count_tokens()
+
+        def func():
+            TokenChecker(prompt, model, segments).count_tokens()
+
+        return func, 1, "request"
+
+    def case_token_checker_uncached(self, model: str = "nous-mixtral-8x7b"):
+        composer = MessageComposer(model=model)
+        composer.merge(MESSAGES)
+        prompt, segments = composer.merged_str, composer.segments
+        TokenChecker(prompt, model, segments).count_tokens()
+
+        def func():
+            with TOKEN_COUNT_CACHE.lock:
+                TOKEN_COUNT_CACHE.counts.clear()
+            TokenChecker(prompt, model, segments).count_tokens()
+
+        return func, 1, "request"
+
+    def case_calc_proof_token(self):
+        # no hex digest is <= "!", so every call searches the full counter range
+        worker = ProofWorker()
+        func = lambda: worker.calc_proof_token("0.42665582", "!" * 6, processes=0)
+        return func, 1, "request"
+
+    def case_chat_return_dict(self, streamer, chunks: list):
+        def func():
+            streamer.chat_return_dict(FakeStreamResponse(chunks))
+
+        return func, STREAM_TOKENS, "token"
+
+    def case_huggingface_return_dict(self, model: str = "nous-mixtral-8x7b"):
+        streamer = HuggingfaceStreamer(model=model)
+        # set by `build_request()` otherwise
+        streamer.stop_sequences = STOP_SEQUENCES_MAP[model]
+        chunks = build_tgi_chunks(stop_sequence=streamer.stop_sequences)
+        return self.case_chat_return_dict(streamer, chunks)
+
+    def get_cases(self) -> dict:
+        cases = {
+            "outputer.output": self.case_outputer_output,
+            "huggingface.parse_line": self.case_parse_line,
+            "composer.concat_messages_by_role": self.case_concat_messages_by_role,
+        }
+        for model in AVAILABLE_MODELS:
+            if model != "default":
+                cases[f"composer.merge.{model}"] = lambda model=model: self.case_merge(
+                    model
+                )
+        cases.update(
+            {
+                "token_checker": self.case_token_checker,
+                "token_checker.uncached": self.case_token_checker_uncached,
+                "proof_worker.calc_proof_token": self.case_calc_proof_token,
+                "huggingface.chat_return_dict": self.case_huggingface_return_dict,
+                "huggingchat.chat_return_dict": lambda: self.case_chat_return_dict(
+                    HuggingchatStreamer(model="command-r-plus"),
+                    build_huggingchat_chunks(),
+                ),
+                "openai.chat_return_dict": lambda: self.case_chat_return_dict(
+                    OpenaiStreamer(), build_openai_chunks()
+                ),
+            }
+        )
+        if self.name_filter:
+            cases = {
+                name: case for name, case in cases.items() if self.name_filter in name
+            }
+        return cases
+
+    def measure(self, func, ops: int) -> float:
+        timer = timeit.Timer(func)
+        loops, _ = timer.autorange()
+        seconds = min(timer.repeat(repeat=self.repeat, number=loops))
+        return seconds / loops / ops * 1e9
+
+    def run(self) -> dict:
+        results = {}
+        for name, case in self.get_cases().items():
+            logger.enter_quiet(True)
+            try:
+                func, ops, unit = case()
+                ns_per_op = self.measure(func, ops)
+                result = {
+                    "ns_per_op": round(ns_per_op, 1),
+                    "ops_per_sec": round(1e9 / ns_per_op, 1),
+                    "unit": unit,
+                }
+            except Exception as e:
+                # e.g. tokenizers which are not downloadable here
+                result = {"error": f"{type(e).__name__}: {e}"}
+            finally:
+                logger.exit_quiet(True)
+            results[name] = result
+            if "error" in result:
+                logger.warn(f"{name:<36} skipped: {result['error']}")
+            else:
+                logger.mesg(
+                    f"{name:<36} {result['ns_per_op']:>14,.1f} ns/{unit}"
+                    f" {result['ops_per_sec']:>14,.1f} {unit}s/sec"
+                )
+        return {
+            "meta": {
+                "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "repeat": self.repeat,
+            },
+            "results": results,
+        }
+
+
+def compare(report: dict, baseline: dict, threshold: float = 0.2) -> list[str]:
+    """
+    Names of cases slower than the baseline by more than `threshold`.
+    """
+    regressions = []
+    for name, result in report["results"].items():
+        base_result = baseline["results"].get(name, {})
+        if "ns_per_op" not in result or "ns_per_op" not in base_result:
+            continue
+        ratio = result["ns_per_op"] / base_result["ns_per_op"]
+        line = f"{name:<36} {ratio:>6.2f}x of baseline"
+        if ratio > 1 + threshold:
+            regressions.append(name)
+            logger.warn(line)
+        else:
+            logger.success(line)
+    return regressions
+
+
+class ArgParser(argparse.ArgumentParser):
+    def __init__(self, *args, **kwargs):
+        super(ArgParser, self).__init__(*args, **kwargs)
+
+        self.add_argument(
+            "-o", "--output", type=Path, default=None, help="Write results as JSON"
+        )
+        self.add_argument(
+            "-b",
+            "--baseline",
+            type=Path,
+            default=None,
+            help="Results JSON to compare with",
+        )
+        self.add_argument(
+            "-t",
+            "--threshold",
+            type=float,
+            default=0.2,
+            help="Fail if a case is slower than the baseline by this ratio",
+        )
+        self.add_argument("-r", "--repeat", type=int, default=5)
+        self.add_argument(
+            "-k", "--filter", type=str, default=None, help="Only run matched cases"
+        )
+
+        self.args = self.parse_args(sys.argv[1:])
+
+
+if __name__ == "__main__":
+    args = ArgParser().args
+    report = HotPathBenchmarks(repeat=args.repeat, name_filter=args.filter).run()
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=4), encoding="utf-8")
+    if args.baseline:
+        baseline = json.loads(args.baseline.read_text(encoding="utf-8"))
+        regressions = compare(report, baseline, threshold=args.threshold)
+        if regressions:
+            logger.err(f"× Regressed: {regressions}")
+            sys.exit(1)
+
+    # python -m benchmarks.hot_paths -o bench.json
+    # python -m benchmarks.hot_paths -b bench.json -t 0.2
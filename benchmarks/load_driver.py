@@ -0,0 +1,255 @@
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import sys
+import time
+
+from pathlib import Path
+
+import httpx
+
+from tclogger import logger
+
+from constants.envs import CONFIG
+
+
+def percentile(values: list[float], p: float) -> float:
+    # nearest-rank percentile
+    if not values:
+        return 0.0
+    values = sorted(values)
+    rank = max(math.ceil(p / 100 * len(values)), 1)
+    return values[rank - 1]
+
+
+def summarize(values: list[float]) -> dict:
+    return {
+        "p50": round(percentile(values, 50), 4),
+        "p95": round(percentile(values, 95), 4),
+        "p99": round(percentile(values, 99), 4),
+        "avg": round(sum(values) / len(values), 4) if values else 0.0,
+    }
+
+
+class TrafficLoader:
+    """
+    Request bodies to replay, from a JSONL file.
+    * Lines with a `messages` list (request bodies) are sent as they are
+    * Lines of the request log (`metrics.request_log`) only have counts,
+      so `messages` turns of about `prompt_tokens` words in total are synthesized
+    """
+
+    def __init__(self, path: Path = None, model: str = None, stream: bool = None):
+        self.path = path
+        self.model = model
+        self.stream = stream
+
+    def synthesize_messages(self, count: int, prompt_tokens: int) -> list[dict]:
+        count = max(count, 1)
+        words = max(prompt_tokens // count, 1)
+        roles = itertools.cycle(["user", "assistant"])
+        messages = [
+            {"role": next(roles), "content": " ".join(["hello"] * words)}
+            for _ in range(count)
+        ]
+        # the last turn is from the user
+        messages[-1]["role"] = "user"
+        return messages
+
+    def to_body(self, record: dict) -> dict:
+        messages = record.get("messages")
+        if not isinstance(messages, list):
+            messages = self.synthesize_messages(
+                messages or 1, record.get("prompt_tokens") or 64
+            )
+        body = {
+            "model": self.model or record.get("model") or "nous-mixtral-8x7b",
+            "messages": messages,
+            "stream": (
+                record.get("stream", True) if self.stream is None else self.stream
+            ),
+        }
+        for key in ["temperature", "top_p", "max_tokens", "use_cache"]:
+            if record.get(key) is not None:
+                body[key] = record[key]
+        return body
+
+    def load(self) -> list[dict]:
+        if not self.path:
+            return [self.to_body({})]
+        bodies = []
+        with open(self.path, "r", encoding="utf-8") as rf:
+            for line in rf:
+                line = line.strip()
+                if line:
+                    bodies.append(self.to_body(json.loads(line)))
+        return bodies
+
+
+class LoadDriver:
+    """
+    Replay chat completion requests at a fixed concurrency,
+    and report TTFT, latency, throughput and error rates.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        bodies: list[dict],
+        concurrency: int = 8,
+        requests: int = 100,
+        api_key: str = None,
+        timeout: float = 60,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.bodies = bodies
+        self.concurrency = concurrency
+        self.requests = requests
+        self.headers = {"Authorization": f"Bearer {api_key or 'sk-benchmark'}"}
+        self.timeout = timeout
+        self.results = []
+
+    async def send_stream(self, client: httpx.AsyncClient, body: dict) -> dict:
+        result = {"status_code": None, "ttft": None, "chunks": 0, "error": None}
+        async with client.stream(
+            "POST", "/chat/completions", json=body, headers=self.headers
+        ) as response:
+            result["status_code"] = response.status_code
+            if response.status_code != 200:
+                await response.aread()
+                return result
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = json.loads(line[len("data:") :])
+                if data["choices"][0]["delta"].get("content"):
+                    if result["ttft"] is None:
+                        result["ttft"] = time.perf_counter()
+                    result["chunks"] += 1
+        return result
+
+    async def send(self, client: httpx.AsyncClient, body: dict) -> dict:
+        started_at = time.perf_counter()
+        try:
+            if body.get("stream", True):
+                result = await self.send_stream(client, body)
+            else:
+                response = await client.post(
+                    "/chat/completions", json=body, headers=self.headers
+                )
+                result = {"status_code": response.status_code, "chunks": 0}
+                result["ttft"] = time.perf_counter()
+                if response.status_code == 200:
+                    message = response.json()["choices"][0]["message"]
+                    if not message["content"]:
+                        result["error"] = "empty_response"
+        except Exception as e:
+            result = {"status_code": None, "ttft": None, "chunks": 0}
+            result["error"] = type(e).__name__
+        ended_at = time.perf_counter()
+        result["latency"] = ended_at - started_at
+        if result["ttft"] is not None:
+            result["ttft"] -= started_at
+        elif result["status_code"] == 200:
+            result["error"] = "empty_stream"
+        result["ok"] = result["status_code"] == 200 and not result.get("error")
+        return result
+
+    async def worker(self, client: httpx.AsyncClient, queue: asyncio.Queue):
+        while True:
+            try:
+                body = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            self.results.append(await self.send(client, body))
+
+    async def run(self) -> dict:
+        queue = asyncio.Queue()
+        for body in itertools.islice(itertools.cycle(self.bodies), self.requests):
+            queue.put_nowait(body)
+        limits = httpx.Limits(max_connections=self.concurrency)
+        async with httpx.AsyncClient(
+            base_url=self.base_url, limits=limits, timeout=self.timeout
+        ) as client:
+            started_at = time.perf_counter()
+            await asyncio.gather(
+                *[self.worker(client, queue) for _ in range(self.concurrency)]
+            )
+            ended_at = time.perf_counter()
+        return self.report(ended_at - started_at)
+
+    def report(self, elapsed: float) -> dict:
+        ok_results = [result for result in self.results if result["ok"]]
+        errors = {}
+        for result in self.results:
+            if result["ok"]:
+                continue
+            reason = result.get("error") or f"http_{result['status_code']}"
+            errors[reason] = errors.get(reason, 0) + 1
+        total = len(self.results)
+        chunks = sum(result["chunks"] for result in ok_results)
+        return {
+            "requests": total,
+            "concurrency": self.concurrency,
+            "elapsed": round(elapsed, 3),
+            "requests_per_second": round(total / elapsed, 2) if elapsed else 0.0,
+            "chunks_per_second": round(chunks / elapsed, 2) if elapsed else 0.0,
+            "error_rate": round(1 - len(ok_results) / total, 4) if total else 0.0,
+            "errors": errors,
+            "ttft_seconds": summarize([result["ttft"] for result in ok_results]),
+            "latency_seconds": summarize([result["latency"] for result in ok_results]),
+        }
+
+
+class ArgParser(argparse.ArgumentParser):
+    def __init__(self, *args, **kwargs):
+        super(ArgParser, self).__init__(*args, **kwargs)
+
+        self.add_argument(
+            "-u",
+            "--url",
+            type=str,
+            default=f"http://127.0.0.1:{CONFIG['port']}",
+            help="Base URL of the API server",
+        )
+        self.add_argument(
+            "-i", "--input", type=Path, default=None, help="JSONL traffic to replay"
+        )
+        self.add_argument("-c", "--concurrency", type=int, default=8)
+        self.add_argument("-n", "--requests", type=int, default=100)
+        self.add_argument("-m", "--model", type=str, default=None)
+        self.add_argument(
+            "--stream",
+            default=None,
+            action=argparse.BooleanOptionalAction,
+            help="Override `stream` of the replayed requests",
+        )
+        self.add_argument("-k", "--api-key", type=str, default=None)
+        self.add_argument(
+            "-o", "--output", type=Path, default=None, help="Write the report as JSON"
+        )
+
+        self.args = self.parse_args(sys.argv[1:])
+
+
+if __name__ == "__main__":
+    args = ArgParser().args
+    bodies = TrafficLoader(args.input, model=args.model, stream=args.stream).load()
+    driver = LoadDriver(
+        args.url,
+        bodies,
+        concurrency=args.concurrency,
+        requests=args.requests,
+        api_key=args.api_key,
+    )
+    report = asyncio.run(driver.run())
+    logger.success(json.dumps(report, indent=4))
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=4), encoding="utf-8")
+
+    # python -m benchmarks.fake_upstream -p 23334
+    # huggingface_api_base=http://127.0.0.1:23334 huggingchat_api_base=http://127.0.0.1:23334 openai_api_base=http://127.0.0.1:23334/backend-anon python -m apis.chat_api
+    # python -m benchmarks.load_driver -c 32 -n 1000
+    # python -m benchmarks.load_driver -i logs/requests.jsonl -c 32 -o load.json
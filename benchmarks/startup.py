@@ -0,0 +1,131 @@
+import argparse
+import json
+import re
+import subprocess
+import sys
+
+from pathlib import Path
+
+from tclogger import logger
+
+REPO_ROOT = Path(__file__).parents[1]
+IMPORTTIME_PATTERN = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s+)(\S+)")
+
+
+def parse_importtime(stderr: str) -> list[dict]:
+    """
+    Parse `python -X importtime` output, in microseconds.
+    * https://docs.python.org/3/using/cmdline.html#cmdoption-X
+    """
+    imports = []
+    for line in stderr.splitlines():
+        match = IMPORTTIME_PATTERN.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            imports.append(
+                {
+                    "module": name,
+                    "self_us": int(self_us),
+                    "cumulative_us": int(cumulative_us),
+                    # top-level imports are indented by one space
+                    "depth": (len(indent) - 1) // 2,
+                }
+            )
+    return imports
+
+
+class StartupBenchmark:
+    """
+    Cold import time of a module, measured in fresh interpreters.
+    * Reports the wall time of `import`, the cumulative time of the slowest modules
+      and the self time summed by top-level package, from the median run
+    """
+
+    def __init__(self, module: str = "apis.chat_api", runs: int = 5, top: int = 20):
+        self.module = module
+        self.runs = runs
+        self.top = top
+
+    def run_once(self) -> dict:
+        code = (
+            "import time; t1 = time.perf_counter(); "
+            f"import {self.module}; "
+            "print(time.perf_counter() - t1)"
+        )
+        process = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", code],
+            cwd=REPO_ROOT,
+            capture_output=True,
+            text=True,
+        )
+        if process.returncode != 0:
+            raise RuntimeError(process.stderr[-2000:])
+        return {
+            "seconds": float(process.stdout.strip().splitlines()[-1]),
+            "imports": parse_importtime(process.stderr),
+        }
+
+    def summarize(self, imports: list[dict]) -> dict:
+        slowest = sorted(imports, key=lambda item: -item["cumulative_us"])
+        # self times add up without double counting nested imports
+        packages = {}
+        for item in imports:
+            package = item["module"].split(".")[0]
+            packages[package] = packages.get(package, 0) + item["self_us"]
+        return {
+            "slowest_modules_ms": {
+                item["module"]: round(item["cumulative_us"] / 1000, 1)
+                for item in slowest[: self.top]
+            },
+            "packages_ms": {
+                package: round(us / 1000, 1)
+                for package, us in sorted(packages.items(), key=lambda kv: -kv[1])[
+                    : self.top
+                ]
+            },
+        }
+
+    def run(self) -> dict:
+        results = sorted(
+            (self.run_once() for _ in range(self.runs)),
+            key=lambda result: result["seconds"],
+        )
+        median = results[len(results) // 2]
+        return {
+            "module": self.module,
+            "runs": self.runs,
+            "import_seconds": {
+                "min": round(results[0]["seconds"], 4),
+                "median": round(median["seconds"], 4),
+                "max": round(results[-1]["seconds"], 4),
+            },
+            **self.summarize(median["imports"]),
+        }
+
+
+class ArgParser(argparse.ArgumentParser):
+    def __init__(self, *args, **kwargs):
+        super(ArgParser, self).__init__(*args, **kwargs)
+
+        self.add_argument("-m", "--module", type=str, default="apis.chat_api")
+        self.add_argument("-n", "--runs", type=int, default=5)
+        self.add_argument("-t", "--top", type=int, default=20)
+        self.add_argument(
+            "-o", "--output", type=Path, default=None, help="Write the report as JSON"
+        )
+
+        self.args = self.parse_args(sys.argv[1:])
+
+
+if __name__ == "__main__":
+    args = ArgParser().args
+    report = StartupBenchmark(module=args.module, runs=args.runs, top=args.top).run()
+    logger.note(f"> Import time of [{report['module']}]:")
+    logger.success(json.dumps(report["import_seconds"]))
+    for name, ms in report["slowest_modules_ms"].items():
+        logger.mesg(f"{name:<48} {ms:>10.1f} ms")
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=4), encoding="utf-8")
+
+    # python -m benchmarks.startup
+    # python -m benchmarks.startup -m networks.openai_streamer -o startup.json
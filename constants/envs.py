@@ -1,7 +1,8 @@
+import json
+
 from pathlib import Path
 from tclogger import logger, OSEnver
 
-
 config_root = Path(__file__).parents[1] / "configs"
 
 secrets_path = config_root / "secrets.json"
@@ -19,3 +20,21 @@ else:
 
 config_path = config_root / "config.json"
 CONFIG = OSEnver(config_path)
+
+
+def get_config(key: str, default=None):
+    # values from configs/config.json take precedence, then env vars (as str)
+    value = CONFIG[key]
+    if value is None:
+        return default
+    if isinstance(value, str) and default is not None and not isinstance(default, str):
+        if isinstance(default, bool):
+            return value.strip().lower() in ["1", "true", "yes", "on"]
+        try:
+            if isinstance(default, (list, dict)):
+                return json.loads(value)
+            return type(default)(value)
+        except ValueError:
+            logger.warn(f"Invalid config value: {key}={value!r}")
+            return default
+    return value
@@ -13,6 +13,14 @@ MODEL_MAP = {
 
 AVAILABLE_MODELS = list(MODEL_MAP.keys())
 
+# As some models are gated, we need to fetch tokenizers from alternatives
+GATED_MODEL_MAP = {
+    "llama3-70b": "NousResearch/Meta-Llama-3-70B",
+    "gemma-7b": "unsloth/gemma-7b",
+    "mistral-7b": "dfurman/Mistral-7B-Instruct-v0.2",
+    "mixtral-8x7b": "dfurman/Mixtral-8x7B-Instruct-v0.1",
+}
+
 PRO_MODELS = ["command-r-plus", "llama3-70b", "zephyr-141b"]
 
 STOP_SEQUENCES_MAP = {
@@ -0,0 +1,150 @@
+from fastapi import status
+from tclogger import logger
+
+from constants.envs import get_config
+from constants.models import TOKEN_LIMIT_MAP, TOKEN_RESERVED
+from messagers.message_composer import MessageComposer
+from messagers.prompt_templates import PROMPT_TEMPLATES
+from messagers.token_checker import TOKEN_COUNT_CACHE, TokenChecker
+from messagers.tokenizer_registry import TOKENIZER_REGISTRY
+from networks.exceptions import HfApiException
+
+ELISION_MARKER = "[{count} earlier messages omitted]"
+
+
+class ContextWindowFitter:
+    """
+    Fit a conversation into the context window of a model, by sliding-window truncation.
+    * System messages and the most recent turns are kept,
+      middle turns are replaced by an elision marker
+    * Messages are sized with cached segment token counts, so a fit costs O(messages),
+      with one merge to verify the cut, and more only if the estimates were too low
+    * A 400 is raised if the system messages and the latest turn alone do not fit
+    * Room is kept for `max_tokens` new tokens, or `truncation_reserved_tokens` if unset
+    """
+
+    def __init__(self, composer: MessageComposer):
+        self.composer = composer
+        self.model = composer.model
+        self.tokenizer_name = TOKENIZER_REGISTRY.get_tokenizer_name(self.model)
+        self.tokenizer = TOKENIZER_REGISTRY.get(self.model)
+        self.template = PROMPT_TEMPLATES.get(self.model)
+        self.dropped_messages = 0
+        self.dropped_tokens = 0
+
+    def get_prompt_budget(self, max_tokens: int = None) -> int:
+        if max_tokens is None or max_tokens <= 0:
+            max_tokens = get_config("truncation_reserved_tokens", 512)
+        token_limit = TOKEN_LIMIT_MAP[self.model]
+        # always leave the prompt at least half of the window
+        max_tokens = min(max_tokens, token_limit // 2)
+        return token_limit - TOKEN_RESERVED - max_tokens
+
+    def count_merged_tokens(self) -> int:
+        checker = TokenChecker(
+            input_str=self.composer.merged_str,
+            model=self.model,
+            segments=self.composer.segments,
+        )
+        return checker.count_tokens()
+
+    def estimate_message_tokens(self, message: dict) -> int:
+        if self.template.is_segmented:
+            text = self.template.render_message(message, False, False)
+        else:
+            # role markers of tokenizer templates are unknown, so pad for them
+            text = f"{message['role']}\n\n{message['content']}\n\n"
+        return TOKEN_COUNT_CACHE.count_segment(
+            self.tokenizer_name, self.tokenizer, text
+        )
+
+    def build_messages(self, system_messages, recent_messages, dropped_count):
+        if dropped_count <= 0:
+            return system_messages + recent_messages
+        marker = {
+            "role": "system",
+            "content": ELISION_MARKER.format(count=dropped_count),
+        }
+        return system_messages + [marker] + recent_messages
+
+    def get_recent_messages(
+        self,
+        messages: list[dict],
+        estimates: list[int],
+        remaining: int,
+        max_count: int = None,
+    ) -> list[dict]:
+        # walk back from the latest message, the latest one is always kept
+        if max_count is None:
+            max_count = len(messages)
+        keep_count = 0
+        for estimate in reversed(estimates):
+            remaining -= estimate
+            if (remaining < 0 or keep_count >= max_count) and keep_count > 0:
+                break
+            keep_count += 1
+        recent_messages = messages[len(messages) - keep_count :]
+        # start the window at a user turn, not in the middle of an answer
+        start = 0
+        while (
+            start < len(recent_messages) - 1
+            and recent_messages[start]["role"] != "user"
+        ):
+            start += 1
+        return recent_messages[start:]
+
+    def fit(self, messages: list[dict], max_tokens: int = None) -> str:
+        """
+        Merge `messages` into the composer, truncated if they do not fit.
+        Returns the merged prompt, raises a 400 `HfApiException`
+        if even the system messages and the latest turn do not fit.
+        """
+        self.composer.merge(messages)
+        budget = self.get_prompt_budget(max_tokens)
+        token_count = self.count_merged_tokens()
+        if token_count <= budget:
+            return self.composer.merged_str
+
+        system_messages = [m for m in messages if m["role"] == "system"]
+        other_messages = [m for m in messages if m["role"] != "system"]
+        marker_tokens = self.estimate_message_tokens(
+            {"role": "system", "content": ELISION_MARKER.format(count=len(messages))}
+        )
+        remaining = budget - marker_tokens
+        remaining -= sum(self.estimate_message_tokens(m) for m in system_messages)
+        estimates = [self.estimate_message_tokens(m) for m in other_messages]
+
+        # the cut is verified by one merge, if the estimates were too low,
+        # the overshoot is cut again from the estimates, not by a merge per turn.
+        # every pass keeps fewer messages, until only the latest one is left
+        max_count = len(other_messages)
+        while True:
+            recent_messages = self.get_recent_messages(
+                other_messages, estimates, remaining, max_count
+            )
+            dropped_count = len(other_messages) - len(recent_messages)
+            self.composer.merge(
+                self.build_messages(system_messages, recent_messages, dropped_count)
+            )
+            truncated_count = self.count_merged_tokens()
+            if truncated_count <= budget or len(recent_messages) <= 1:
+                break
+            remaining -= truncated_count - budget
+            max_count = len(recent_messages) - 1
+
+        if truncated_count > budget:
+            raise HfApiException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=(
+                    f"Prompt is too long: {truncated_count} tokens after truncation, "
+                    f"more than the {budget} tokens left for the prompt"
+                ),
+            )
+
+        self.dropped_messages = dropped_count
+        self.dropped_tokens = max(token_count - truncated_count, 0)
+        logger.note(
+            f"> Truncated {dropped_count} messages ({self.dropped_tokens} tokens): "
+            f"{token_count} -> {truncated_count} tokens"
+        )
+        return self.composer.merged_str
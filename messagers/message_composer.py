@@ -1,9 +1,8 @@
 import re
 from pprint import pprint
 
-from transformers import AutoTokenizer
-
 from constants.models import AVAILABLE_MODELS, MODEL_MAP
+from messagers.prompt_templates import PROMPT_TEMPLATES
 from tclogger import logger
 
 
@@ -37,6 +36,8 @@ class MessageComposer:
             if concat_messages and is_same_role(role, concat_messages[-1]["role"]):
                 concat_messages[-1]["content"] += "\n" + content
             else:
+                # copy, so that messages of the request are not modified
+                message = dict(message)
                 if role in self.inst_roles:
                     message["role"] = "inst"
                 elif role in self.answer_roles:
@@ -47,123 +48,14 @@ class MessageComposer:
         return concat_messages
 
     def merge(self, messages) -> str:
-        # Templates for Chat Models
-        # - https://huggingface.co/docs/transformers/main/en/chat_templating
-        #   - https://huggingface.co/mistralai/Mixtral-8x7B-Instruct-v0.1#instruction-format
-        #   - https://huggingface.co/NousResearch/Nous-Hermes-2-Mixtral-8x7B-DPO#prompt-format
-        #   - https://huggingface.co/openchat/openchat-3.5-0106
-        #   - https://huggingface.co/google/gemma-7b-it#chat-template
-
-        # Mistral and Mixtral:
-        #   <s> [INST] Instruction [/INST] Model answer </s> [INST] Follow-up instruction [/INST]
-
-        # Nous Mixtral:
-        #   <|im_start|>system
-        #   You are "Hermes 2".<|im_end|>
-        #   <|im_start|>user
-        #   Hello, who are you?<|im_end|>
-        #   <|im_start|>assistant
-
-        # OpenChat:
-        #   GPT4 Correct User: Hello<|end_of_turn|>GPT4 Correct Assistant: Hi<|end_of_turn|>GPT4 Correct User: How are you today?<|end_of_turn|>GPT4 Correct Assistant:
-
-        # Google Gemma-it
-        # <start_of_turn>user
-        # How does the brain work?<end_of_turn>
-        # <start_of_turn>model
-
-        self.messages = messages
-        self.merged_str = ""
-
-        # https://huggingface.co/mistralai/Mixtral-8x7B-Instruct-v0.1#instruction-format
-        if self.model in ["mixtral-8x7b", "mistral-7b"]:
+        # Prompt formats of each model are in `messagers.prompt_templates`
+        template = PROMPT_TEMPLATES.get(self.model)
+        if template.concat_by_role:
             self.messages = self.concat_messages_by_role(messages)
-            self.cached_str = ""
-            for message in self.messages:
-                role = message["role"]
-                content = message["content"]
-                if role in self.inst_roles:
-                    self.cached_str = f"[INST] {content} [/INST]"
-                elif role in self.answer_roles:
-                    self.merged_str += f"<s> {self.cached_str} {content} </s>\n"
-                    self.cached_str = ""
-                else:
-                    self.cached_str = f"[INST] {content} [/INST]"
-            if self.cached_str:
-                self.merged_str += f"{self.cached_str}"
-        # https://huggingface.co/NousResearch/Nous-Hermes-2-Mixtral-8x7B-DPO#prompt-format
-        elif self.model in ["nous-mixtral-8x7b"]:
-            self.merged_str_list = []
-            for message in self.messages:
-                role = message["role"]
-                content = message["content"]
-                if role not in ["system", "user", "assistant"]:
-                    role = self.default_role
-                message_line = f"<|im_start|>{role}\n{content}<|im_end|>"
-                self.merged_str_list.append(message_line)
-            self.merged_str_list.append("<|im_start|>assistant")
-            self.merged_str = "\n".join(self.merged_str_list)
-        # https://huggingface.co/openchat/openchat-3.5-0106
-        elif self.model in ["openchat-3.5"]:
-            self.messages = self.concat_messages_by_role(messages)
-            self.merged_str_list = []
-            self.end_of_turn = "<|end_of_turn|>"
-            for message in self.messages:
-                role = message["role"]
-                content = message["content"]
-                if role in self.inst_roles:
-                    self.merged_str_list.append(
-                        f"GPT4 Correct User:\n{content}{self.end_of_turn}"
-                    )
-                elif role in self.answer_roles:
-                    self.merged_str_list.append(
-                        f"GPT4 Correct Assistant:\n{content}{self.end_of_turn}"
-                    )
-                else:
-                    self.merged_str_list.append(
-                        f"GPT4 Correct User: {content}{self.end_of_turn}"
-                    )
-            self.merged_str_list.append(f"GPT4 Correct Assistant:\n")
-            self.merged_str = "\n".join(self.merged_str_list)
-        # https://huggingface.co/google/gemma-1.1-7b-it#chat-template
-        elif self.model in ["gemma-7b"]:
-            self.messages = self.concat_messages_by_role(messages)
-            self.merged_str_list = []
-            self.end_of_turn = "<end_of_turn>"
-            self.start_of_turn = "<start_of_turn>"
-            for message in self.messages:
-                role = message["role"]
-                content = message["content"]
-                if role in self.inst_roles:
-                    self.merged_str_list.append(
-                        f"{self.start_of_turn}user\n{content}{self.end_of_turn}"
-                    )
-                elif role in self.answer_roles:
-                    self.merged_str_list.append(
-                        f"{self.start_of_turn}model\n{content}{self.end_of_turn}"
-                    )
-                else:
-                    self.merged_str_list.append(
-                        f"{self.start_of_turn}user\n{content}{self.end_of_turn}"
-                    )
-            self.merged_str_list.append(f"{self.start_of_turn}model\n")
-            self.merged_str = "<bos>" + "\n".join(self.merged_str_list)
-        # https://huggingface.co/NousResearch/Nous-Hermes-2-Mixtral-8x7B-DPO#prompt-format
-        # https://huggingface.co/openchat/openchat-3.5-0106
-        # https://huggingface.co/01-ai/Yi-1.5-34B-Chat
-        elif self.model in ["openchat-3.5", "command-r-plus", "gemma-7b", "yi-1.5-34b"]:
-            # https://discuss.huggingface.co/t/error-with-new-tokenizers-urgent/2847/5
-            tokenizer = AutoTokenizer.from_pretrained(
-                self.model_fullname, use_fast=False
-            )
-            self.merged_str = tokenizer.apply_chat_template(
-                messages, tokenize=False, add_generation_prompt=True
-            )
         else:
-            self.merged_str = "\n\n".join(
-                [f"{message['role']}: {message['content']}" for message in messages]
-            )
-
+            self.messages = messages
+        self.segments = PROMPT_TEMPLATES.render_segments(self.model, self.messages)
+        self.merged_str = "".join(self.segments)
         return self.merged_str
 
     def decompose_to_system_and_input_prompt(
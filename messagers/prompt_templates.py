@@ -0,0 +1,321 @@
+import hashlib
+import threading
+import time
+
+from collections import OrderedDict
+
+from jinja2.ext import loopcontrols
+from jinja2.sandbox import ImmutableSandboxedEnvironment
+from tclogger import logger
+
+from constants.envs import get_config
+from messagers.tokenizer_registry import TOKENIZER_REGISTRY
+
+# Templates for Chat Models
+# - https://huggingface.co/docs/transformers/main/en/chat_templating
+#   - https://huggingface.co/mistralai/Mixtral-8x7B-Instruct-v0.1#instruction-format
+#   - https://huggingface.co/NousResearch/Nous-Hermes-2-Mixtral-8x7B-DPO#prompt-format
+#   - https://huggingface.co/openchat/openchat-3.5-0106
+#   - https://huggingface.co/google/gemma-1.1-7b-it#chat-template
+
+# Built-in templates render one message at a time, with `is_first` / `is_last`,
+# so each rendered message is a segment that can be cached and tokenized alone
+
+# Mistral and Mixtral:
+#   <s> [INST] Instruction [/INST] Model answer </s> [INST] Follow-up instruction [/INST]
+MIXTRAL_TEMPLATE = {
+    "prefix": "",
+    "message": (
+        '{% if message.role == "answer" %}'
+        '{% if is_first %}<s> {% endif %} {{ message.content }} </s>{{ "\\n" }}'
+        "{% else %}"
+        "{% if not is_last %}<s> {% endif %}[INST] {{ message.content }} [/INST]"
+        "{% endif %}"
+    ),
+    "suffix": "",
+}
+
+# Nous Mixtral:
+#   <|im_start|>system
+#   You are "Hermes 2".<|im_end|>
+#   <|im_start|>user
+#   Hello, who are you?<|im_end|>
+#   <|im_start|>assistant
+NOUS_MIXTRAL_TEMPLATE = {
+    "prefix": "",
+    "message": (
+        '{% if message.role in ["system", "user", "assistant"] %}'
+        "{% set role = message.role %}"
+        "{% else %}"
+        '{% set role = "user" %}'
+        "{% endif %}"
+        '<|im_start|>{{ role }}{{ "\\n" }}{{ message.content }}<|im_end|>{{ "\\n" }}'
+    ),
+    "suffix": "<|im_start|>assistant",
+}
+
+# OpenChat:
+#   GPT4 Correct User: Hello<|end_of_turn|>GPT4 Correct Assistant: Hi<|end_of_turn|>GPT4 Correct User: How are you today?<|end_of_turn|>GPT4 Correct Assistant:
+OPENCHAT_TEMPLATE = {
+    "prefix": "",
+    "message": (
+        '{% if message.role == "answer" %}'
+        "GPT4 Correct Assistant:"
+        "{% else %}"
+        "GPT4 Correct User:"
+        "{% endif %}"
+        '{{ "\\n" }}{{ message.content }}<|end_of_turn|>{{ "\\n" }}'
+    ),
+    "suffix": "GPT4 Correct Assistant:\n",
+}
+
+# Google Gemma-it
+#   <start_of_turn>user
+#   How does the brain work?<end_of_turn>
+#   <start_of_turn>model
+GEMMA_TEMPLATE = {
+    "prefix": "<bos>",
+    "message": (
+        '{% if message.role == "answer" %}'
+        "<start_of_turn>model"
+        "{% else %}"
+        "<start_of_turn>user"
+        "{% endif %}"
+        '{{ "\\n" }}{{ message.content }}<end_of_turn>{{ "\\n" }}'
+    ),
+    "suffix": "<start_of_turn>model\n",
+}
+
+DEFAULT_TEMPLATE = {
+    "prefix": "",
+    "message": (
+        '{% if not is_first %}{{ "\\n\\n" }}{% endif %}'
+        "{{ message.role }}: {{ message.content }}"
+    ),
+    "suffix": "",
+}
+
+# models whose templates expect messages concatenated by role (`inst` / `answer`)
+BUILTIN_TEMPLATES = {
+    "mixtral-8x7b": (MIXTRAL_TEMPLATE, True),
+    "mistral-7b": (MIXTRAL_TEMPLATE, True),
+    "nous-mixtral-8x7b": (NOUS_MIXTRAL_TEMPLATE, False),
+    "openchat-3.5": (OPENCHAT_TEMPLATE, True),
+    "gemma-7b": (GEMMA_TEMPLATE, True),
+}
+
+# models using the chat template shipped with their tokenizer
+TOKENIZER_TEMPLATE_MODELS = ["command-r-plus", "yi-1.5-34b"]
+
+
+class PromptTemplate:
+    """
+    Chat template of a model.
+    * Built-in templates are segmented: prefix, one segment per message, suffix
+    * Tokenizer templates are rendered as a whole, as one segment
+    """
+
+    def __init__(
+        self,
+        template=None,
+        concat_by_role: bool = False,
+        variables: dict = None,
+        prefix: str = "",
+        message_template=None,
+        suffix: str = "",
+    ):
+        self.template = template
+        self.concat_by_role = concat_by_role
+        self.variables = variables or {}
+        self.prefix = prefix
+        self.message_template = message_template
+        self.suffix = suffix
+
+    @property
+    def is_segmented(self) -> bool:
+        return self.message_template is not None
+
+    def render_message(self, message: dict, is_first: bool, is_last: bool) -> str:
+        return self.message_template.render(
+            message=message, is_first=is_first, is_last=is_last
+        )
+
+    def render(self, messages: list[dict]) -> str:
+        if self.is_segmented:
+            last_idx = len(messages) - 1
+            segments = [
+                self.render_message(message, idx == 0, idx == last_idx)
+                for idx, message in enumerate(messages)
+            ]
+            return self.prefix + "".join(segments) + self.suffix
+        return self.template.render(
+            messages=messages, add_generation_prompt=True, **self.variables
+        )
+
+
+class PromptTemplateRegistry:
+    """
+    Compiled prompt templates, one per model.
+    * Built-in models use hand-written templates
+    * Others use the `chat_template` of their tokenizer, extracted once,
+      and rendered like `apply_chat_template(..., add_generation_prompt=True)`
+    * Rendered message segments are cached (LRU of `prompt_segment_cache_size`),
+      keyed by model, role, position flags and a hash of the content
+    """
+
+    def __init__(self):
+        # same environment as `transformers` uses for chat templates
+        self.env = ImmutableSandboxedEnvironment(
+            trim_blocks=True, lstrip_blocks=True, extensions=[loopcontrols]
+        )
+        self.env.globals["raise_exception"] = self.raise_exception
+        self.templates = {}
+        self.lock = threading.Lock()
+        self.compile_seconds = {}
+        self.segments = OrderedDict()
+        self.segments_lock = threading.Lock()
+        self.segment_hits = 0
+        self.segment_misses = 0
+
+    @staticmethod
+    def raise_exception(message):
+        raise ValueError(message)
+
+    def get_tokenizer_variables(self, tokenizer) -> dict:
+        special_tokens_map = getattr(tokenizer, "special_tokens_map", None) or {}
+        return {
+            key: value
+            for key, value in special_tokens_map.items()
+            if isinstance(value, str)
+        }
+
+    def compile_parts(self, parts: dict, concat_by_role: bool = False):
+        return PromptTemplate(
+            concat_by_role=concat_by_role,
+            prefix=parts["prefix"],
+            message_template=self.env.from_string(parts["message"]),
+            suffix=parts["suffix"],
+        )
+
+    def compile(self, model: str) -> PromptTemplate:
+        t1 = time.perf_counter()
+        if model in BUILTIN_TEMPLATES:
+            parts, concat_by_role = BUILTIN_TEMPLATES[model]
+            template = self.compile_parts(parts, concat_by_role)
+        elif model in TOKENIZER_TEMPLATE_MODELS:
+            tokenizer = TOKENIZER_REGISTRY.get(model)
+            source = getattr(tokenizer, "chat_template", None)
+            if isinstance(source, dict):
+                source = source.get("default")
+            if source:
+                template = PromptTemplate(
+                    self.env.from_string(source),
+                    variables=self.get_tokenizer_variables(tokenizer),
+                )
+            else:
+                logger.warn(f"No chat template in tokenizer of [{model}]")
+                template = self.compile_parts(DEFAULT_TEMPLATE)
+        else:
+            template = self.compile_parts(DEFAULT_TEMPLATE)
+        t2 = time.perf_counter()
+        self.compile_seconds[model] = round(t2 - t1, 4)
+        return template
+
+    def get(self, model: str) -> PromptTemplate:
+        template = self.templates.get(model)
+        if template is None:
+            with self.lock:
+                template = self.templates.get(model)
+                if template is None:
+                    template = self.compile(model)
+                    self.templates[model] = template
+        return template
+
+    def get_segment(self, key: tuple):
+        with self.segments_lock:
+            segment = self.segments.get(key)
+            if segment is None:
+                self.segment_misses += 1
+            else:
+                self.segments.move_to_end(key)
+                self.segment_hits += 1
+            return segment
+
+    def put_segment(self, key: tuple, segment: str):
+        max_size = get_config("prompt_segment_cache_size", 4096)
+        with self.segments_lock:
+            self.segments[key] = segment
+            while len(self.segments) > max_size:
+                self.segments.popitem(last=False)
+
+    def render_segments(self, model: str, messages: list[dict]) -> list[str]:
+        """
+        Returns the prompt as a list of segments, which join to `render()`.
+        """
+        template = self.get(model)
+        if not template.is_segmented:
+            return [template.render(messages)]
+
+        segments = [template.prefix]
+        last_idx = len(messages) - 1
+        for idx, message in enumerate(messages):
+            is_first, is_last = idx == 0, idx == last_idx
+            content_hash = hashlib.sha1(
+                str(message["content"]).encode("utf-8")
+            ).digest()
+            key = (model, message["role"], is_first, is_last, content_hash)
+            segment = self.get_segment(key)
+            if segment is None:
+                segment = template.render_message(message, is_first, is_last)
+                self.put_segment(key, segment)
+            segments.append(segment)
+        segments.append(template.suffix)
+        return segments
+
+    def stats(self) -> dict:
+        with self.segments_lock:
+            hits, misses = self.segment_hits, self.segment_misses
+            segments_count = len(self.segments)
+        total = hits + misses
+        return {
+            "compiled": sorted(self.templates.keys()),
+            "compile_seconds": dict(self.compile_seconds),
+            "segments": segments_count,
+            "segment_hits": hits,
+            "segment_misses": misses,
+            "segment_hit_rate": round(hits / total, 4) if total else 0.0,
+        }
+
+
+PROMPT_TEMPLATES = PromptTemplateRegistry()
+
+
+def benchmark(n: int = 20000, models: list[str] = None):
+    from constants.models import AVAILABLE_MODELS
+    from messagers.message_composer import MessageComposer
+
+    messages = [
+        {"role": "system", "content": "You are a helpful assistant."},
+        {"role": "user", "content": "Hello, who are you?"},
+        {"role": "assistant", "content": "I am a bot."},
+        {"role": "user", "content": "What is your name?"},
+    ]
+    if models is None:
+        models = [model for model in AVAILABLE_MODELS if model != "default"]
+    for model in models:
+        composer = MessageComposer(model)
+        try:
+            composer.merge(messages)
+        except Exception as e:
+            logger.warn(f"[{model}] skipped: {e}")
+            continue
+        t1 = time.perf_counter()
+        for _ in range(n):
+            composer.merge(messages)
+        t2 = time.perf_counter()
+        print(f"{model:<20}: {n / (t2 - t1):>12,.0f} merges/sec")
+
+
+if __name__ == "__main__":
+    benchmark()
+    # python -m messagers.prompt_templates
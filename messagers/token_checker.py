@@ -1,12 +1,105 @@
+import hashlib
+import threading
+
+from collections import OrderedDict
+
 from tclogger import logger
-from transformers import AutoTokenizer
 
+from constants.envs import get_config
 from constants.models import MODEL_MAP, TOKEN_LIMIT_MAP, TOKEN_RESERVED
+from messagers.tokenizer_registry import TOKENIZER_REGISTRY
+
+
+class TokenCountCache:
+    """
+    Token counts of prompt segments, so resent history is not re-tokenized.
+    * Keyed by tokenizer name and a hash of the segment text,
+      LRU bounded by `token_count_cache_size`
+    * Segments are counted without special tokens, which are counted once per prompt.
+      Tokens cannot merge across segment boundaries, so the sum may slightly
+      over-count, which only makes `max_new_tokens` more conservative
+    """
+
+    def __init__(self):
+        self.counts = OrderedDict()
+        self.special_counts = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def count_special_tokens(self, name: str, tokenizer) -> int:
+        if name not in self.special_counts:
+            self.special_counts[name] = len(
+                tokenizer.encode("", add_special_tokens=True)
+            )
+        return self.special_counts[name]
+
+    def get_key(self, name: str, segment: str) -> tuple:
+        return (name, hashlib.sha1(segment.encode("utf-8")).digest())
+
+    def lookup(self, name: str, segment: str):
+        key = self.get_key(name, segment)
+        with self.lock:
+            count = self.counts.get(key)
+            if count is None:
+                self.misses += 1
+            else:
+                self.counts.move_to_end(key)
+                self.hits += 1
+            return count
+
+    def store(self, name: str, segment: str, count: int):
+        key = self.get_key(name, segment)
+        max_size = get_config("token_count_cache_size", 4096)
+        with self.lock:
+            self.counts[key] = count
+            while len(self.counts) > max_size:
+                self.counts.popitem(last=False)
+
+    def count_segment(self, name: str, tokenizer, segment: str) -> int:
+        if not segment:
+            return 0
+        count = self.lookup(name, segment)
+        if count is None:
+            count = len(tokenizer.encode(segment, add_special_tokens=False))
+            self.store(name, segment, count)
+        return count
+
+    def count(self, name: str, tokenizer, segments: list[str]) -> int:
+        return self.count_special_tokens(name, tokenizer) + sum(
+            self.count_segment(name, tokenizer, segment) for segment in segments
+        )
+
+    def stats(self) -> dict:
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self.counts),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            }
+
+
+TOKEN_COUNT_CACHE = TokenCountCache()
+
+
+def encode_batch_lengths(tokenizer, texts: list[str]) -> list[int]:
+    # one batch call, which fast (Rust) tokenizers run in parallel without the GIL
+    if hasattr(tokenizer, "encode_batch"):
+        # tiktoken
+        return [len(tokens) for tokens in tokenizer.encode_batch(texts)]
+    if callable(tokenizer):
+        input_ids = tokenizer(texts, add_special_tokens=False)["input_ids"]
+        return [len(ids) for ids in input_ids]
+    return [len(tokenizer.encode(text, add_special_tokens=False)) for text in texts]
 
 
 class TokenChecker:
-    def __init__(self, input_str: str, model: str):
+    def __init__(self, input_str: str, model: str, segments: list[str] = None):
         self.input_str = input_str
+        # segments join to `input_str`, see `MessageComposer.merge()`
+        self.segments = segments if segments is not None else [input_str]
 
         if model in MODEL_MAP.keys():
             self.model = model
@@ -14,23 +107,17 @@ class TokenChecker:
             self.model = "nous-mixtral-8x7b"
 
         self.model_fullname = MODEL_MAP[self.model]
-
-        # As some models are gated, we need to fetch tokenizers from alternatives
-        GATED_MODEL_MAP = {
-            "llama3-70b": "NousResearch/Meta-Llama-3-70B",
-            "gemma-7b": "unsloth/gemma-7b",
-            "mistral-7b": "dfurman/Mistral-7B-Instruct-v0.2",
-            "mixtral-8x7b": "dfurman/Mixtral-8x7B-Instruct-v0.1",
-        }
-        if self.model in GATED_MODEL_MAP.keys():
-            self.tokenizer = AutoTokenizer.from_pretrained(GATED_MODEL_MAP[self.model])
-        else:
-            self.tokenizer = AutoTokenizer.from_pretrained(self.model_fullname)
+        self.tokenizer_name = TOKENIZER_REGISTRY.get_tokenizer_name(self.model)
+        self.tokenizer = TOKENIZER_REGISTRY.get(self.model)
+        self.token_count = None
 
     def count_tokens(self):
-        token_count = len(self.tokenizer.encode(self.input_str))
-        logger.note(f"Prompt Token Count: {token_count}")
-        return token_count
+        if self.token_count is None:
+            self.token_count = TOKEN_COUNT_CACHE.count(
+                self.tokenizer_name, self.tokenizer, self.segments
+            )
+            logger.note(f"Prompt Token Count: {self.token_count}")
+        return self.token_count
 
     def get_token_limit(self):
         return TOKEN_LIMIT_MAP[self.model]
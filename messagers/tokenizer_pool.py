@@ -0,0 +1,218 @@
+import asyncio
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import status
+from tclogger import logger
+
+from constants.envs import get_config
+from messagers.token_checker import TOKEN_COUNT_CACHE, encode_batch_lengths
+from messagers.tokenizer_registry import TOKENIZER_REGISTRY
+from metrics.chat_metrics import (
+    TOKENIZER_POOL_EXEC_SECONDS,
+    TOKENIZER_POOL_WAIT_SECONDS,
+)
+from networks.exceptions import HfApiException
+
+# (model, backend, phase) of jobs with no request, e.g. prewarming
+UNKNOWN_LABELS = ("unknown", "unknown", "other")
+
+TOKENIZER_POOL_BUSY_ERROR = HfApiException(
+    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+    detail="Tokenizer pool is busy",
+)
+
+
+class TokenizerPool:
+    """
+    Bounded worker pool for CPU-bound prompt work: composition and tokenization.
+    * `tokenizer_pool_workers` threads, HF tokenizers and tiktoken release the GIL
+      while encoding, so they do not stall the event loop and SSE streaming
+    * Token counts requested within `tokenizer_pool_batch_ms` are encoded
+      with one batch call per tokenizer and model
+    * Wait and run times are observed by `(model, backend, phase)` labels,
+      where the phase is `compose` or `tokenize`
+    * At most `tokenizer_pool_max_queue` jobs wait, further jobs are rejected with 503
+    """
+
+    def __init__(self):
+        self.executor = None
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.rejected = 0
+        self.batches = {}
+        self.batch_handles = {}
+        self.batch_tasks = set()
+        self.batched_calls = 0
+        self.batch_jobs = 0
+
+    def get_executor(self) -> ThreadPoolExecutor:
+        if self.executor is None:
+            with self.lock:
+                if self.executor is None:
+                    workers = get_config("tokenizer_pool_workers", 2)
+                    self.executor = ThreadPoolExecutor(
+                        max_workers=workers, thread_name_prefix="tokenizer"
+                    )
+        return self.executor
+
+    def timed(self, func, submitted_at: float, labels: tuple, *args, **kwargs):
+        started_at = time.perf_counter()
+        with self.lock:
+            self.queued -= 1
+            self.running += 1
+        TOKENIZER_POOL_WAIT_SECONDS.labels(*labels).observe(started_at - submitted_at)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            TOKENIZER_POOL_EXEC_SECONDS.labels(*labels).observe(
+                time.perf_counter() - started_at
+            )
+            with self.lock:
+                self.running -= 1
+
+    async def run(self, func, *args, labels: tuple = UNKNOWN_LABELS, **kwargs):
+        """
+        Run `func(*args, **kwargs)` in the pool,
+        `labels` are the `(model, backend, phase)` of its timings.
+        """
+        max_queue = get_config("tokenizer_pool_max_queue", 64)
+        with self.lock:
+            if self.queued >= max_queue:
+                self.rejected += 1
+                raise TOKENIZER_POOL_BUSY_ERROR
+            self.queued += 1
+        loop = asyncio.get_running_loop()
+        submitted_at = time.perf_counter()
+        try:
+            future = self.get_executor().submit(
+                self.timed, func, submitted_at, labels, *args, **kwargs
+            )
+        except BaseException:
+            with self.lock:
+                self.queued -= 1
+            raise
+        # jobs cancelled before they start (deadlines, disconnects) never run `timed()`
+        future.add_done_callback(self.on_cancelled)
+        return await asyncio.wrap_future(future, loop=loop)
+
+    def on_cancelled(self, future):
+        if future.cancelled():
+            with self.lock:
+                self.queued -= 1
+
+    async def encode_lengths(
+        self, name: str, tokenizer, texts: list[str], labels: tuple = UNKNOWN_LABELS
+    ):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        key = (name, labels)
+        batch = self.batches.setdefault(key, (tokenizer, labels, []))
+        batch[2].append((texts, future))
+        self.batched_calls += 1
+
+        max_batch = get_config("tokenizer_pool_max_batch", 64)
+        if sum(len(item[0]) for item in batch[2]) >= max_batch:
+            self.flush(key)
+        elif key not in self.batch_handles:
+            batch_seconds = get_config("tokenizer_pool_batch_ms", 2) / 1000
+            self.batch_handles[key] = loop.call_later(batch_seconds, self.flush, key)
+        return await future
+
+    def flush(self, key: tuple):
+        handle = self.batch_handles.pop(key, None)
+        if handle:
+            handle.cancel()
+        batch = self.batches.pop(key, None)
+        if batch:
+            task = asyncio.create_task(self.encode_batch(*batch))
+            self.batch_tasks.add(task)
+            task.add_done_callback(self.batch_tasks.discard)
+
+    async def encode_batch(self, tokenizer, labels: tuple, items: list):
+        # waiters cancelled before the flush are not encoded
+        items = [item for item in items if not item[1].done()]
+        if not items:
+            return
+        texts = [text for item_texts, _ in items for text in item_texts]
+        self.batch_jobs += 1
+        try:
+            lengths = await self.run(
+                encode_batch_lengths, tokenizer, texts, labels=labels
+            )
+        except BaseException as e:
+            for _, future in items:
+                if not future.done():
+                    future.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+            return
+        offset = 0
+        for item_texts, future in items:
+            if not future.done():
+                future.set_result(lengths[offset : offset + len(item_texts)])
+            offset += len(item_texts)
+
+    async def count_tokens(
+        self, model: str, segments: list[str], backend: str = "huggingface"
+    ) -> int:
+        """
+        Async counterpart of `TokenChecker.count_tokens()`, with cached segments.
+        """
+        labels = (model, backend, "tokenize")
+        name = TOKENIZER_REGISTRY.get_tokenizer_name(model)
+        tokenizer = TOKENIZER_REGISTRY.tokenizers.get(name)
+        if tokenizer is None:
+            tokenizer = await self.run(TOKENIZER_REGISTRY.get, model, labels=labels)
+        if name not in TOKEN_COUNT_CACHE.special_counts:
+            await self.run(
+                TOKEN_COUNT_CACHE.count_special_tokens, name, tokenizer, labels=labels
+            )
+        token_count = TOKEN_COUNT_CACHE.special_counts[name]
+
+        missing = []
+        for segment in segments:
+            if not segment:
+                continue
+            count = TOKEN_COUNT_CACHE.lookup(name, segment)
+            if count is None:
+                missing.append(segment)
+            else:
+                token_count += count
+        if missing:
+            missing = list(dict.fromkeys(missing))
+            lengths = await self.encode_lengths(name, tokenizer, missing, labels)
+            counts = dict(zip(missing, lengths))
+            for segment, count in counts.items():
+                TOKEN_COUNT_CACHE.store(name, segment, count)
+            token_count += sum(
+                counts[segment] for segment in segments if segment in counts
+            )
+        logger.note(f"Prompt Token Count: {token_count}")
+        return token_count
+
+    def stats(self) -> dict:
+        with self.lock:
+            queued, running, rejected = self.queued, self.running, self.rejected
+        return {
+            "workers": get_config("tokenizer_pool_workers", 2),
+            "queued": queued,
+            "running": running,
+            "rejected": rejected,
+            "batched_calls": self.batched_calls,
+            "batch_jobs": self.batch_jobs,
+            "wait_seconds": self.get_snapshots(TOKENIZER_POOL_WAIT_SECONDS),
+            "exec_seconds": self.get_snapshots(TOKENIZER_POOL_EXEC_SECONDS),
+        }
+
+    def get_snapshots(self, histogram) -> dict:
+        # keyed by "model/backend/phase"
+        return {
+            "/".join(labels): child.snapshot() for labels, child in histogram.items()
+        }
+
+
+TOKENIZER_POOL = TokenizerPool()
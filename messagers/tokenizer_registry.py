@@ -0,0 +1,90 @@
+import threading
+import time
+
+from tclogger import logger
+
+from constants.models import GATED_MODEL_MAP, MODEL_MAP
+
+
+class TokenizerRegistry:
+    """
+    Process-wide cache of tokenizers, so each one is loaded only once.
+    * Keyed by tokenizer repo name, so models sharing a tokenizer share the instance
+    * Loading is guarded by a per-name lock, concurrent misses wait for one load
+    """
+
+    def __init__(self):
+        self.tokenizers = {}
+        self.lock = threading.Lock()
+        self.name_locks = {}
+        self.hits = 0
+        self.misses = 0
+        self.load_seconds = {}
+
+    def get_tokenizer_name(self, model: str) -> str:
+        if model in GATED_MODEL_MAP.keys():
+            return GATED_MODEL_MAP[model]
+        if model in MODEL_MAP.keys():
+            return MODEL_MAP[model]
+        return MODEL_MAP["default"]
+
+    def get_name_lock(self, name: str) -> threading.Lock:
+        with self.lock:
+            if name not in self.name_locks:
+                self.name_locks[name] = threading.Lock()
+            return self.name_locks[name]
+
+    def load(self, name: str):
+        # transformers takes seconds to import, so it is loaded on first use
+        from transformers import AutoTokenizer
+
+        t1 = time.perf_counter()
+        tokenizer = AutoTokenizer.from_pretrained(name)
+        t2 = time.perf_counter()
+        self.load_seconds[name] = round(t2 - t1, 4)
+        logger.note(f"> Loaded tokenizer: [{name}] ({t2 - t1:.2f}s)")
+        return tokenizer
+
+    def get(self, model: str):
+        name = self.get_tokenizer_name(model)
+        tokenizer = self.tokenizers.get(name)
+        if tokenizer is not None:
+            with self.lock:
+                self.hits += 1
+            return tokenizer
+
+        with self.get_name_lock(name):
+            tokenizer = self.tokenizers.get(name)
+            if tokenizer is None:
+                tokenizer = self.load(name)
+                self.tokenizers[name] = tokenizer
+                with self.lock:
+                    self.misses += 1
+            else:
+                with self.lock:
+                    self.hits += 1
+        return tokenizer
+
+    def prewarm(self, models: list[str] = None):
+        if models is None:
+            models = [model for model in MODEL_MAP.keys() if model != "default"]
+        for model in models:
+            try:
+                self.get(model)
+            except Exception as e:
+                logger.warn(f"Failed to prewarm tokenizer of [{model}]: {e}")
+
+    def stats(self) -> dict:
+        with self.lock:
+            hits, misses = self.hits, self.misses
+        total = hits + misses
+        return {
+            "loaded": sorted(self.tokenizers.keys()),
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": round(hits / total, 4) if total else 0.0,
+            "load_seconds": dict(self.load_seconds),
+        }
+
+
+TOKENIZER_REGISTRY = TokenizerRegistry()
@@ -0,0 +1,124 @@
+import asyncio
+import time
+
+from metrics.collectors import Counter, Gauge, Histogram
+
+LABELS = ("model", "backend")
+
+REQUESTS_TOTAL = Counter(
+    "hf_llm_api_requests_total",
+    "Chat completion requests",
+    LABELS + ("stream",),
+)
+REQUEST_ERRORS_TOTAL = Counter(
+    "hf_llm_api_request_errors_total",
+    "Chat completion requests failed with an HTTP error",
+    LABELS + ("status_code",),
+)
+REQUEST_DURATION_SECONDS = Histogram(
+    "hf_llm_api_request_duration_seconds",
+    "Duration of chat completion requests, until the end of the stream",
+    LABELS + ("stream",),
+)
+TIME_TO_FIRST_TOKEN_SECONDS = Histogram(
+    "hf_llm_api_time_to_first_token_seconds",
+    "Time from request to the first streamed chunk",
+    LABELS,
+)
+INTER_TOKEN_LATENCY_SECONDS = Histogram(
+    "hf_llm_api_inter_token_latency_seconds",
+    "Time between consecutive streamed chunks",
+    LABELS,
+    buckets=[0.001, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5],
+)
+OUTPUT_CHUNKS_TOTAL = Counter(
+    "hf_llm_api_output_chunks_total",
+    "Streamed chunks",
+    LABELS,
+)
+OUTPUT_CHUNKS_PER_SECOND = Histogram(
+    "hf_llm_api_output_chunks_per_second",
+    "Streamed chunks per second of each stream, after the first chunk",
+    LABELS,
+    buckets=[1, 2, 5, 10, 20, 50, 100, 200, 500, 1000],
+)
+STREAMS_IN_FLIGHT = Gauge(
+    "hf_llm_api_streams_in_flight",
+    "Streams being sent to clients",
+    LABELS,
+)
+STREAMS_ABORTED_TOTAL = Counter(
+    "hf_llm_api_streams_aborted_total",
+    "Streams closed before the end, mostly by client disconnects",
+    LABELS,
+)
+DEADLINES_EXCEEDED_TOTAL = Counter(
+    "hf_llm_api_deadlines_exceeded_total",
+    "Requests and streams ended by deadlines or upstream timeouts",
+    LABELS + ("phase",),
+)
+HEDGED_REQUESTS_TOTAL = Counter(
+    "hf_llm_api_hedged_requests_total",
+    "Hedged upstream requests, by whether the hedge or the primary won",
+    LABELS + ("result",),
+)
+UPSTREAM_RESPONSES_TOTAL = Counter(
+    "hf_llm_api_upstream_responses_total",
+    "Upstream responses by status code",
+    LABELS + ("status_code",),
+)
+PROMPT_TOKENS = Histogram(
+    "hf_llm_api_prompt_tokens",
+    "Prompt token counts",
+    LABELS,
+    buckets=[64, 256, 1024, 2048, 4096, 8192, 16384, 32768],
+)
+TOKENIZER_POOL_WAIT_SECONDS = Histogram(
+    "hf_llm_api_tokenizer_pool_wait_seconds",
+    "Time jobs wait in the tokenizer pool queue, by phase: compose or tokenize",
+    LABELS + ("phase",),
+)
+TOKENIZER_POOL_EXEC_SECONDS = Histogram(
+    "hf_llm_api_tokenizer_pool_exec_seconds",
+    "Time to run jobs of the tokenizer pool, by phase: compose or tokenize",
+    LABELS + ("phase",),
+)
+
+
+async def track_stream(generator, model: str, backend: str, started_at: float):
+    """
+    Wrap a chunk generator of a response, to observe TTFT, inter-token latency,
+    duration, chunk rate, in-flight and aborted streams.
+    """
+    labels = (model, backend)
+    ttft = TIME_TO_FIRST_TOKEN_SECONDS.labels(*labels)
+    itl = INTER_TOKEN_LATENCY_SECONDS.labels(*labels)
+    chunks_total = OUTPUT_CHUNKS_TOTAL.labels(*labels)
+    in_flight = STREAMS_IN_FLIGHT.labels(*labels)
+
+    chunk_count = 0
+    first_at = last_at = None
+    in_flight.inc()
+    try:
+        async for chunk in generator:
+            now = time.perf_counter()
+            if first_at is None:
+                first_at = now
+                ttft.observe(now - started_at)
+            else:
+                itl.observe(now - last_at)
+            last_at = now
+            chunk_count += 1
+            yield chunk
+    except (asyncio.CancelledError, GeneratorExit):
+        STREAMS_ABORTED_TOTAL.labels(*labels).inc()
+        raise
+    finally:
+        in_flight.dec()
+        chunks_total.inc(chunk_count)
+        ended_at = time.perf_counter()
+        REQUEST_DURATION_SECONDS.labels(*labels, "true").observe(ended_at - started_at)
+        if chunk_count > 1 and last_at > first_at:
+            OUTPUT_CHUNKS_PER_SECOND.labels(*labels).observe(
+                (chunk_count - 1) / (last_at - first_at)
+            )
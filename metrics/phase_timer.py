@@ -0,0 +1,45 @@
+import time
+
+
+class PhaseTimer:
+    """
+    Sequential phase durations of a request, for the `Server-Timing` header.
+    * https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Server-Timing
+    * `mark(name)` records the time since the previous mark as phase `name`
+    * `trace()` is an httpx trace extension, marking `connect`, `tls` and `first_byte`
+    """
+
+    TRACE_PHASES = {
+        "connection.connect_tcp.complete": "connect",
+        "connection.start_tls.complete": "tls",
+        "http11.receive_response_headers.complete": "first_byte",
+        "http2.receive_response_headers.complete": "first_byte",
+    }
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.last_at = self.started_at
+        self.phases = {}
+
+    def mark(self, name: str):
+        now = time.perf_counter()
+        self.phases[name] = self.phases.get(name, 0.0) + now - self.last_at
+        self.last_at = now
+
+    async def trace(self, event_name: str, info: dict):
+        name = self.TRACE_PHASES.get(event_name)
+        if name:
+            self.mark(name)
+
+    def total(self) -> float:
+        return self.last_at - self.started_at
+
+    def to_header(self) -> str:
+        metrics = [
+            f"{name};dur={seconds * 1000:.2f}" for name, seconds in self.phases.items()
+        ]
+        metrics.append(f"total;dur={self.total() * 1000:.2f}")
+        return ", ".join(metrics)
+
+    def to_sse_comment(self) -> bytes:
+        return f": server-timing {self.to_header()}\r\n\r\n".encode("utf-8")
@@ -0,0 +1,188 @@
+import json
+import os
+import threading
+import time
+
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:
+    # no file locks on Windows, where workers share no log file
+    fcntl = None
+
+from tclogger import logger
+
+from constants.envs import get_config
+
+REQUEST_LOG_PATH = Path(__file__).parents[1] / "logs" / "requests.jsonl"
+
+
+class RequestLogWriter:
+    """
+    Structured per-request log, written as JSONL by a background thread.
+    * Enabled by `request_log`, written to `request_log_path`,
+      which defaults to `logs/requests.jsonl` of the repo
+    * `log(record)` only appends to an in-memory queue, so request handlers never
+      wait on disk; records beyond `request_log_max_queue` are dropped and counted
+    * The writer flushes every `request_log_flush_interval` seconds,
+      or once `request_log_batch_size` records are queued
+    * Files are rotated at `request_log_max_bytes`,
+      keeping `request_log_backups` files: `requests.jsonl.1`, `requests.jsonl.2`, ...
+    * Writes and rotations hold the writer lock, and a lock file shared by
+      worker processes, so racing rotations never overwrite a backup
+    """
+
+    def __init__(self):
+        self.queue = deque()
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.is_closed = False
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+        self.rotations = 0
+        self.errors = 0
+
+    def get_path(self) -> Path:
+        return Path(get_config("request_log_path", str(REQUEST_LOG_PATH)))
+
+    def is_enabled(self) -> bool:
+        return get_config("request_log", False) and not self.is_closed
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.run, name="request-log", daemon=True
+                )
+                self.thread.start()
+
+    def log(self, record: dict):
+        if not self.is_enabled():
+            return
+        if self.thread is None:
+            self.start()
+        max_queue = get_config("request_log_max_queue", 10000)
+        with self.lock:
+            if len(self.queue) >= max_queue:
+                self.dropped += 1
+                return
+            self.queue.append(record)
+            queued = len(self.queue)
+        if queued >= get_config("request_log_batch_size", 256):
+            self.wakeup.set()
+
+    def pop_batch(self) -> list[dict]:
+        with self.lock:
+            batch = list(self.queue)
+            self.queue.clear()
+        return batch
+
+    def rotate(self, path: Path):
+        backups = get_config("request_log_backups", 5)
+        try:
+            if backups <= 0:
+                path.unlink()
+            else:
+                for idx in range(backups - 1, 0, -1):
+                    src = path.with_name(f"{path.name}.{idx}")
+                    if src.exists():
+                        os.replace(src, path.with_name(f"{path.name}.{idx + 1}"))
+                os.replace(path, path.with_name(f"{path.name}.1"))
+        except FileNotFoundError:
+            # removed meanwhile by something else than a worker, e.g. by hand
+            return
+        self.rotations += 1
+
+    @contextmanager
+    def lock_file(self, path: Path):
+        if fcntl is None:
+            yield
+            return
+        with open(path.with_name(f"{path.name}.lock"), "ab") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def write_batch(self, batch: list[dict]):
+        lines = "".join(
+            json.dumps(record, ensure_ascii=False, default=str) + "\n"
+            for record in batch
+        ).encode("utf-8")
+        path = self.get_path()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        max_bytes = get_config("request_log_max_bytes", 50 * 1024 * 1024)
+        with self.write_lock, self.lock_file(path):
+            # the size is checked under the locks, after any other rotation
+            if path.exists() and path.stat().st_size + len(lines) > max_bytes:
+                self.rotate(path)
+            # one unbuffered append per batch, so lines of workers do not interleave
+            with open(path, "ab", buffering=0) as wf:
+                wf.write(lines)
+        self.written += len(batch)
+        self.batches += 1
+
+    def flush(self):
+        batch = self.pop_batch()
+        if not batch:
+            return
+        try:
+            self.write_batch(batch)
+        except Exception as e:
+            self.errors += 1
+            self.dropped += len(batch)
+            logger.warn(f"× Request log write failed: {e}")
+
+    def run(self):
+        while not self.is_closed:
+            self.wakeup.wait(get_config("request_log_flush_interval", 1.0))
+            self.wakeup.clear()
+            self.flush()
+
+    def close(self):
+        self.is_closed = True
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+        self.flush()
+
+    def stats(self) -> dict:
+        with self.lock:
+            queued = len(self.queue)
+        return {
+            "enabled": self.is_enabled(),
+            "path": str(self.get_path()),
+            "queued": queued,
+            "written": self.written,
+            "dropped": self.dropped,
+            "batches": self.batches,
+            "rotations": self.rotations,
+            "errors": self.errors,
+        }
+
+
+REQUEST_LOG = RequestLogWriter()
+
+
+def benchmark(n: int = 10000):
+    # cost on the request path: one queue append per request
+    writer = RequestLogWriter()
+    writer.start = lambda: None
+    record = {"model": "nous-mixtral-8x7b", "backend": "huggingface", "status": 200}
+    t1 = time.perf_counter()
+    for _ in range(n):
+        writer.log(record)
+    t2 = time.perf_counter()
+    print(f"log() cost: {(t2 - t1) / n * 1e9:.0f} ns")
+
+
+if __name__ == "__main__":
+    benchmark()
+    # python -m metrics.request_log
@@ -0,0 +1,169 @@
+import asyncio
+import httpx
+import requests
+import threading
+import time
+
+from requests.adapters import HTTPAdapter
+from tclogger import logger
+
+from constants.envs import PROXIES, get_config
+
+
+class AsyncClientPool:
+    """
+    Long-lived pooled `httpx.AsyncClient`, one per upstream host.
+    * Connections are kept alive and reused across requests
+    * Clients are created lazily, and closed on app shutdown
+    """
+
+    def __init__(self):
+        self.clients = {}
+
+    def create_client(self) -> httpx.AsyncClient:
+        limits = httpx.Limits(
+            max_connections=get_config("async_http_max_connections", 1000),
+            max_keepalive_connections=get_config("http_pool_maxsize", 100),
+            keepalive_expiry=get_config("http_pool_idle_timeout", 60),
+        )
+        timeout = httpx.Timeout(connect=10, read=None, write=None, pool=None)
+        proxy = PROXIES["https"] if PROXIES else None
+        return httpx.AsyncClient(limits=limits, timeout=timeout, proxy=proxy)
+
+    def get(self, url: str) -> httpx.AsyncClient:
+        host = httpx.URL(url).host
+        if host not in self.clients:
+            self.clients[host] = self.create_client()
+        return self.clients[host]
+
+    async def preconnect(self, url: str, count: int = 1):
+        # open `count` concurrent connections, which stay alive in the pool
+        client = self.get(url)
+        results = await asyncio.gather(
+            *[client.head(url) for _ in range(count)], return_exceptions=True
+        )
+        errors = [r for r in results if isinstance(r, Exception)]
+        if errors:
+            logger.warn(f"Failed to preconnect [{url}]: {errors[0]}")
+
+    def stats(self) -> dict:
+        stats = {}
+        for host, client in self.clients.items():
+            # httpx does not expose pool state publicly, read it from httpcore
+            pool = getattr(getattr(client, "_transport", None), "_pool", None)
+            connections = getattr(pool, "connections", [])
+            idle = sum(1 for conn in connections if conn.is_idle())
+            stats[host] = {
+                "connections": len(connections),
+                "idle": idle,
+                "in_use": len(connections) - idle,
+            }
+        return stats
+
+    async def aclose(self):
+        for host, client in self.clients.items():
+            try:
+                await client.aclose()
+            except Exception as e:
+                logger.warn(f"Failed to close client of [{host}]: {e}")
+        self.clients = {}
+
+
+class SessionPool:
+    """
+    Keep-alive `requests.Session`, one per upstream host.
+    * Sessions are dropped and recreated after `http_pool_idle_timeout` seconds idle,
+      so stale connections are not reused
+    """
+
+    def __init__(self):
+        self.sessions = {}
+        self.last_used = {}
+        self.lock = threading.Lock()
+
+    def create_session(self) -> requests.Session:
+        pool_maxsize = get_config("http_pool_maxsize", 100)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        if PROXIES:
+            session.proxies.update(PROXIES)
+        return session
+
+    def get(self, url: str) -> requests.Session:
+        host = httpx.URL(url).host
+        idle_timeout = get_config("http_pool_idle_timeout", 60)
+        now = time.time()
+        with self.lock:
+            session = self.sessions.get(host)
+            if session and now - self.last_used[host] > idle_timeout:
+                # not closed here, as a long stream might still be using it
+                session = None
+            if session is None:
+                session = self.create_session()
+                self.sessions[host] = session
+            self.last_used[host] = now
+        return session
+
+    def preconnect(self, url: str, count: int = 1):
+        session = self.get(url)
+        threads = [
+            threading.Thread(target=self.head, args=(session, url))
+            for _ in range(count)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def head(self, session: requests.Session, url: str):
+        try:
+            session.head(url, timeout=10)
+        except Exception as e:
+            logger.warn(f"Failed to preconnect [{url}]: {e}")
+
+    def stats(self) -> dict:
+        stats = {}
+        with self.lock:
+            sessions = list(self.sessions.items())
+        for host, session in sessions:
+            idle, in_use = 0, 0
+            for adapter in set(session.adapters.values()):
+                for key in adapter.poolmanager.pools.keys():
+                    pool = adapter.poolmanager.pools[key]
+                    # urllib3 pre-fills the queue with None placeholders
+                    idle += sum(1 for conn in pool.pool.queue if conn is not None)
+                    in_use += pool.pool.maxsize - pool.pool.qsize()
+            stats[host] = {
+                "connections": idle + in_use,
+                "idle": idle,
+                "in_use": in_use,
+            }
+        return stats
+
+    def close(self):
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions = {}
+            self.last_used = {}
+
+
+ASYNC_CLIENT_POOL = AsyncClientPool()
+SESSION_POOL = SessionPool()
+
+
+async def preconnect_pools():
+    urls = get_config("http_preconnect_urls", ["https://api-inference.huggingface.co"])
+    count = get_config("http_preconnect_count", 2)
+    for url in urls:
+        await ASYNC_CLIENT_POOL.preconnect(url, count=count)
+        await asyncio.to_thread(SESSION_POOL.preconnect, url, count)
+
+
+def get_pools_stats() -> dict:
+    return {
+        "async": ASYNC_CLIENT_POOL.stats(),
+        "sync": SESSION_POOL.stats(),
+    }
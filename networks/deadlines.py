@@ -0,0 +1,107 @@
+import asyncio
+import httpx
+import requests
+import sys
+import time
+import urllib3
+
+from typing import Union
+
+from constants.envs import get_config
+from networks.exceptions import DeadlineExceeded
+
+# a zero timeout means "no timeout" to curl
+MIN_TIMEOUT = 0.01
+
+
+class Deadline:
+    """
+    Time budget of one request, shared by composition, token checks and upstream calls.
+    * `total` seconds from the `X-Request-Timeout` header, or `request_timeout`
+      (0 for none), at most `request_timeout_max`
+    * Upstream calls wait at most `upstream_connect_timeout` to connect,
+      `upstream_first_byte_timeout` for the first chunk
+      and `upstream_idle_timeout` between chunks, all capped by the time left
+    """
+
+    def __init__(self, total: float = None):
+        if total is None:
+            total = get_config("request_timeout", 0.0)
+        max_total = get_config("request_timeout_max", 600.0)
+        if max_total > 0 and total > max_total:
+            total = max_total
+        self.total = total
+        self.started_at = time.perf_counter()
+        self.expires_at = self.started_at + total if total > 0 else None
+        self.connect_timeout = get_config("upstream_connect_timeout", 10.0)
+        self.first_byte_timeout = get_config("upstream_first_byte_timeout", 60.0)
+        self.idle_timeout = get_config("upstream_idle_timeout", 30.0)
+
+    def remaining(self) -> Union[float, None]:
+        if self.expires_at is None:
+            return None
+        return max(self.expires_at - time.perf_counter(), 0.0)
+
+    def is_expired(self) -> bool:
+        return self.remaining() == 0.0
+
+    def cap(self, timeout: float) -> float:
+        remaining = self.remaining()
+        if remaining is not None:
+            timeout = min(timeout, remaining)
+        return max(timeout, MIN_TIMEOUT)
+
+    def check(self, phase: str):
+        if self.is_expired():
+            raise DeadlineExceeded(phase)
+
+    def upstream_timeout(self) -> tuple[float, float]:
+        # `(connect, read)` of requests and curl_cffi, read also bounds the first byte
+        return (self.cap(self.connect_timeout), self.cap(self.first_byte_timeout))
+
+    def httpx_timeout(self) -> httpx.Timeout:
+        connect = self.cap(self.connect_timeout)
+        return httpx.Timeout(
+            connect=connect,
+            read=self.cap(self.first_byte_timeout),
+            write=connect,
+            pool=connect,
+        )
+
+    async def wait_for(self, awaitable, phase: str, timeout: float = None):
+        """
+        Await within the time left, and `timeout` if given,
+        raises `DeadlineExceeded(phase)` on timeout.
+        """
+        remaining = self.remaining()
+        if timeout is not None:
+            remaining = timeout if remaining is None else min(timeout, remaining)
+        try:
+            return await asyncio.wait_for(awaitable, remaining)
+        except asyncio.TimeoutError:
+            raise DeadlineExceeded(phase)
+
+
+def is_timeout_error(e: BaseException) -> bool:
+    """
+    Timeouts of asyncio, httpx, requests and curl_cffi, also when wrapped:
+    requests re-raises read timeouts of streams as `ConnectionError`.
+    """
+    timeout_types = [
+        TimeoutError,
+        httpx.TimeoutException,
+        requests.Timeout,
+        urllib3.exceptions.TimeoutError,
+    ]
+    # curl_cffi is only imported with the backends which use it
+    cffi_exceptions = sys.modules.get("curl_cffi.requests.exceptions")
+    if cffi_exceptions:
+        timeout_types.append(cffi_exceptions.Timeout)
+    timeout_types = tuple(timeout_types)
+    depth = 0
+    while e is not None and depth < 4:
+        if isinstance(e, timeout_types):
+            return True
+        e = e.__cause__ or e.__context__
+        depth += 1
+    return False
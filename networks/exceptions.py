@@ -29,3 +29,12 @@ INVALID_API_KEY_ERROR = HfApiException(
     status_code=status.HTTP_403_FORBIDDEN,
     detail="Invalid API Key",
 )
+
+
+class DeadlineExceeded(HfApiException):
+    def __init__(self, phase: str) -> None:
+        super().__init__(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail=f"Deadline exceeded: {phase}",
+        )
+        self.phase = phase
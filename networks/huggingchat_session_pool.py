@@ -0,0 +1,230 @@
+import hashlib
+import sqlite3
+import threading
+import time
+
+from collections import deque
+
+from tclogger import logger
+
+from constants.envs import get_config
+from networks.shared_state import SHARED_QUEUES
+
+
+class HuggingchatSession:
+    def __init__(
+        self, hf_chat_id: str, conversation_id: str, message_id: str, model: str
+    ):
+        self.hf_chat_id = hf_chat_id
+        self.conversation_id = conversation_id
+        self.message_id = message_id
+        self.model = model
+        self.created_at = time.time()
+
+    def to_dict(self) -> dict:
+        return {
+            "hf_chat_id": self.hf_chat_id,
+            "conversation_id": self.conversation_id,
+            "message_id": self.message_id,
+            "model": self.model,
+            "created_at": self.created_at,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "HuggingchatSession":
+        session = cls(
+            hf_chat_id=str(data["hf_chat_id"]),
+            conversation_id=str(data["conversation_id"]),
+            message_id=str(data["message_id"]),
+            model=str(data["model"]),
+        )
+        session.created_at = float(data["created_at"])
+        return session
+
+    def is_healthy(self, ttl: float) -> bool:
+        if not (self.hf_chat_id and self.conversation_id and self.message_id):
+            return False
+        return time.time() - self.created_at < ttl
+
+
+class HuggingchatSessionPool:
+    """
+    Ready-to-use HuggingChat sessions (hf-chat id, conversation id, message id).
+    * Pools are keyed by (model, system prompt), and are only refilled for keys
+      which were requested within `huggingchat_pool_demand_ttl` seconds
+    * Sessions are single-use, and expire after `huggingchat_pool_ttl` seconds
+    * Sessions the server has invalidated are only found by their first message,
+      callers `discard()` them and retry with a fresh session
+    * `provider(model, system_prompt)` creates a session with 3 round-trips
+    * With `shared_state_path`, ready sessions are shared by worker processes
+    """
+
+    def __init__(self, provider):
+        self.provider = provider
+        self.pools = {}
+        self.demands = {}
+        self.lock = threading.Lock()
+        self.refill_event = threading.Event()
+        self.thread = None
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.stale = 0
+        self.failures = 0
+
+    @property
+    def size(self) -> int:
+        return get_config("huggingchat_pool_size", 2)
+
+    @property
+    def ttl(self) -> float:
+        return get_config("huggingchat_pool_ttl", 300)
+
+    def get_key(self, model: str, system_prompt: str) -> str:
+        prompt_hash = hashlib.sha1(system_prompt.encode("utf-8")).hexdigest()
+        return f"{model}:{prompt_hash}"
+
+    def start(self):
+        with self.lock:
+            if self.thread and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(target=self.refill_loop, daemon=True)
+            self.thread.start()
+
+    def record_demand(self, key: str, model: str, system_prompt: str):
+        max_keys = get_config("huggingchat_pool_max_keys", 16)
+        with self.lock:
+            self.demands.pop(key, None)
+            self.demands[key] = (model, system_prompt, time.time())
+            # evict least recently demanded keys
+            while len(self.demands) > max_keys:
+                old_key = next(iter(self.demands))
+                self.demands.pop(old_key)
+                self.pools.pop(old_key, None)
+
+    def acquire(self, model: str, system_prompt: str = ""):
+        if self.size <= 0:
+            return None
+        key = self.get_key(model, system_prompt)
+        self.record_demand(key, model, system_prompt)
+        if SHARED_QUEUES.enabled:
+            session = self.pop_shared(key)
+        else:
+            session = None
+            with self.lock:
+                pool = self.pools.get(key, deque())
+                while pool:
+                    candidate = pool.popleft()
+                    if candidate.is_healthy(self.ttl):
+                        session = candidate
+                        break
+                    self.expired += 1
+        with self.lock:
+            if session:
+                self.hits += 1
+            else:
+                self.misses += 1
+        self.start()
+        self.refill_event.set()
+        return session
+
+    def pop_shared(self, key: str):
+        try:
+            data, expired = SHARED_QUEUES.pop(f"huggingchat:{key}", self.ttl)
+        except sqlite3.Error as e:
+            logger.warn(f"HuggingChat session pool: {e}")
+            return None
+        with self.lock:
+            self.expired += expired
+        if data is None:
+            return None
+        try:
+            session = HuggingchatSession.from_dict(data)
+        except (KeyError, TypeError, ValueError) as e:
+            logger.warn(f"HuggingChat session pool: invalid shared session: {e}")
+            return None
+        if session and not session.is_healthy(self.ttl):
+            return None
+        return session
+
+    def discard(self, session: HuggingchatSession, status_code: int):
+        logger.warn(
+            f"Dropped stale HuggingChat session [{session.conversation_id}]: "
+            f"[{status_code}]"
+        )
+        with self.lock:
+            self.stale += 1
+
+    def count_ready(self, key: str) -> int:
+        if SHARED_QUEUES.enabled:
+            return SHARED_QUEUES.count(f"huggingchat:{key}", self.ttl)
+        return len(self.pools.get(key, []))
+
+    def sweep(self):
+        if SHARED_QUEUES.enabled:
+            expired = SHARED_QUEUES.sweep("huggingchat:", self.ttl)
+            with self.lock:
+                self.expired += expired
+            return
+        with self.lock:
+            for pool in self.pools.values():
+                healthy = [s for s in pool if s.is_healthy(self.ttl)]
+                self.expired += len(pool) - len(healthy)
+                pool.clear()
+                pool.extend(healthy)
+
+    def refill(self):
+        demand_ttl = get_config("huggingchat_pool_demand_ttl", 600)
+        now = time.time()
+        with self.lock:
+            demands = [
+                (key, model, system_prompt)
+                for key, (model, system_prompt, demand_at) in self.demands.items()
+                if now - demand_at < demand_ttl
+            ]
+        for key, model, system_prompt in demands:
+            while self.count_ready(key) < self.size:
+                try:
+                    session = self.provider(model, system_prompt)
+                except Exception as e:
+                    self.failures += 1
+                    logger.warn(f"Failed to provision HuggingChat session: {e}")
+                    break
+                with self.lock:
+                    if key not in self.demands:
+                        break
+                    if not SHARED_QUEUES.enabled:
+                        self.pools.setdefault(key, deque()).append(session)
+                if SHARED_QUEUES.enabled:
+                    SHARED_QUEUES.push(
+                        f"huggingchat:{key}",
+                        session.to_dict(),
+                        created_at=session.created_at,
+                    )
+
+    def refill_loop(self):
+        interval = get_config("huggingchat_pool_refill_interval", 10)
+        while True:
+            self.refill_event.wait(timeout=interval)
+            self.refill_event.clear()
+            try:
+                self.sweep()
+                self.refill()
+            except Exception as e:
+                logger.warn(f"HuggingChat session pool: {e}")
+
+    def stats(self) -> dict:
+        if SHARED_QUEUES.enabled:
+            ready = SHARED_QUEUES.counts("huggingchat:")
+        else:
+            with self.lock:
+                ready = {key: len(pool) for key, pool in self.pools.items()}
+        with self.lock:
+            return {
+                "ready": ready,
+                "hits": self.hits,
+                "misses": self.misses,
+                "expired": self.expired,
+                "stale": self.stale,
+                "failures": self.failures,
+            }
@@ -8,11 +8,18 @@ from curl_cffi import requests as cffi_requests
 from tclogger import logger
 
 from constants.models import MODEL_MAP
-from constants.envs import PROXIES
+from constants.envs import PROXIES, get_config
 from constants.headers import HUGGINGCHAT_POST_HEADERS, HUGGINGCHAT_SETTINGS_POST_DATA
 from messagers.message_outputer import OpenaiStreamOutputer
 from messagers.message_composer import MessageComposer
 from messagers.token_checker import TokenChecker
+from networks.connection_pools import SESSION_POOL
+from networks.deadlines import Deadline
+from networks.sse_parser import find_string_field, iter_sse_events
+from networks.huggingchat_session_pool import (
+    HuggingchatSession,
+    HuggingchatSessionPool,
+)
 
 
 class HuggingchatRequester:
@@ -22,9 +29,10 @@ class HuggingchatRequester:
         else:
             self.model = "nous-mixtral-8x7b"
         self.model_fullname = MODEL_MAP[self.model]
+        self.api_base = get_config("huggingchat_api_base", "https://huggingface.co")
 
     def get_hf_chat_id(self):
-        request_url = "https://huggingface.co/chat/settings"
+        request_url = f"{self.api_base}/chat/settings"
         request_body = copy.deepcopy(HUGGINGCHAT_SETTINGS_POST_DATA)
         extra_body = {
             "activeModel": self.model_fullname,
@@ -49,8 +57,8 @@ class HuggingchatRequester:
             raise ValueError(f"Failed to get hf-chat ID: {res.text}")
 
     def get_conversation_id(self, system_prompt: str = ""):
-        request_url = "https://huggingface.co/chat/conversation"
-        request_headers = HUGGINGCHAT_POST_HEADERS
+        request_url = f"{self.api_base}/chat/conversation"
+        request_headers = copy.deepcopy(HUGGINGCHAT_POST_HEADERS)
         extra_headers = {
             "Cookie": f"hf-chat={self.hf_chat_id}",
         }
@@ -61,7 +69,7 @@ class HuggingchatRequester:
         }
         logger.note(f"> Conversation ID:", end=" ")
 
-        res = requests.post(
+        res = SESSION_POOL.get(request_url).post(
             request_url,
             headers=request_headers,
             json=request_body,
@@ -78,8 +86,8 @@ class HuggingchatRequester:
         return conversation_id
 
     def get_last_message_id(self):
-        request_url = f"https://huggingface.co/chat/conversation/{self.conversation_id}/__data.json?x-sveltekit-invalidated=11"
-        request_headers = HUGGINGCHAT_POST_HEADERS
+        request_url = f"{self.api_base}/chat/conversation/{self.conversation_id}/__data.json?x-sveltekit-invalidated=11"
+        request_headers = copy.deepcopy(HUGGINGCHAT_POST_HEADERS)
         extra_headers = {
             "Cookie": f"hf-chat={self.hf_chat_id}",
         }
@@ -87,7 +95,7 @@ class HuggingchatRequester:
         logger.note(f"> Message ID:", end=" ")
 
         message_id = None
-        res = requests.post(
+        res = SESSION_POOL.get(request_url).post(
             request_url,
             headers=request_headers,
             proxies=PROXIES,
@@ -109,6 +117,17 @@ class HuggingchatRequester:
 
         return message_id
 
+    def create_session(self, system_prompt: str = "") -> HuggingchatSession:
+        self.get_hf_chat_id()
+        self.get_conversation_id(system_prompt=system_prompt)
+        self.message_id = self.get_last_message_id()
+        return HuggingchatSession(
+            hf_chat_id=self.hf_chat_id,
+            conversation_id=self.conversation_id,
+            message_id=self.message_id,
+            model=self.model,
+        )
+
     def log_request(self, url, method="GET"):
         logger.note(f"> {method}:", end=" ")
         logger.mesg(f"{url}", end=" ")
@@ -160,7 +179,14 @@ class HuggingchatRequester:
 
         logger.exit_quiet(not verbose)
 
-    def chat_completions(self, messages: list[dict], iter_lines=False, verbose=False):
+    def chat_completions(
+        self,
+        messages: list[dict],
+        iter_lines=False,
+        verbose=False,
+        deadline: Deadline = None,
+    ):
+        deadline = deadline or Deadline()
         composer = MessageComposer(model=self.model)
         system_prompt, input_prompt = composer.decompose_to_system_and_input_prompt(
             messages
@@ -168,12 +194,32 @@ class HuggingchatRequester:
 
         checker = TokenChecker(input_str=system_prompt + input_prompt, model=self.model)
         checker.check_token_limit()
+        deadline.check("tokenize")
 
-        self.get_hf_chat_id()
-        self.get_conversation_id(system_prompt=system_prompt)
-        message_id = self.get_last_message_id()
+        session = HUGGINGCHAT_SESSION_POOL.acquire(self.model, system_prompt)
+        if session:
+            self.hf_chat_id = session.hf_chat_id
+            self.conversation_id = session.conversation_id
+            message_id = session.message_id
+        else:
+            self.create_session(system_prompt=system_prompt)
+            message_id = self.message_id
+        deadline.check("session")
+
+        res = self.post_message(message_id, input_prompt, deadline)
+        if session and res.status_code != 200:
+            # pooled conversations may have been invalidated by the server,
+            # so the session is dropped, and the message is sent in a fresh one
+            HUGGINGCHAT_SESSION_POOL.discard(session, res.status_code)
+            res.close()
+            self.create_session(system_prompt=system_prompt)
+            deadline.check("session")
+            res = self.post_message(self.message_id, input_prompt, deadline)
+        self.log_response(res, stream=True, iter_lines=iter_lines, verbose=verbose)
+        return res
 
-        request_url = f"https://huggingface.co/chat/conversation/{self.conversation_id}"
+    def post_message(self, message_id: str, input_prompt: str, deadline: Deadline):
+        request_url = f"{self.api_base}/chat/conversation/{self.conversation_id}"
         request_headers = copy.deepcopy(HUGGINGCHAT_POST_HEADERS)
         extra_headers = {
             "Content-Type": "text/event-stream",
@@ -191,18 +237,29 @@ class HuggingchatRequester:
         }
         self.log_request(request_url, method="POST")
 
-        res = requests.post(
+        return SESSION_POOL.get(request_url).post(
             request_url,
             headers=request_headers,
             json=request_body,
             proxies=PROXIES,
+            timeout=deadline.upstream_timeout(),
             stream=True,
         )
-        self.log_response(res, stream=True, iter_lines=iter_lines, verbose=verbose)
-        return res
+
+
+def provision_huggingchat_session(model: str, system_prompt: str = ""):
+    requester = HuggingchatRequester(model=model)
+    return requester.create_session(system_prompt=system_prompt)
+
+
+HUGGINGCHAT_SESSION_POOL = HuggingchatSessionPool(
+    provider=provision_huggingchat_session
+)
 
 
 class HuggingchatStreamer:
+    backend = "huggingchat"
+
     def __init__(self, model: str):
         if model in MODEL_MAP.keys():
             self.model = model
@@ -211,51 +268,64 @@ class HuggingchatStreamer:
         self.model_fullname = MODEL_MAP[self.model]
         self.message_outputer = OpenaiStreamOutputer(model=self.model)
 
-    def chat_response(self, messages: list[dict], verbose=False):
+    def chat_response(
+        self, messages: list[dict], verbose=False, deadline: Deadline = None
+    ):
         requester = HuggingchatRequester(model=self.model)
         return requester.chat_completions(
-            messages=messages, iter_lines=False, verbose=verbose
+            messages=messages, iter_lines=False, verbose=verbose, deadline=deadline
         )
 
+    def parse_data(self, data: bytes):
+        # fast path for the frequent stream tokens, others are fully parsed
+        msg_type = find_string_field(data, b"type")
+        if msg_type and msg_type[0] == "stream":
+            token = find_string_field(data, b"token", start=msg_type[1])
+            if token:
+                return {"type": "stream", "token": token[0]}
+        return json.loads(data, strict=False)
+
     def chat_return_generator(self, stream_response: requests.Response, verbose=False):
         is_finished = False
-        for line in stream_response.iter_lines():
-            line = line.decode("utf-8")
-            line = re.sub(r"^data:\s*", "", line)
-            line = line.strip()
-            if not line:
-                continue
-
-            content = ""
-            content_type = "Completions"
-            try:
-                data = json.loads(line, strict=False)
-                msg_type = data.get("type")
-                if msg_type == "status":
-                    msg_status = data.get("status")
-                    continue
-                elif msg_type == "stream":
-                    content_type = "Completions"
-                    content = data.get("token", "")
-                    if verbose:
-                        logger.success(content, end="")
-                elif msg_type == "finalAnswer":
-                    content_type = "Finished"
-                    content = ""
-                    full_content = data.get("text")
-                    if verbose:
-                        logger.success("\n[Finished]")
-                    is_finished = True
-                    break
-                else:
+        try:
+            events = iter_sse_events(stream_response.iter_content(chunk_size=None))
+            for event in events:
+                if not event.data.strip():
                     continue
-            except Exception as e:
-                logger.warn(e)
 
-            output = self.message_outputer.output(
-                content=content, content_type=content_type
-            )
-            yield output
+                content = ""
+                content_type = "Completions"
+                try:
+                    data = self.parse_data(event.data)
+                    msg_type = data.get("type")
+                    if msg_type == "status":
+                        msg_status = data.get("status")
+                        continue
+                    elif msg_type == "stream":
+                        content_type = "Completions"
+                        content = data.get("token", "")
+                        if verbose:
+                            logger.success(content, end="")
+                    elif msg_type == "finalAnswer":
+                        content_type = "Finished"
+                        content = ""
+                        full_content = data.get("text")
+                        if verbose:
+                            logger.success("\n[Finished]")
+                        is_finished = True
+                        break
+                    else:
+                        continue
+                except Exception as e:
+                    logger.warn(e)
+
+                output = self.message_outputer.output(
+                    content=content, content_type=content_type
+                )
+                yield output
+        finally:
+            # also run if the generator is closed early, on client disconnect
+            stream_response.close()
 
         if not is_finished:
             yield self.message_outputer.output(content="", content_type="Finished")
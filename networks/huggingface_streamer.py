@@ -1,15 +1,22 @@
+import anyio
 import json
-import re
-import requests
 
 from tclogger import logger
 from constants.models import MODEL_MAP, STOP_SEQUENCES_MAP
-from constants.envs import PROXIES
+from constants.envs import PROXIES, get_config
 from messagers.message_outputer import OpenaiStreamOutputer
 from messagers.token_checker import TokenChecker
+from messagers.tokenizer_pool import TOKENIZER_POOL
+from metrics.phase_timer import PhaseTimer
+from networks.connection_pools import ASYNC_CLIENT_POOL, SESSION_POOL
+from networks.deadlines import Deadline
+from networks.sse_parser import aiter_sse_events, find_string_field, iter_sse_events
+from networks.upstream_router import UPSTREAM_ROUTER
 
 
 class HuggingfaceStreamer:
+    backend = "huggingface"
+
     def __init__(self, model: str):
         if model in MODEL_MAP.keys():
             self.model = model
@@ -17,10 +24,23 @@ class HuggingfaceStreamer:
             self.model = "nous-mixtral-8x7b"
         self.model_fullname = MODEL_MAP[self.model]
         self.message_outputer = OpenaiStreamOutputer(model=self.model)
+        self.prompt_tokens = None
+        # per-token console writes are costly under load, enabled in dev mode
+        self.is_log_tokens = get_config("log_tokens", False)
 
     def parse_line(self, line):
-        line = line.decode("utf-8")
-        line = re.sub(r"data:\s*", "", line)
+        # `line` is the data of a TGI stream event, a "data:" prefix is tolerated
+        if isinstance(line, str):
+            line = line.encode("utf-8")
+        if line.startswith(b"data:"):
+            line = line[len(b"data:") :].lstrip()
+        # fast path: read `token.text` without parsing the whole event
+        token_idx = line.find(b'"token":')
+        if token_idx >= 0:
+            field = find_string_field(line, b"text", start=token_idx)
+            if field:
+                return field[0]
+
         data = json.loads(line)
         content = ""
         try:
@@ -29,7 +49,26 @@ class HuggingfaceStreamer:
             logger.err(data)
         return content
 
-    def chat_response(
+    def get_max_new_tokens(
+        self,
+        prompt: str,
+        max_new_tokens: int = None,
+        prompt_segments: list[str] = None,
+        prompt_tokens: int = None,
+    ):
+        checker = TokenChecker(
+            input_str=prompt, model=self.model, segments=prompt_segments
+        )
+        if prompt_tokens is not None:
+            checker.token_count = prompt_tokens
+        token_redundancy = checker.get_token_redundancy()
+        if max_new_tokens is None or max_new_tokens <= 0:
+            max_new_tokens = token_redundancy
+        else:
+            max_new_tokens = min(max_new_tokens, token_redundancy)
+        return max_new_tokens
+
+    def build_request(
         self,
         prompt: str = None,
         temperature: float = 0.5,
@@ -40,9 +79,11 @@ class HuggingfaceStreamer:
     ):
         # https://huggingface.co/docs/api-inference/detailed_parameters?code=curl
         # curl --proxy http://<server>:<port> https://api-inference.huggingface.co/models/<org>/<model_name> -X POST -d '{"inputs":"who are you?","parameters":{"max_new_token":64}}' -H 'Content-Type: application/json' -H 'Authorization: Bearer <HF_TOKEN>'
-        self.request_url = (
-            f"https://api-inference.huggingface.co/models/{self.model_fullname}"
+        # `huggingface_api_base` can point to a local TGI, see `benchmarks.fake_upstream`
+        api_base = get_config(
+            "huggingface_api_base", "https://api-inference.huggingface.co"
         )
+        self.request_url = f"{api_base}/models/{self.model_fullname}"
         self.request_headers = {
             "Content-Type": "application/json",
         }
@@ -61,13 +102,6 @@ class HuggingfaceStreamer:
         top_p = max(top_p, 0.01)
         top_p = min(top_p, 0.99)
 
-        checker = TokenChecker(input_str=prompt, model=self.model)
-
-        if max_new_tokens is None or max_new_tokens <= 0:
-            max_new_tokens = checker.get_token_redundancy()
-        else:
-            max_new_tokens = min(max_new_tokens, checker.get_token_redundancy())
-
         # References:
         #   huggingface_hub/inference/_client.py:
         #     class InferenceClient > def text_generation()
@@ -95,23 +129,122 @@ class HuggingfaceStreamer:
         #         self.STOP_SEQUENCES[self.model]
         #     ]
 
+    def log_status_code(self, status_code: int):
+        if status_code == 200:
+            logger.success(status_code)
+        else:
+            logger.err(status_code)
+
+    def chat_response(
+        self,
+        prompt: str = None,
+        temperature: float = 0.5,
+        top_p: float = 0.95,
+        max_new_tokens: int = None,
+        api_key: str = None,
+        use_cache: bool = False,
+        prompt_segments: list[str] = None,
+        deadline: Deadline = None,
+    ):
+        deadline = deadline or Deadline()
+        max_new_tokens = self.get_max_new_tokens(
+            prompt, max_new_tokens, prompt_segments
+        )
+        deadline.check("tokenize")
+        self.build_request(
+            prompt=prompt,
+            temperature=temperature,
+            top_p=top_p,
+            max_new_tokens=max_new_tokens,
+            api_key=api_key,
+            use_cache=use_cache,
+        )
+
         logger.back(self.request_url)
-        stream_response = requests.post(
+        session = SESSION_POOL.get(self.request_url)
+        stream_response = session.post(
             self.request_url,
             headers=self.request_headers,
             json=self.request_body,
             proxies=PROXIES,
+            timeout=deadline.upstream_timeout(),
             stream=True,
         )
-        status_code = stream_response.status_code
-        if status_code == 200:
-            logger.success(status_code)
+        self.log_status_code(stream_response.status_code)
+
+        return stream_response
+
+    async def chat_response_async(
+        self,
+        prompt: str = None,
+        temperature: float = 0.5,
+        top_p: float = 0.95,
+        max_new_tokens: int = None,
+        api_key: str = None,
+        use_cache: bool = False,
+        prompt_segments: list[str] = None,
+        timer: PhaseTimer = None,
+        deadline: Deadline = None,
+    ):
+        deadline = deadline or Deadline()
+        # tokenization is CPU-bound, so keep it off the event loop
+        prompt_tokens = await deadline.wait_for(
+            TOKENIZER_POOL.count_tokens(
+                self.model, prompt_segments or [prompt], backend=self.backend
+            ),
+            "tokenize",
+        )
+        self.prompt_tokens = prompt_tokens
+        if timer:
+            timer.mark("tokenize")
+        max_new_tokens = self.get_max_new_tokens(
+            prompt, max_new_tokens, prompt_segments, prompt_tokens
+        )
+        self.build_request(
+            prompt=prompt,
+            temperature=temperature,
+            top_p=top_p,
+            max_new_tokens=max_new_tokens,
+            api_key=api_key,
+            use_cache=use_cache,
+        )
+
+        urls = UPSTREAM_ROUTER.get_urls(self.model, self.request_url)
+        if len(urls) == 1 and not get_config("upstream_hedging", False):
+            stream_response = await self.send_async(self.request_url, deadline, timer)
         else:
-            logger.err(status_code)
+            stream_response = await UPSTREAM_ROUTER.open(
+                self.model,
+                urls,
+                lambda url: self.send_async(url, deadline, timer),
+                # phases of the request timer are only marked by the primary
+                lambda url: self.send_async(url, deadline),
+            )
+        self.log_status_code(stream_response.status_code)
 
         return stream_response
 
-    def chat_return_dict(self, stream_response):
+    async def send_async(self, url: str, deadline: Deadline, timer: PhaseTimer = None):
+        logger.back(url)
+        headers = self.request_headers
+        if url != self.request_url:
+            # the HF token is only sent to the HF Inference API
+            headers = {
+                key: value for key, value in headers.items() if key != "Authorization"
+            }
+        client = ASYNC_CLIENT_POOL.get(url)
+        request = client.build_request(
+            "POST",
+            url,
+            headers=headers,
+            json=self.request_body,
+            timeout=deadline.httpx_timeout(),
+            # marks `connect` and `first_byte` phases
+            extensions={"trace": timer.trace} if timer else None,
+        )
+        return await client.send(request, stream=True)
+
+    def init_final_output(self):
         # https://platform.openai.com/docs/guides/text-generation/chat-completions-response-format
         final_output = self.message_outputer.default_data.copy()
         final_output["choices"] = [
@@ -125,52 +258,127 @@ class HuggingfaceStreamer:
             }
         ]
         logger.back(final_output)
+        return final_output
 
-        final_content = ""
-        for line in stream_response.iter_lines():
-            if not line:
-                continue
-            content = self.parse_line(line)
-
-            if content.strip() == self.stop_sequences:
-                logger.success("\n[Finished]")
-                break
-            else:
-                logger.back(content, end="")
-                final_content += content
-
+    def finalize_content(self, final_output, final_content: str):
         if self.model in STOP_SEQUENCES_MAP.keys():
-            final_content = final_content.replace(self.stop_sequences, "")
+            final_content = final_content.replace(STOP_SEQUENCES_MAP[self.model], "")
 
         final_content = final_content.strip()
         final_output["choices"][0]["message"]["content"] = final_content
         return final_output
 
-    def chat_return_generator(self, stream_response):
+    def chat_return_dict(self, stream_response):
+        final_output = self.init_final_output()
+        final_content = ""
+        is_finished = False
+        try:
+            events = iter_sse_events(stream_response.iter_content(chunk_size=None))
+            for event in events:
+                if not event.data:
+                    continue
+                if is_finished:
+                    # keep reading to the end, so the connection can be reused
+                    continue
+                content = self.parse_line(event.data)
+
+                if content.strip() == self.stop_sequences:
+                    logger.success("\n[Finished]")
+                    is_finished = True
+                else:
+                    if self.is_log_tokens:
+                        logger.back(content, end="")
+                    final_content += content
+        finally:
+            stream_response.close()
+
+        return self.finalize_content(final_output, final_content)
+
+    async def chat_return_dict_async(self, stream_response):
+        final_output = self.init_final_output()
+        final_content = ""
         is_finished = False
-        line_count = 0
-        for line in stream_response.iter_lines():
-            if line:
-                line_count += 1
-            else:
-                continue
-
-            content = self.parse_line(line)
-
-            if content.strip() == self.stop_sequences:
-                content_type = "Finished"
-                logger.success("\n[Finished]")
-                is_finished = True
-            else:
-                content_type = "Completions"
-                if line_count == 1:
-                    content = content.lstrip()
+        try:
+            events = aiter_sse_events(stream_response.aiter_bytes())
+            async for event in events:
+                if not event.data:
+                    continue
+                if is_finished:
+                    # keep reading to the end, so the connection can be reused
+                    continue
+                content = self.parse_line(event.data)
+
+                if content.strip() == self.stop_sequences:
+                    logger.success("\n[Finished]")
+                    is_finished = True
+                else:
+                    if self.is_log_tokens:
+                        logger.back(content, end="")
+                    final_content += content
+        finally:
+            await stream_response.aclose()
+
+        return self.finalize_content(final_output, final_content)
+
+    def event_to_output(self, data: bytes, event_count: int):
+        content = self.parse_line(data)
+
+        if content.strip() == self.stop_sequences:
+            content_type = "Finished"
+            logger.success("\n[Finished]")
+            is_finished = True
+        else:
+            content_type = "Completions"
+            is_finished = False
+            if event_count == 1:
+                content = content.lstrip()
+            if self.is_log_tokens:
                 logger.back(content, end="")
 
-            output = self.message_outputer.output(
-                content=content, content_type=content_type
-            )
-            yield output
+        output = self.message_outputer.output(
+            content=content, content_type=content_type
+        )
+        return output, is_finished
+
+    def chat_return_generator(self, stream_response):
+        is_finished = False
+        event_count = 0
+        try:
+            events = iter_sse_events(stream_response.iter_content(chunk_size=None))
+            for event in events:
+                if event.data:
+                    event_count += 1
+                else:
+                    continue
+
+                output, event_finished = self.event_to_output(event.data, event_count)
+                is_finished = is_finished or event_finished
+                yield output
+        finally:
+            # also run if the generator is closed early, on client disconnect
+            stream_response.close()
+
+        if not is_finished:
+            yield self.message_outputer.output(content="", content_type="Finished")
+
+    async def chat_return_generator_async(self, stream_response):
+        is_finished = False
+        event_count = 0
+        try:
+            events = aiter_sse_events(stream_response.aiter_bytes())
+            async for event in events:
+                if event.data:
+                    event_count += 1
+                else:
+                    continue
+
+                output, event_finished = self.event_to_output(event.data, event_count)
+                is_finished = is_finished or event_finished
+                yield output
+        finally:
+            # shielded, as awaits in a cancelled scope (client disconnect) raise at once
+            with anyio.CancelScope(shield=True):
+                await stream_response.aclose()
 
         if not is_finished:
             yield self.message_outputer.output(content="", content_type="Finished")
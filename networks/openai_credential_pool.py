@@ -0,0 +1,177 @@
+import math
+import sqlite3
+import threading
+import time
+
+from collections import deque
+
+from tclogger import logger
+
+from constants.envs import get_config
+from networks.shared_state import SHARED_QUEUES
+
+
+class OpenaiCredentialPool:
+    """
+    Pre-authenticated OpenAI requesters (requirements token + proof token).
+    * A background thread keeps `target_size` credentials ready,
+      where the target follows the observed request rate (EWMA),
+      bounded by `openai_pool_min_size` and `openai_pool_max_size`
+    * Credentials are single-use, and expire after `openai_pool_ttl` seconds
+    * `provider()` returns an authenticated requester with its proof token
+    * With `shared_state_path`, ready credentials are shared by worker processes,
+      as the dicts of `credential.to_dict()`, and `restorer(dict)` rebuilds them
+    """
+
+    SHARED_NAME = "openai:credentials"
+
+    def __init__(self, provider, restorer):
+        self.provider = provider
+        self.restorer = restorer
+        self.credentials = deque()
+        self.lock = threading.Lock()
+        self.refill_event = threading.Event()
+        self.thread = None
+        self.last_acquire_at = None
+        self.request_rate = 0.0
+        self.provision_seconds = 1.0
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.failures = 0
+
+    @property
+    def ttl(self) -> float:
+        return get_config("openai_pool_ttl", 120)
+
+    @property
+    def target_size(self) -> int:
+        min_size = get_config("openai_pool_min_size", 1)
+        max_size = get_config("openai_pool_max_size", 4)
+        if max_size <= 0:
+            return 0
+        # enough credentials to serve requests while the next ones are provisioned
+        expected = math.ceil(self.request_rate * self.provision_seconds * 2)
+        return max(min_size, min(max_size, expected))
+
+    def start(self):
+        with self.lock:
+            if self.thread and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(target=self.refill_loop, daemon=True)
+            self.thread.start()
+
+    def update_request_rate(self, now: float):
+        if self.last_acquire_at is not None:
+            interval = max(now - self.last_acquire_at, 1e-3)
+            self.request_rate = 0.8 * self.request_rate + 0.2 * (1 / interval)
+        self.last_acquire_at = now
+
+    def acquire(self):
+        if get_config("openai_pool_max_size", 4) <= 0:
+            return None
+        now = time.time()
+        credential = None
+        if SHARED_QUEUES.enabled:
+            credential = self.pop_shared()
+        with self.lock:
+            self.update_request_rate(now)
+            while self.credentials:
+                created_at, candidate = self.credentials.popleft()
+                if now - created_at < self.ttl:
+                    credential = candidate
+                    break
+                self.expired += 1
+            if credential:
+                self.hits += 1
+            else:
+                self.misses += 1
+        self.start()
+        self.refill_event.set()
+        return credential
+
+    def pop_shared(self):
+        try:
+            data, expired = SHARED_QUEUES.pop(self.SHARED_NAME, self.ttl)
+        except sqlite3.Error as e:
+            logger.warn(f"OpenAI credential pool: {e}")
+            return None
+        with self.lock:
+            self.expired += expired
+        if data is None:
+            return None
+        try:
+            return self.restorer(data)
+        except (KeyError, TypeError, ValueError) as e:
+            logger.warn(f"OpenAI credential pool: invalid shared credential: {e}")
+            return None
+
+    def count_ready(self) -> int:
+        if SHARED_QUEUES.enabled:
+            return SHARED_QUEUES.count(self.SHARED_NAME, self.ttl)
+        return len(self.credentials)
+
+    def sweep(self):
+        if SHARED_QUEUES.enabled:
+            expired = SHARED_QUEUES.sweep(self.SHARED_NAME, self.ttl)
+            with self.lock:
+                self.expired += expired
+            return
+        now = time.time()
+        with self.lock:
+            fresh = [(t, c) for t, c in self.credentials if now - t < self.ttl]
+            self.expired += len(self.credentials) - len(fresh)
+            self.credentials = deque(fresh)
+
+    def is_in_demand(self) -> bool:
+        demand_ttl = get_config("openai_pool_demand_ttl", 600)
+        last_acquire_at = self.last_acquire_at
+        return (
+            last_acquire_at is not None and time.time() - last_acquire_at < demand_ttl
+        )
+
+    def refill(self):
+        if not self.is_in_demand():
+            return
+        while self.count_ready() < self.target_size:
+            t1 = time.time()
+            try:
+                credential = self.provider()
+            except Exception as e:
+                self.failures += 1
+                logger.warn(f"Failed to provision OpenAI credential: {e}")
+                break
+            t2 = time.time()
+            with self.lock:
+                self.provision_seconds = 0.8 * self.provision_seconds + 0.2 * (t2 - t1)
+                if not SHARED_QUEUES.enabled:
+                    self.credentials.append((t2, credential))
+            if SHARED_QUEUES.enabled:
+                SHARED_QUEUES.push(
+                    self.SHARED_NAME, credential.to_dict(), created_at=t2
+                )
+
+    def refill_loop(self):
+        interval = get_config("openai_pool_refill_interval", 5)
+        while True:
+            self.refill_event.wait(timeout=interval)
+            self.refill_event.clear()
+            try:
+                self.sweep()
+                self.refill()
+            except Exception as e:
+                logger.warn(f"OpenAI credential pool: {e}")
+
+    def stats(self) -> dict:
+        ready = self.count_ready()
+        with self.lock:
+            return {
+                "ready": ready,
+                "target_size": self.target_size,
+                "request_rate": round(self.request_rate, 4),
+                "provision_seconds": round(self.provision_seconds, 4),
+                "hits": self.hits,
+                "misses": self.misses,
+                "expired": self.expired,
+                "failures": self.failures,
+            }
@@ -0,0 +1,165 @@
+import json
+import time
+
+from networks.sse_parser import find_string_field
+
+
+class OpenaiDeltaExtractor:
+    """
+    Extract new content from ChatGPT backend events, which resend the whole
+    accumulated message each time.
+    * Only the unseen suffix of the raw `parts[0]` string is scanned and decoded,
+      so a stream costs O(n) instead of re-parsing an O(n) payload per event
+    * Falls back to full json parsing for events without the expected layout,
+      and for the rest of the stream once such an event carries content
+    """
+
+    def __init__(self):
+        self.raw_offset = 0
+        self.raw_tail = b""
+        self.content_offset = 0
+        self.fast = True
+
+    def extract(self, data: bytes):
+        """
+        Returns the delta content of an in-progress assistant message,
+        or None if the event should be skipped.
+        """
+        if self.fast:
+            try:
+                return self.extract_fast(data)
+            except ValueError:
+                pass
+        delta_content = self.extract_full(data)
+        if delta_content is not None:
+            # raw offsets are not tracked by the full parse
+            self.fast = False
+        return delta_content
+
+    def extract_full(self, data: bytes):
+        data = json.loads(data, strict=False)
+        message_role = data["message"]["author"]["role"]
+        message_status = data["message"]["status"]
+        if message_role != "assistant" or message_status != "in_progress":
+            return None
+        content = data["message"]["content"]["parts"][0]
+        if not len(content):
+            return None
+        delta_content = content[self.content_offset :]
+        self.content_offset = len(content)
+        return delta_content
+
+    def find_parts_string(self, data: bytes):
+        # locate the opening quote of `"parts": ["...`
+        idx = data.find(b'"parts":')
+        if idx < 0:
+            raise ValueError("parts not found")
+        idx = data.find(b"[", idx) + 1
+        while data[idx : idx + 1] in (b" ", b"\n", b"\t"):
+            idx += 1
+        if data[idx : idx + 1] != b'"':
+            raise ValueError("parts[0] is not a string")
+        return idx + 1
+
+    def find_string_end(self, data: bytes, begin: int, start: int) -> int:
+        end = data.find(b'"', start)
+        while end >= 0:
+            backslashes = 0
+            pos = end - 1
+            while pos >= begin and data[pos] == 0x5C:  # '\\'
+                backslashes += 1
+                pos -= 1
+            if backslashes % 2 == 0:
+                return end
+            end = data.find(b'"', end + 1)
+        raise ValueError("unterminated string")
+
+    def extract_fast(self, data: bytes):
+        # `author` precedes `content`, so this only scans the event header
+        role = find_string_field(data, b"role")
+        if role is None:
+            raise ValueError("role not found")
+        if role[0] != "assistant":
+            return None
+
+        begin = self.find_parts_string(data)
+        # the seen prefix is a complete json string, so scanning resumes at its end,
+        # unless its tail differs, e.g. when a new message starts
+        start = begin + self.raw_offset
+        if data[start - len(self.raw_tail) : start] != self.raw_tail:
+            start = begin
+        end = self.find_string_end(data, begin, start)
+        if data[end + 1 : end + 2] != b"]":
+            raise ValueError("parts has more than one element")
+
+        status = find_string_field(data, b"status", start=end + 1)
+        if status is None:
+            raise ValueError("status not found")
+        if status[0] != "in_progress":
+            return None
+        if end == begin:
+            return None
+
+        raw_length = end - begin
+        if raw_length <= self.raw_offset:
+            # shorter than what was seen, e.g. a new message
+            delta_raw = b""
+        else:
+            delta_raw = data[begin + self.raw_offset : end]
+        self.raw_offset = raw_length
+        self.raw_tail = data[max(begin, end - 16) : end]
+
+        if b"\\" in delta_raw:
+            delta_content = json.loads(b'"' + delta_raw + b'"', strict=False)
+        else:
+            delta_content = delta_raw.decode("utf-8")
+        self.content_offset += len(delta_content)
+        return delta_content
+
+
+def build_synthetic_events(n_tokens: int = 8000) -> list[bytes]:
+    words = ["Hello", " world", ",", " this", " is", ' "quoted"', " 你好", "\n"]
+    events = []
+    content = ""
+    for i in range(n_tokens):
+        content += words[i % len(words)]
+        event = {
+            "message": {
+                "id": "00000000-0000-0000-0000-000000000000",
+                "author": {"role": "assistant", "name": None, "metadata": {}},
+                "create_time": 1700000000.0,
+                "update_time": None,
+                "content": {"content_type": "text", "parts": [content]},
+                "status": "in_progress",
+                "end_turn": None,
+                "weight": 1.0,
+                "metadata": {"model_slug": "text-davinci-002-render-sha"},
+                "recipient": "all",
+            },
+            "conversation_id": "00000000-0000-0000-0000-000000000000",
+            "error": None,
+        }
+        events.append(json.dumps(event).encode())
+    return events
+
+
+def benchmark(n_tokens: int = 8000):
+    events = build_synthetic_events(n_tokens)
+
+    t1 = time.perf_counter()
+    baseline = OpenaiDeltaExtractor()
+    baseline_deltas = [baseline.extract_full(event) for event in events]
+    t2 = time.perf_counter()
+    extractor = OpenaiDeltaExtractor()
+    deltas = [extractor.extract(event) for event in events]
+    t3 = time.perf_counter()
+
+    assert deltas == baseline_deltas and extractor.fast
+    print(f"events  : {n_tokens} ({sum(map(len, events)) / 1e6:.1f} MB)")
+    print(f"baseline: {t2 - t1:>8.3f}s  {n_tokens / (t2 - t1):>12,.0f} events/sec")
+    print(f"fast    : {t3 - t2:>8.3f}s  {n_tokens / (t3 - t2):>12,.0f} events/sec")
+
+
+if __name__ == "__main__":
+    benchmark()
+    # python -m networks.openai_delta_extractor
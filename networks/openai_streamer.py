@@ -7,12 +7,16 @@ import uuid
 from curl_cffi import requests
 from tclogger import logger
 
-from constants.envs import PROXIES
+from constants.envs import PROXIES, get_config
 from constants.headers import OPENAI_GET_HEADERS, OPENAI_POST_DATA
 from constants.models import TOKEN_LIMIT_MAP, TOKEN_RESERVED
 
 from messagers.message_outputer import OpenaiStreamOutputer
+from networks.deadlines import Deadline
+from networks.openai_credential_pool import OpenaiCredentialPool
+from networks.openai_delta_extractor import OpenaiDeltaExtractor
 from networks.proof_worker import ProofWorker
+from networks.sse_parser import iter_sse_events
 
 
 class OpenaiRequester:
@@ -20,7 +24,9 @@ class OpenaiRequester:
         self.init_requests_params()
 
     def init_requests_params(self):
-        self.api_base = "https://chat.openai.com/backend-anon"
+        self.api_base = get_config(
+            "openai_api_base", "https://chat.openai.com/backend-anon"
+        )
         self.api_me = f"{self.api_base}/me"
         self.api_models = f"{self.api_base}/models"
         self.api_chat_requirements = f"{self.api_base}/sentinel/chat-requirements"
@@ -32,6 +38,29 @@ class OpenaiRequester:
         }
         self.requests_headers.update(extra_headers)
 
+    def to_dict(self) -> dict:
+        # the state of an authenticated requester, to share it with other workers
+        return {
+            "uuid": self.uuid,
+            "chat_requirements_token": self.chat_requirements_token,
+            "chat_requirements_seed": self.chat_requirements_seed,
+            "chat_requirements_difficulty": self.chat_requirements_difficulty,
+            "proof_token": self.proof_token,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "OpenaiRequester":
+        requester = cls()
+        requester.uuid = str(data["uuid"])
+        requester.requests_headers["Oai-Device-Id"] = requester.uuid
+        requester.chat_requirements_token = str(data["chat_requirements_token"])
+        requester.chat_requirements_seed = str(data["chat_requirements_seed"])
+        requester.chat_requirements_difficulty = str(
+            data["chat_requirements_difficulty"]
+        )
+        requester.proof_token = str(data["proof_token"])
+        return requester
+
     def log_request(self, url, method="GET"):
         logger.note(f"> {method}:", end=" ")
         logger.mesg(f"{url}", end=" ")
@@ -128,14 +157,27 @@ class OpenaiRequester:
         ]
         return new_messages
 
-    def chat_completions(self, messages: list[dict], iter_lines=False, verbose=False):
-        proof_token = ProofWorker().calc_proof_token(
+    def calc_proof_token(self):
+        self.proof_token = ProofWorker().calc_proof_token(
             self.chat_requirements_seed, self.chat_requirements_difficulty
         )
+        return self.proof_token
+
+    def chat_completions(
+        self,
+        messages: list[dict],
+        iter_lines=False,
+        verbose=False,
+        deadline: Deadline = None,
+    ):
+        deadline = deadline or Deadline()
+        if not getattr(self, "proof_token", None):
+            self.calc_proof_token()
+            deadline.check("proof_token")
         extra_headers = {
             "Accept": "text/event-stream",
             "Openai-Sentinel-Chat-Requirements-Token": self.chat_requirements_token,
-            "Openai-Sentinel-Proof-Token": proof_token,
+            "Openai-Sentinel-Proof-Token": self.proof_token,
         }
         requests_headers = copy.deepcopy(self.requests_headers)
         requests_headers.update(extra_headers)
@@ -154,7 +196,7 @@ class OpenaiRequester:
             headers=requests_headers,
             json=post_data,
             proxies=PROXIES,
-            timeout=10,
+            timeout=deadline.upstream_timeout(),
             impersonate="chrome120",
             stream=True,
         )
@@ -162,17 +204,33 @@ class OpenaiRequester:
         return res
 
 
+def provision_openai_requester():
+    requester = OpenaiRequester()
+    requester.auth()
+    requester.calc_proof_token()
+    return requester
+
+
+OPENAI_CREDENTIAL_POOL = OpenaiCredentialPool(
+    provider=provision_openai_requester, restorer=OpenaiRequester.from_dict
+)
+
+
 class OpenaiStreamer:
+    backend = "openai"
+
     def __init__(self):
         self.model = "gpt-3.5-turbo"
         self.message_outputer = OpenaiStreamOutputer(
             owned_by="openai", model="gpt-3.5-turbo"
         )
         self.tokenizer = tiktoken.get_encoding("cl100k_base")
+        self.prompt_tokens = None
 
     def count_tokens(self, messages: list[dict]):
+        contents = [message["content"] for message in messages]
         token_count = sum(
-            len(self.tokenizer.encode(message["content"])) for message in messages
+            len(tokens) for tokens in self.tokenizer.encode_batch(contents)
         )
         logger.note(f"Prompt Token Count: {token_count}")
         return token_count
@@ -180,6 +238,7 @@ class OpenaiStreamer:
     def check_token_limit(self, messages: list[dict]):
         token_limit = TOKEN_LIMIT_MAP[self.model]
         token_count = self.count_tokens(messages)
+        self.prompt_tokens = token_count
         token_redundancy = int(token_limit - TOKEN_RESERVED - token_count)
         if token_redundancy <= 0:
             raise ValueError(
@@ -187,57 +246,64 @@ class OpenaiStreamer:
             )
         return True
 
-    def chat_response(self, messages: list[dict], iter_lines=False, verbose=False):
-        self.check_token_limit(messages)
-        logger.enter_quiet(not verbose)
-        requester = OpenaiRequester()
-        requester.auth()
-        logger.exit_quiet(not verbose)
+    def chat_response(
+        self,
+        messages: list[dict],
+        iter_lines=False,
+        verbose=False,
+        is_token_limit_checked=False,
+        deadline: Deadline = None,
+    ):
+        deadline = deadline or Deadline()
+        if not is_token_limit_checked:
+            self.check_token_limit(messages)
+            deadline.check("tokenize")
+        requester = OPENAI_CREDENTIAL_POOL.acquire()
+        if requester is None:
+            logger.enter_quiet(not verbose)
+            requester = OpenaiRequester()
+            requester.auth()
+            logger.exit_quiet(not verbose)
+            deadline.check("auth")
         return requester.chat_completions(
-            messages=messages, iter_lines=iter_lines, verbose=verbose
+            messages=messages, iter_lines=iter_lines, verbose=verbose, deadline=deadline
         )
 
     def chat_return_generator(self, stream_response: requests.Response, verbose=False):
-        content_offset = 0
+        extractor = OpenaiDeltaExtractor()
         is_finished = False
 
-        for line in stream_response.iter_lines():
-            line = line.decode("utf-8")
-            line = re.sub(r"^data:\s*", "", line)
-            line = line.strip()
-
-            if not line:
-                continue
+        try:
+            events = iter_sse_events(stream_response.iter_content())
+            for event in events:
+                if not event.data.strip():
+                    continue
 
-            if re.match(r"^\[DONE\]", line):
-                content_type = "Finished"
-                delta_content = ""
-                logger.success("\n[Finished]")
-                is_finished = True
-            else:
-                content_type = "Completions"
-                delta_content = ""
-                try:
-                    data = json.loads(line, strict=False)
-                    message_role = data["message"]["author"]["role"]
-                    message_status = data["message"]["status"]
-                    if message_role == "assistant" and message_status == "in_progress":
-                        content = data["message"]["content"]["parts"][0]
-                        if not len(content):
+                if event.is_done:
+                    content_type = "Finished"
+                    delta_content = ""
+                    logger.success("\n[Finished]")
+                    is_finished = True
+                else:
+                    content_type = "Completions"
+                    delta_content = ""
+                    try:
+                        delta_content = extractor.extract(event.data)
+                        if delta_content is None:
                             continue
-                        delta_content = content[content_offset:]
-                        content_offset = len(content)
                         if verbose:
                             logger.success(delta_content, end="")
-                    else:
-                        continue
-                except Exception as e:
-                    logger.warn(e)
+                    except Exception as e:
+                        delta_content = ""
+                        logger.warn(e)
 
-            output = self.message_outputer.output(
-                content=delta_content, content_type=content_type
-            )
-            yield output
+                output = self.message_outputer.output(
+                    content=delta_content, content_type=content_type
+                )
+                yield output
+        finally:
+            # also run if the generator is closed early, on client disconnect
+            stream_response.close()
 
         if not is_finished:
             yield self.message_outputer.output(content="", content_type="Finished")
@@ -1,12 +1,82 @@
+import argparse
 import base64
 from hashlib import sha3_512
 import json
+import multiprocessing
+import os
 import random
+import threading
+import time
 
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from datetime import datetime, timedelta, timezone
 
+from constants.envs import get_config
 from constants.headers import OPENAI_GET_HEADERS
 
+MAX_ITERATIONS = 100000
+
+PROCESS_POOL = None
+PROCESS_POOL_LOCK = threading.Lock()
+
+
+def get_process_pool(processes: int) -> ProcessPoolExecutor:
+    global PROCESS_POOL
+    with PROCESS_POOL_LOCK:
+        if PROCESS_POOL is None:
+            # the pool is created from a thread of the server, and forking
+            # a multi-threaded process (uvicorn, tokenizers) can deadlock children
+            if "forkserver" in multiprocessing.get_all_start_methods():
+                mp_context = multiprocessing.get_context("forkserver")
+            else:
+                mp_context = multiprocessing.get_context("spawn")
+            PROCESS_POOL = ProcessPoolExecutor(
+                max_workers=processes, mp_context=mp_context
+            )
+        return PROCESS_POOL
+
+
+def shutdown_process_pool():
+    global PROCESS_POOL
+    with PROCESS_POOL_LOCK:
+        pool, PROCESS_POOL = PROCESS_POOL, None
+    if pool is not None:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def solve_range(
+    seed: str, difficulty: str, prefix: bytes, suffix: bytes, start: int, end: int
+):
+    """
+    Search counters in [start, end) for the proof token.
+    * The json string is `prefix + str(counter) + suffix`,
+      so only the bytes around the counter are base64-encoded per iteration,
+      and the sha3 state of `seed + b64(prefix)` is computed only once
+    """
+    diff_len = len(difficulty) // 2
+    digest_len = (diff_len + 1) // 2
+
+    # split prefix at a 3-byte boundary, so that its head encodes independently
+    head_len = len(prefix) // 3 * 3
+    prefix_b64 = base64.b64encode(prefix[:head_len])
+    prefix_tail = prefix[head_len:]
+    # the suffix is re-aligned by 0/1/2 bytes, depending on the counter length
+    suffix_b64s = [base64.b64encode(suffix[k:]) for k in range(3)]
+
+    seed_hasher = sha3_512(seed.encode() + prefix_b64)
+    b64encode = base64.b64encode
+
+    for i in range(start, end):
+        middle = prefix_tail + str(i).encode()
+        k = -len(middle) % 3
+        middle_b64 = b64encode(middle + suffix[:k])
+        hasher = seed_hasher.copy()
+        hasher.update(middle_b64)
+        hasher.update(suffix_b64s[k])
+        if hasher.digest()[:digest_len].hex()[:diff_len] <= difficulty:
+            return (prefix_b64 + middle_b64 + suffix_b64s[k]).decode()
+    return None
+
 
 class ProofWorker:
     def __init__(self, difficulty=None, required=False, seed=None):
@@ -35,27 +105,107 @@ class ProofWorker:
             OPENAI_GET_HEADERS["User-Agent"],
         ]
 
-    def calc_proof_token(self, seed: str, difficulty: str):
+    def get_config_prefix_suffix(self):
+        # json.dumps(config) == prefix + str(config[3]) + suffix
         config = self.get_config()
-        diff_len = len(difficulty) // 2
-        for i in range(100000):
-            config[3] = i
-            json_str = json.dumps(config)
-            base = base64.b64encode(json_str.encode()).decode()
-            hasher = sha3_512()
-            hasher.update((seed + base).encode())
-            hash = hasher.digest().hex()
-            if hash[:diff_len] <= difficulty:
-                return "gAAAAAB" + base
+        prefix = json.dumps(config[:3])[:-1] + ", "
+        suffix = ", " + json.dumps(config[4:])[1:]
+        return prefix.encode(), suffix.encode()
+
+    def search(self, seed: str, difficulty: str, processes: int = 1):
+        prefix, suffix = self.get_config_prefix_suffix()
+        if processes <= 1:
+            return solve_range(seed, difficulty, prefix, suffix, 0, MAX_ITERATIONS)
+
+        pool = get_process_pool(processes)
+        chunk_size = get_config("proof_worker_chunk_size", 5000)
+        pending = {
+            pool.submit(
+                solve_range,
+                seed,
+                difficulty,
+                prefix,
+                suffix,
+                start,
+                min(start + chunk_size, MAX_ITERATIONS),
+            )
+            for start in range(0, MAX_ITERATIONS, chunk_size)
+        }
+        base = None
+        while pending and base is None:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                base = base or future.result()
+        # chunks not started yet are cancelled, running ones are short
+        for future in pending:
+            future.cancel()
+        return base
+
+    def calc_proof_token(self, seed: str, difficulty: str, processes: int = None):
+        if processes is None:
+            processes = get_config("proof_worker_processes", 0)
+        base = self.search(seed, difficulty, processes=processes)
+        if base:
+            return "gAAAAAB" + base
         self.proof_token = (
             self.proof_token_prefix + base64.b64encode(seed.encode()).decode()
         )
         return self.proof_token
 
 
-if __name__ == "__main__":
-    seed, difficulty = "0.42665582693491433", "05cdf2"
+def calc_proof_token_baseline(worker: ProofWorker, seed: str, difficulty: str, n: int):
+    # the original per-iteration json.dumps + b64 + sha3, kept as benchmark reference
+    config = worker.get_config()
+    diff_len = len(difficulty) // 2
+    for i in range(n):
+        config[3] = i
+        json_str = json.dumps(config)
+        base = base64.b64encode(json_str.encode()).decode()
+        hasher = sha3_512()
+        hasher.update((seed + base).encode())
+        hash = hasher.digest().hex()
+        if hash[:diff_len] <= difficulty:
+            return "gAAAAAB" + base
+    return None
+
+
+def benchmark(n: int = MAX_ITERATIONS, processes: int = 0):
+    seed = "0.42665582693491433"
+    # no hex digest is lexicographically <= "!", so the full range is searched
+    unreachable_difficulty = "!" * 6
     worker = ProofWorker()
-    proof_token = worker.calc_proof_token(seed, difficulty)
-    print(f"proof_token: {proof_token}")
+    prefix, suffix = worker.get_config_prefix_suffix()
+
+    t1 = time.perf_counter()
+    calc_proof_token_baseline(worker, seed, unreachable_difficulty, n)
+    t2 = time.perf_counter()
+    solve_range(seed, unreachable_difficulty, prefix, suffix, 0, n)
+    t3 = time.perf_counter()
+    print(f"baseline: {n / (t2 - t1):>12,.0f} hashes/sec")
+    print(f"fast    : {n / (t3 - t2):>12,.0f} hashes/sec")
+
+    if processes > 1:
+        # first run spawns the process pool, only the warm run is reported
+        worker.search(seed, unreachable_difficulty, processes=processes)
+        t4 = time.perf_counter()
+        worker.search(seed, unreachable_difficulty, processes=processes)
+        t5 = time.perf_counter()
+        print(f"fast x{processes}: {MAX_ITERATIONS / (t5 - t4):>12,.0f} hashes/sec")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-b", "--benchmark", action="store_true")
+    parser.add_argument("-n", "--iterations", type=int, default=MAX_ITERATIONS)
+    parser.add_argument("-j", "--processes", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(n=args.iterations, processes=args.processes)
+    else:
+        seed, difficulty = "0.42665582693491433", "05cdf2"
+        worker = ProofWorker()
+        proof_token = worker.calc_proof_token(seed, difficulty)
+        print(f"proof_token: {proof_token}")
     # python -m networks.proof_worker
+    # python -m networks.proof_worker -b
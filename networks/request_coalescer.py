@@ -0,0 +1,166 @@
+import asyncio
+import hashlib
+
+from tclogger import logger
+
+from constants.envs import get_config
+
+
+class Flight:
+    """
+    One upstream stream shared by all concurrent identical requests.
+    * Chunks are buffered, so late subscribers replay from the first chunk
+    * The upstream is cancelled once every subscriber has left,
+      and the flight is not joined anymore from then on
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self.chunks = []
+        self.subscribers = 0
+        self.is_done = False
+        self.is_cancelling = False
+        self.error = None
+        self.task = None
+        self.opened = asyncio.get_running_loop().create_future()
+        self.changed = asyncio.Event()
+
+    def notify(self):
+        # waiters hold the old event, so a fresh one is used for the next change
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def run(self, open_stream):
+        try:
+            generator = await open_stream()
+        except BaseException as e:
+            self.opened.set_exception(e)
+            self.error = e
+            self.is_done = True
+            self.notify()
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            return
+        self.opened.set_result(True)
+        try:
+            async for chunk in generator:
+                self.chunks.append(chunk)
+                self.notify()
+        except asyncio.CancelledError as e:
+            self.error = e
+            raise
+        except Exception as e:
+            logger.warn(f"Coalesced stream failed: {e}")
+            self.error = e
+        finally:
+            self.is_done = True
+            self.notify()
+
+    async def wait_opened(self):
+        await asyncio.shield(self.opened)
+
+    async def iterate(self):
+        idx = 0
+        while True:
+            if idx < len(self.chunks):
+                yield self.chunks[idx]
+                idx += 1
+            elif self.is_done:
+                if self.error:
+                    raise self.error
+                return
+            else:
+                await self.changed.wait()
+
+    def leave(self):
+        self.subscribers -= 1
+        if self.subscribers <= 0 and not self.is_done and self.task:
+            # the task ends later, so new requests must not join in the meantime
+            self.is_cancelling = True
+            self.task.cancel()
+
+
+class Subscription:
+    """
+    One request subscribed to a flight, counted from `join()` until `leave()`.
+    * `leave()` is idempotent, so requests also call it when they end
+      before iterating `chunks()`, e.g. on timeouts or early client disconnects
+    """
+
+    def __init__(self, flight: Flight):
+        self.flight = flight
+        self.is_left = False
+
+    async def chunks(self):
+        try:
+            async for chunk in self.flight.iterate():
+                yield chunk
+        finally:
+            self.leave()
+
+    def leave(self):
+        if not self.is_left:
+            self.is_left = True
+            self.flight.leave()
+
+
+class RequestCoalescer:
+    """
+    Single-flight coalescing of identical in-flight completion requests.
+    * Enabled by `request_coalescing`, for the models in
+      `request_coalescing_models` (all models if empty)
+    * Requests are keyed like the response cache, plus the HF token,
+      and only those with `use_cache` are shared, as upstreams always sample
+    """
+
+    def __init__(self):
+        self.flights = {}
+        self.leaders = 0
+        self.followers = 0
+
+    def is_coalescable(self, model: str, use_cache: bool) -> bool:
+        if not get_config("request_coalescing", False):
+            return False
+        models = get_config("request_coalescing_models", [])
+        if models and model not in models:
+            return False
+        return bool(use_cache)
+
+    def get_key(self, request_key: str, api_key: str = None) -> str:
+        # requests with different HF tokens never share an upstream stream
+        token_hash = ""
+        if api_key:
+            token_hash = hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+        return f"{request_key}:{token_hash}"
+
+    def join(self, key: str, open_stream) -> Subscription:
+        """
+        `open_stream()` is an async function returning an async generator of chunks,
+        it is only called by the first request of a key.
+        """
+        flight = self.flights.get(key)
+        if flight is None or flight.is_done or flight.is_cancelling:
+            flight = Flight(key)
+            self.flights[key] = flight
+            flight.task = asyncio.create_task(flight.run(open_stream))
+            flight.task.add_done_callback(lambda task: self.remove(flight))
+            self.leaders += 1
+        else:
+            self.followers += 1
+        flight.subscribers += 1
+        return Subscription(flight)
+
+    def remove(self, flight: Flight):
+        if self.flights.get(flight.key) is flight:
+            self.flights.pop(flight.key)
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self.flights),
+            "subscribers": sum(flight.subscribers for flight in self.flights.values()),
+            "upstream_calls": self.leaders,
+            "upstream_calls_saved": self.followers,
+        }
+
+
+REQUEST_COALESCER = RequestCoalescer()
@@ -0,0 +1,184 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+from collections import OrderedDict
+
+from tclogger import logger
+
+from constants.envs import get_config
+
+
+class ResponseCache:
+    """
+    Exact-match cache of completion contents.
+    * Keyed by (model, merged prompt, temperature, top_p, max_tokens)
+    * In-memory LRU tier, bounded by `response_cache_max_entries` and
+      `response_cache_max_bytes`, plus an optional SQLite tier at
+      `response_cache_sqlite_path`
+    * Entries expire after `response_cache_ttl` seconds
+    """
+
+    def __init__(self):
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        self.lock = threading.Lock()
+        self.db = None
+        self.db_path = None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    @property
+    def enabled(self) -> bool:
+        return get_config("response_cache", False)
+
+    @property
+    def ttl(self) -> float:
+        return get_config("response_cache_ttl", 3600)
+
+    def is_cacheable(self, use_cache: bool) -> bool:
+        if not self.enabled:
+            return False
+        # upstreams always sample, temperature 0 is raised to 0.01 for TGI,
+        # so only requests opting in with `use_cache` are cached
+        return bool(use_cache)
+
+    def get_key(
+        self,
+        model: str,
+        prompt: str,
+        temperature: float = None,
+        top_p: float = None,
+        max_tokens: int = None,
+    ) -> str:
+        if max_tokens is None or max_tokens <= 0:
+            max_tokens = -1
+        normalized = [
+            model,
+            prompt,
+            None if temperature is None else round(max(temperature, 0.0), 4),
+            None if top_p is None else round(top_p, 4),
+            max_tokens,
+        ]
+        key_str = json.dumps(normalized, ensure_ascii=False)
+        return hashlib.sha256(key_str.encode("utf-8")).hexdigest()
+
+    def get_db(self):
+        db_path = get_config("response_cache_sqlite_path", "")
+        if not db_path:
+            return None
+        if self.db is None or self.db_path != db_path:
+            self.db = sqlite3.connect(db_path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, content TEXT, created_at REAL)"
+            )
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS responses_created_at "
+                "ON responses (created_at)"
+            )
+            self.db.commit()
+            self.db_path = db_path
+        return self.db
+
+    def get_from_disk(self, key: str):
+        db = self.get_db()
+        if db is None:
+            return None
+        row = db.execute(
+            "SELECT content, created_at FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        content, created_at = row
+        if time.time() - created_at >= self.ttl:
+            db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            db.commit()
+            return None
+        return content, created_at
+
+    def put_to_memory(self, key: str, content: str, created_at: float):
+        max_entries = get_config("response_cache_max_entries", 1024)
+        max_bytes = get_config("response_cache_max_bytes", 64 * 1024 * 1024)
+        if key in self.memory:
+            self.memory_bytes -= self.memory.pop(key)[2]
+        size = len(content.encode("utf-8"))
+        self.memory[key] = (content, created_at, size)
+        self.memory_bytes += size
+        while self.memory and (
+            len(self.memory) > max_entries or self.memory_bytes > max_bytes
+        ):
+            _, (_, _, old_size) = self.memory.popitem(last=False)
+            self.memory_bytes -= old_size
+
+    def get(self, key: str):
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry and now - entry[1] >= self.ttl:
+                self.memory.pop(key)
+                self.memory_bytes -= entry[2]
+                entry = None
+            if entry:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            try:
+                entry = self.get_from_disk(key)
+            except sqlite3.Error as e:
+                logger.warn(f"Response cache: {e}")
+                entry = None
+            if entry:
+                self.put_to_memory(key, *entry)
+                self.hits += 1
+                self.disk_hits += 1
+                return entry[0]
+            self.misses += 1
+            return None
+
+    def set(self, key: str, content: str):
+        if not content:
+            return
+        now = time.time()
+        with self.lock:
+            self.put_to_memory(key, content, now)
+            self.stores += 1
+            try:
+                db = self.get_db()
+                if db is not None:
+                    db.execute(
+                        "INSERT OR REPLACE INTO responses VALUES (?, ?, ?)",
+                        (key, content, now),
+                    )
+                    max_rows = get_config("response_cache_sqlite_max_entries", 100000)
+                    db.execute(
+                        "DELETE FROM responses WHERE created_at < ? OR key IN ("
+                        "SELECT key FROM responses ORDER BY created_at DESC "
+                        "LIMIT -1 OFFSET ?)",
+                        (now - self.ttl, max_rows),
+                    )
+                    db.commit()
+            except sqlite3.Error as e:
+                logger.warn(f"Response cache: {e}")
+
+    def stats(self) -> dict:
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "entries": len(self.memory),
+                "bytes": self.memory_bytes,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "stores": self.stores,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            }
+
+
+RESPONSE_CACHE = ResponseCache()
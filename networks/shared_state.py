@@ -0,0 +1,127 @@
+import json
+import sqlite3
+import threading
+import time
+
+from tclogger import logger
+
+from constants.envs import get_config
+
+
+class SharedQueues:
+    """
+    Named FIFO queues in a SQLite (WAL) file, shared by the worker processes.
+    * Enabled by `shared_state_path`, which must be on a local disk,
+      in a directory only writable by the server user
+    * Items are JSON dicts, never pickles, as anyone who can write the file
+      could make a pickle run code in the server
+    * Items are popped at most once across processes,
+      items older than `ttl` are skipped and deleted
+    """
+
+    def __init__(self):
+        self.db = None
+        self.db_path = None
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(get_config("shared_state_path", ""))
+
+    def get_db(self):
+        db_path = get_config("shared_state_path", "")
+        if self.db is None or self.db_path != db_path:
+            # autocommit, transactions are explicit
+            self.db = sqlite3.connect(
+                db_path, timeout=10, isolation_level=None, check_same_thread=False
+            )
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS queue_items ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "name TEXT, item TEXT, created_at REAL)"
+            )
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS queue_items_name ON queue_items (name, id)"
+            )
+            self.db_path = db_path
+        return self.db
+
+    def push(self, name: str, item: dict, created_at: float = None):
+        if created_at is None:
+            created_at = time.time()
+        with self.lock:
+            self.get_db().execute(
+                "INSERT INTO queue_items (name, item, created_at) VALUES (?, ?, ?)",
+                (name, json.dumps(item), created_at),
+            )
+
+    def pop(self, name: str, ttl: float):
+        """
+        Returns `(item, expired_count)`, item is None if no fresh one is queued.
+        """
+        min_created_at = time.time() - ttl
+        with self.lock:
+            db = self.get_db()
+            # the write lock is taken at once, so two processes never pop the same row
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                expired = db.execute(
+                    "DELETE FROM queue_items WHERE name = ? AND created_at <= ?",
+                    (name, min_created_at),
+                ).rowcount
+                row = db.execute(
+                    "SELECT id, item FROM queue_items WHERE name = ? "
+                    "ORDER BY id LIMIT 1",
+                    (name,),
+                ).fetchone()
+                if row:
+                    db.execute("DELETE FROM queue_items WHERE id = ?", (row[0],))
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None, expired
+        try:
+            return json.loads(row[1]), expired
+        except (TypeError, ValueError) as e:
+            logger.warn(f"Shared queue [{name}]: {e}")
+            return None, expired
+
+    def count(self, name: str, ttl: float) -> int:
+        min_created_at = time.time() - ttl
+        with self.lock:
+            return (
+                self.get_db()
+                .execute(
+                    "SELECT COUNT(*) FROM queue_items WHERE name = ? AND created_at > ?",
+                    (name, min_created_at),
+                )
+                .fetchone()[0]
+            )
+
+    def sweep(self, prefix: str, ttl: float) -> int:
+        min_created_at = time.time() - ttl
+        with self.lock:
+            return (
+                self.get_db()
+                .execute(
+                    "DELETE FROM queue_items "
+                    "WHERE substr(name, 1, ?) = ? AND created_at <= ?",
+                    (len(prefix), prefix, min_created_at),
+                )
+                .rowcount
+            )
+
+    def counts(self, prefix: str) -> dict:
+        with self.lock:
+            rows = self.get_db().execute(
+                "SELECT name, COUNT(*) FROM queue_items WHERE substr(name, 1, ?) = ? "
+                "GROUP BY name",
+                (len(prefix), prefix),
+            )
+            return {name[len(prefix) :]: count for name, count in rows}
+
+
+SHARED_QUEUES = SharedQueues()
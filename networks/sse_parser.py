@@ -0,0 +1,159 @@
+import json
+
+DONE_DATA = b"[DONE]"
+
+
+class SSEEvent:
+    __slots__ = ("data", "event", "id")
+
+    def __init__(self, data: bytes, event: str = "message", id: str = None):
+        self.data = data
+        self.event = event
+        self.id = id
+
+    @property
+    def is_done(self) -> bool:
+        return self.data.strip() == DONE_DATA
+
+    def __repr__(self) -> str:
+        return f"SSEEvent(event={self.event!r}, data={self.data!r})"
+
+
+class SSEParser:
+    """
+    Incremental Server-Sent Events parser working on raw byte chunks.
+    * https://html.spec.whatwg.org/multipage/server-sent-events.html#event-stream-interpretation
+    * Lines may end with CRLF, LF or CR, and may be split across chunks
+    * Multi-line `data:` fields are joined with LF, events end at a blank line
+    * Bare json lines (starting with `{`) are not SSE fields, but some upstreams
+      send them (HuggingChat streams, error bodies), so each is emitted as an event
+    """
+
+    def __init__(self):
+        self.pending = []
+        self.data_lines = []
+        self.event = ""
+        self.last_id = None
+
+    def feed(self, chunk: bytes) -> list[SSEEvent]:
+        events = []
+        if not chunk:
+            return events
+        # keep incomplete lines as pieces, to avoid re-copying long lines per chunk
+        if not (b"\n" in chunk or b"\r" in chunk):
+            self.pending.append(chunk)
+            return events
+        if self.pending:
+            self.pending.append(chunk)
+            chunk = b"".join(self.pending)
+            self.pending = []
+
+        lines = chunk.splitlines(keepends=True)
+        last_line = lines[-1]
+        # a trailing CR might be the first half of a CRLF in the next chunk
+        if not last_line.endswith(b"\n"):
+            self.pending.append(lines.pop())
+
+        for line in lines:
+            self.process_line(line.rstrip(b"\r\n"), events)
+        return events
+
+    def flush(self) -> list[SSEEvent]:
+        events = []
+        if self.pending:
+            line = b"".join(self.pending)
+            self.pending = []
+            for sub_line in line.splitlines():
+                self.process_line(sub_line, events)
+        self.dispatch(events)
+        return events
+
+    def dispatch(self, events: list):
+        if self.data_lines:
+            data = b"\n".join(self.data_lines)
+            events.append(SSEEvent(data, self.event or "message", self.last_id))
+        self.data_lines = []
+        self.event = ""
+
+    def process_line(self, line: bytes, events: list):
+        if not line:
+            self.dispatch(events)
+            return
+        first_byte = line[:1]
+        if first_byte == b":":
+            return
+        if first_byte == b"{":
+            self.dispatch(events)
+            events.append(SSEEvent(line))
+            return
+
+        field, sep, value = line.partition(b":")
+        if sep and value[:1] == b" ":
+            value = value[1:]
+        if field == b"data":
+            self.data_lines.append(value)
+        elif field == b"event":
+            self.event = value.decode("utf-8")
+        elif field == b"id":
+            self.last_id = value.decode("utf-8")
+        # `retry` and unknown fields are ignored
+
+
+def iter_sse_events(chunks):
+    parser = SSEParser()
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+    yield from parser.flush()
+
+
+async def aiter_sse_events(chunks):
+    parser = SSEParser()
+    async for chunk in chunks:
+        for event in parser.feed(chunk):
+            yield event
+    for event in parser.flush():
+        yield event
+
+
+def find_string_field(data: bytes, key: bytes, start: int = 0):
+    """
+    Locate the json string value of `"key":` in `data`, without a full parse.
+    * Returns (value, end) with `end` after the closing quote, or None when
+      the key is missing or its value is not a string
+    * An unescaped `"key":` cannot occur inside a json string, as the quotes
+      would be escaped there
+    """
+    pattern = b'"' + key + b'":'
+    idx = data.find(pattern, start)
+    if idx < 0:
+        return None
+    idx += len(pattern)
+    length = len(data)
+    while idx < length and data[idx] in b" \t":
+        idx += 1
+    if idx >= length or data[idx] != 0x22:  # '"'
+        return None
+
+    begin = idx + 1
+    end = data.find(b'"', begin)
+    has_escape = False
+    while end >= 0:
+        # count preceding backslashes, an odd count means the quote is escaped
+        backslashes = 0
+        pos = end - 1
+        while pos >= begin and data[pos] == 0x5C:  # '\\'
+            backslashes += 1
+            pos -= 1
+        if backslashes % 2 == 0:
+            break
+        has_escape = True
+        end = data.find(b'"', end + 1)
+    if end < 0:
+        return None
+
+    raw = data[begin:end]
+    if has_escape or b"\\" in raw:
+        value = json.loads(data[begin - 1 : end + 1], strict=False)
+    else:
+        value = raw.decode("utf-8")
+    return value, end + 1
@@ -0,0 +1,255 @@
+import anyio
+import asyncio
+import hashlib
+import math
+import time
+
+from collections import deque
+
+from tclogger import logger
+
+from constants.envs import get_config
+from metrics.chat_metrics import HEDGED_REQUESTS_TOTAL
+
+SSE_EVENT_ENDS = (b"\n\n", b"\r\n\r\n")
+
+
+class ReplayResponse:
+    """
+    Stream response whose first chunks were already read, to detect the first token.
+    * `aiter_bytes()` replays them, then continues the upstream stream
+    """
+
+    def __init__(self, response, chunks: list[bytes], iterator):
+        self.response = response
+        self.chunks = chunks
+        self.iterator = iterator
+        self.status_code = response.status_code
+        self.headers = response.headers
+
+    async def aiter_bytes(self):
+        for chunk in self.chunks:
+            yield chunk
+        self.chunks = []
+        async for chunk in self.iterator:
+            yield chunk
+
+    async def aclose(self):
+        await self.response.aclose()
+
+
+class UpstreamStats:
+    def __init__(self, url: str):
+        self.url = url
+        # URLs can hold hosts or credentials, so stats only show their hash
+        self.name = "upstream-" + hashlib.sha1(url.encode("utf-8")).hexdigest()[:8]
+        self.requests = 0
+        self.errors = 0
+        self.ttft_ewma = None
+        self.error_ewma = 0.0
+        self.ttfts = deque(maxlen=get_config("upstream_ttft_window", 200))
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def observe(self, ttft: float = None, is_error: bool = False):
+        alpha = get_config("upstream_ewma_alpha", 0.2)
+        self.requests += 1
+        if is_error:
+            self.errors += 1
+        self.error_ewma += alpha * (float(is_error) - self.error_ewma)
+        if ttft is not None:
+            if self.ttft_ewma is None:
+                self.ttft_ewma = ttft
+            else:
+                self.ttft_ewma += alpha * (ttft - self.ttft_ewma)
+
+    def observe_ttft(self, ttft: float):
+        self.ttfts.append(ttft)
+        self.observe(ttft=ttft)
+
+    def observe_censored(self, elapsed: float):
+        # a cancelled attempt only tells that its TTFT is above `elapsed`,
+        # so the EWMA is only raised by it, and the TTFT window is left out
+        alpha = get_config("upstream_ewma_alpha", 0.2)
+        self.requests += 1
+        if self.ttft_ewma is None:
+            self.ttft_ewma = elapsed
+        elif elapsed > self.ttft_ewma:
+            self.ttft_ewma += alpha * (elapsed - self.ttft_ewma)
+
+    def score(self) -> float:
+        # expected seconds to a successful first token, untried upstreams go first
+        if self.ttft_ewma is None:
+            return 0.0
+        return self.ttft_ewma / max(1.0 - self.error_ewma, 0.05)
+
+    def ttft_percentile(self, p: float) -> float:
+        # nearest-rank percentile
+        values = sorted(self.ttfts)
+        rank = max(math.ceil(p / 100 * len(values)), 1)
+        return values[rank - 1]
+
+    def stats(self) -> dict:
+        stats = {
+            "requests": self.requests,
+            "errors": self.errors,
+            "error_rate_ewma": round(self.error_ewma, 4),
+            "ttft_ewma": round(self.ttft_ewma, 4) if self.ttft_ewma else None,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+        }
+        if self.ttfts:
+            stats["ttft_p50"] = round(self.ttft_percentile(50), 4)
+            stats["ttft_p95"] = round(self.ttft_percentile(95), 4)
+        return stats
+
+
+class UpstreamRouter:
+    """
+    Latency-aware routing and hedging of TGI streams, over the upstreams of a model.
+    * Upstreams are the HF Inference API and the TGI URLs in `tgi_upstreams[model]`,
+      the primary has the lowest EWMA TTFT, scaled by its EWMA error rate
+    * With `upstream_hedging`, if the primary sends no token within
+      the `upstream_hedge_percentile` of its recent TTFTs, a duplicate request
+      is sent to the next upstream (or the same one, if it is the only one)
+    * The first stream with a token wins, and the other one is cancelled
+    * Hedges are at most `upstream_hedge_max_ratio` of requests
+    * `stats()` names upstreams by the hash of their URL, as `/stats` is public
+    """
+
+    def __init__(self):
+        self.upstreams = {}
+        self.requests = 0
+        self.hedges = 0
+
+    def get_urls(self, model: str, default_url: str) -> list[str]:
+        alternates = get_config("tgi_upstreams", {}).get(model, [])
+        return [default_url] + [url for url in alternates if url != default_url]
+
+    def get_stats(self, url: str) -> UpstreamStats:
+        if url not in self.upstreams:
+            self.upstreams[url] = UpstreamStats(url)
+        return self.upstreams[url]
+
+    def rank(self, urls: list[str]) -> list[str]:
+        # stable, so untried upstreams are tried in the configured order
+        return sorted(urls, key=lambda url: self.get_stats(url).score())
+
+    def get_hedge_delay(self, url: str) -> float:
+        stats = self.get_stats(url)
+        if len(stats.ttfts) < get_config("upstream_hedge_min_samples", 20):
+            return get_config("upstream_hedge_delay", 2.0)
+        percentile = get_config("upstream_hedge_percentile", 95.0)
+        return max(
+            stats.ttft_percentile(percentile),
+            get_config("upstream_hedge_min_delay", 0.05),
+        )
+
+    def is_hedge_allowed(self) -> bool:
+        max_ratio = get_config("upstream_hedge_max_ratio", 0.1)
+        return self.hedges < self.requests * max_ratio + 1
+
+    async def read_first_event(self, response):
+        chunks = []
+        iterator = response.aiter_bytes()
+        async for chunk in iterator:
+            chunks.append(chunk)
+            # events are small, so the buffer is only joined until the first one
+            buffer = b"".join(chunks)
+            if any(end in buffer for end in SSE_EVENT_ENDS):
+                break
+        return ReplayResponse(response, chunks, iterator)
+
+    async def attempt(self, url: str, send):
+        """
+        Returns a `ReplayResponse` after the first event, or the failed response.
+        """
+        stats = self.get_stats(url)
+        started_at = time.perf_counter()
+        response = None
+        try:
+            response = await send(url)
+            if response.status_code != 200:
+                stats.observe(is_error=True)
+                return response
+            replay = await self.read_first_event(response)
+            stats.observe_ttft(time.perf_counter() - started_at)
+            return replay
+        except asyncio.CancelledError:
+            # the loser of a hedge, its elapsed time is a lower bound of its TTFT
+            stats.observe_censored(time.perf_counter() - started_at)
+            await self.close(response)
+            raise
+        except Exception:
+            stats.observe(is_error=True)
+            await self.close(response)
+            raise
+
+    async def close(self, response):
+        if response is not None:
+            # shielded, as awaits in a cancelled scope raise at once
+            with anyio.CancelScope(shield=True):
+                await response.aclose()
+
+    def is_success(self, task: asyncio.Task) -> bool:
+        return not task.exception() and task.result().status_code == 200
+
+    async def open(self, model: str, urls: list[str], send, send_hedge=None):
+        """
+        `send(url)` is an async function returning a stream response,
+        `send_hedge(url)` is used for the hedged request, defaults to `send`.
+        """
+        self.requests += 1
+        urls = self.rank(urls)
+        primary = urls[0]
+        hedge_url = urls[1] if len(urls) > 1 else primary
+        tasks = {asyncio.create_task(self.attempt(primary, send))}
+        hedge_task = None
+        try:
+            if get_config("upstream_hedging", False):
+                done, _ = await asyncio.wait(
+                    tasks, timeout=self.get_hedge_delay(primary)
+                )
+                if not done and self.is_hedge_allowed():
+                    self.hedges += 1
+                    self.get_stats(hedge_url).hedges += 1
+                    logger.note(f"> Hedging [{model}] to: {hedge_url}")
+                    hedge_task = asyncio.create_task(
+                        self.attempt(hedge_url, send_hedge or send)
+                    )
+                    tasks.add(hedge_task)
+            failed = []
+            while tasks:
+                done, tasks = await asyncio.wait(
+                    tasks, return_when=asyncio.FIRST_COMPLETED
+                )
+                winner = next((task for task in done if self.is_success(task)), None)
+                failed.extend(task for task in done if task is not winner)
+                if winner:
+                    break
+            if hedge_task:
+                result = "won" if winner is hedge_task else "lost"
+                HEDGED_REQUESTS_TOTAL.labels(model, "huggingface", result).inc()
+                if winner is hedge_task:
+                    self.get_stats(hedge_url).hedge_wins += 1
+            # no success, the first failure is returned or raised as before
+            result_task = winner or failed[0]
+            for task in failed:
+                if task is not result_task and not task.exception():
+                    await self.close(task.result())
+            return result_task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "hedges": self.hedges,
+            "upstreams": {
+                stats.name: stats.stats() for stats in self.upstreams.values()
+            },
+        }
+
+
+UPSTREAM_ROUTER = UpstreamRouter()
@@ -0,0 +1,57 @@
+import socket
+import threading
+import time
+
+import pytest
+import uvicorn
+
+from benchmarks.fake_upstream import FakeUpstream
+from constants.models import MODEL_MAP
+from messagers.tokenizer_registry import TOKENIZER_REGISTRY
+
+
+class FakeTokenizer:
+    """
+    Whitespace tokenizer, so that tests do not download tokenizers.
+    """
+
+    chat_template = None
+    special_tokens_map = {}
+
+    def encode(self, text: str, add_special_tokens: bool = True) -> list[str]:
+        tokens = text.split()
+        if add_special_tokens:
+            tokens = ["<s>"] + tokens
+        return tokens
+
+
+@pytest.fixture
+def fake_tokenizers(monkeypatch):
+    for model in MODEL_MAP.keys():
+        name = TOKENIZER_REGISTRY.get_tokenizer_name(model)
+        monkeypatch.setitem(TOKENIZER_REGISTRY.tokenizers, name, FakeTokenizer())
+
+
+def get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture(scope="module")
+def fake_upstream():
+    """
+    `benchmarks.fake_upstream` served on a local port, yields `(upstream, url)`.
+    """
+    upstream = FakeUpstream(ttft_ms=50, token_ms=5, tokens=8)
+    port = get_free_port()
+    server = uvicorn.Server(
+        uvicorn.Config(upstream.app, host="127.0.0.1", port=port, log_level="error")
+    )
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    yield upstream, f"http://127.0.0.1:{port}"
+    server.should_exit = True
+    thread.join(timeout=5)
@@ -0,0 +1,239 @@
+import asyncio
+import json
+import threading
+import time
+
+import httpx
+import pytest
+
+from metrics.chat_metrics import (
+    TOKENIZER_POOL_EXEC_SECONDS,
+    TOKENIZER_POOL_WAIT_SECONDS,
+)
+from networks.huggingface_streamer import HuggingfaceStreamer
+from networks.response_cache import ResponseCache
+
+
+@pytest.fixture
+def chat_api_app():
+    from apis.chat_api import ChatAPIApp
+
+    return ChatAPIApp()
+
+
+@pytest.mark.parametrize(
+    "model, is_off_loop",
+    [
+        ("gpt-3.5-turbo", True),
+        ("command-r-plus", True),
+        ("nous-mixtral-8x7b", False),
+    ],
+)
+def test_streamers_with_blocking_setup_are_built_off_the_loop(
+    chat_api_app, monkeypatch, model, is_off_loop
+):
+    threads = []
+
+    def get_streamer(model: str):
+        threads.append(threading.current_thread())
+        return HuggingfaceStreamer(model=model)
+
+    monkeypatch.setattr(chat_api_app, "get_streamer", get_streamer)
+
+    async def main():
+        await chat_api_app.create_streamer(model)
+        return threading.current_thread()
+
+    loop_thread = asyncio.run(main())
+    assert (threads[0] is not loop_thread) == is_off_loop
+
+
+@pytest.fixture
+def chat_api(fake_upstream, fake_tokenizers, monkeypatch):
+    import apis.chat_api as chat_api
+
+    upstream, url = fake_upstream
+    monkeypatch.setenv("huggingface_api_base", url)
+    monkeypatch.setenv("response_cache", "false")
+    monkeypatch.setenv("request_coalescing", "false")
+    return chat_api, upstream
+
+
+def post_completions(chat_api, payload: dict, headers: dict = None):
+    async def main():
+        transport = httpx.ASGITransport(app=chat_api.app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://test", timeout=30
+        ) as client:
+            try:
+                return await client.post(
+                    "/chat/completions",
+                    headers={"Authorization": "Bearer sk-test", **(headers or {})},
+                    json=payload,
+                )
+            finally:
+                await chat_api.ASYNC_CLIENT_POOL.aclose()
+
+    return asyncio.run(main())
+
+
+PAYLOAD = {
+    "model": "nous-mixtral-8x7b",
+    "messages": [{"role": "user", "content": "Hello"}],
+    "stream": False,
+}
+
+
+def test_context_window_fitter_is_built_in_the_tokenizer_pool(chat_api, monkeypatch):
+    chat_api, upstream = chat_api
+    threads = []
+    init = chat_api.ContextWindowFitter.__init__
+
+    def recorded_init(fitter, composer):
+        threads.append(threading.current_thread())
+        init(fitter, composer)
+
+    monkeypatch.setattr(chat_api.ContextWindowFitter, "__init__", recorded_init)
+    response = post_completions(chat_api, {**PAYLOAD, "truncate": True})
+    assert response.status_code == 200
+    # the event loop of `asyncio.run()` runs in the main thread
+    assert threads and threads[0] is not threading.main_thread()
+
+
+def test_tokenizer_pool_times_are_labelled_by_model_backend_and_phase(chat_api):
+    chat_api, upstream = chat_api
+    histograms = [TOKENIZER_POOL_WAIT_SECONDS, TOKENIZER_POOL_EXEC_SECONDS]
+    labels = [
+        ("nous-mixtral-8x7b", "huggingface", phase) for phase in ["compose", "tokenize"]
+    ]
+
+    def get_counts() -> list[int]:
+        return [
+            histogram.labels(*label).snapshot()["count"]
+            for histogram in histograms
+            for label in labels
+        ]
+
+    counts = get_counts()
+    # a prompt of no other test, so its token count is not cached
+    messages = [{"role": "user", "content": "Hello, labelled tokenizer pool"}]
+    response = post_completions(chat_api, {**PAYLOAD, "messages": messages})
+    assert response.status_code == 200
+    assert all(after > before for before, after in zip(counts, get_counts()))
+    stats = chat_api.TOKENIZER_POOL.stats()
+    assert "nous-mixtral-8x7b/huggingface/compose" in stats["exec_seconds"]
+
+
+@pytest.mark.parametrize(
+    "upstream_attrs, headers, status_code, upstream_status_code, finish_reason",
+    [
+        ({}, {}, 200, 200, "stop"),
+        ({"error_rate": 1.0}, {}, 503, 503, "stop"),
+        # the upstream answers with a 200, and no token before the deadline
+        ({"ttft_ms": 2000}, {"X-Request-Timeout": "0.3"}, 504, 200, "timeout"),
+    ],
+    ids=["ok", "upstream_error", "timeout"],
+)
+def test_streams_are_logged_with_how_they_ended(
+    chat_api,
+    monkeypatch,
+    upstream_attrs,
+    headers,
+    status_code,
+    upstream_status_code,
+    finish_reason,
+):
+    chat_api, upstream = chat_api
+    for name, value in upstream_attrs.items():
+        monkeypatch.setattr(upstream, name, value)
+    records = []
+    monkeypatch.setattr(chat_api.REQUEST_LOG, "log", records.append)
+    response = post_completions(chat_api, {**PAYLOAD, "stream": True}, headers)
+    assert response.status_code == 200
+    (record,) = records
+    assert record["status_code"] == status_code
+    assert record["upstream_status_code"] == upstream_status_code
+    assert record["finish_reason"] == finish_reason
+
+
+def test_cache_hits_of_streamed_responses_match_non_stream_ones(chat_api, monkeypatch):
+    chat_api, upstream = chat_api
+    monkeypatch.setenv("response_cache", "true")
+    monkeypatch.setattr(chat_api, "RESPONSE_CACHE", ResponseCache())
+    # streams keep the trailing newline, non-stream responses strip it
+    monkeypatch.setattr(upstream, "get_tokens", lambda: [" Hello", " world", "\n"])
+    payload = {**PAYLOAD, "use_cache": True}
+    expected = post_completions(chat_api, {**payload, "use_cache": False}).json()
+
+    post_completions(chat_api, {**payload, "stream": True})
+    requests_before = upstream.requests
+    response = post_completions(chat_api, payload)
+    assert upstream.requests == requests_before
+    assert response.json()["choices"] == expected["choices"]
+
+
+# the async TGI stream, and a sync stream read in a thread
+@pytest.mark.parametrize("model", ["nous-mixtral-8x7b", "command-r-plus"])
+def test_client_disconnect_closes_the_upstream_stream(
+    chat_api, fake_upstream, monkeypatch, model
+):
+    chat_api, upstream = chat_api
+    url = fake_upstream[1]
+    monkeypatch.setenv("huggingchat_api_base", url)
+    # a stream of about 4 seconds, which the client leaves after its first chunk
+    monkeypatch.setattr(upstream, "tokens", 200)
+    monkeypatch.setattr(upstream, "token_ms", 20)
+    records = []
+    monkeypatch.setattr(chat_api.REQUEST_LOG, "log", records.append)
+    body = json.dumps({**PAYLOAD, "model": model, "stream": True}).encode("utf-8")
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": "/chat/completions",
+        "raw_path": b"/chat/completions",
+        "query_string": b"",
+        "root_path": "",
+        "headers": [
+            (b"host", b"test"),
+            (b"content-type", b"application/json"),
+            (b"authorization", b"Bearer sk-test"),
+        ],
+        "client": ("127.0.0.1", 50000),
+        "server": ("test", 80),
+    }
+
+    async def main():
+        is_requested = False
+        first_chunk = asyncio.Event()
+
+        async def receive():
+            nonlocal is_requested
+            if not is_requested:
+                is_requested = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            await first_chunk.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            if message["type"] == "http.response.body" and message.get("body"):
+                first_chunk.set()
+
+        aborted_before = upstream.aborted
+        started_at = time.perf_counter()
+        try:
+            await asyncio.wait_for(chat_api.app(scope, receive, send), 5)
+            while upstream.aborted == aborted_before:
+                assert time.perf_counter() - started_at < 2
+                await asyncio.sleep(0.02)
+        finally:
+            await chat_api.ASYNC_CLIENT_POOL.aclose()
+        return time.perf_counter() - started_at
+
+    # closed long before the upstream would have finished the stream
+    assert asyncio.run(main()) < 2
+    (record,) = records
+    assert record["aborted"] is True
+    assert record["status_code"] == 499
@@ -0,0 +1,129 @@
+import pytest
+
+from constants.models import TOKEN_LIMIT_MAP, TOKEN_RESERVED
+from messagers.context_window import ContextWindowFitter
+from messagers.message_composer import MessageComposer
+from networks.exceptions import HfApiException
+
+MODEL = "nous-mixtral-8x7b"
+
+
+def build_conversation(turns: int, words: int = 1000) -> list[dict]:
+    messages = [{"role": "system", "content": "Be nice."}]
+    for turn in range(turns):
+        messages.append({"role": "user", "content": f"question{turn} " * words})
+        messages.append({"role": "assistant", "content": f"answer{turn} " * words})
+    messages.append({"role": "user", "content": "final question"})
+    return messages
+
+
+@pytest.fixture
+def fitter(fake_tokenizers):
+    return ContextWindowFitter(MessageComposer(model=MODEL))
+
+
+@pytest.fixture
+def merges(fitter, monkeypatch):
+    count = [0]
+    merge = fitter.composer.merge
+
+    def counted_merge(messages):
+        count[0] += 1
+        return merge(messages)
+
+    monkeypatch.setattr(fitter.composer, "merge", counted_merge)
+    return count
+
+
+def test_budget_reserves_new_tokens(fitter, monkeypatch):
+    limit = TOKEN_LIMIT_MAP[MODEL]
+    assert fitter.get_prompt_budget(1000) == limit - TOKEN_RESERVED - 1000
+    monkeypatch.setenv("truncation_reserved_tokens", "256")
+    assert fitter.get_prompt_budget(None) == limit - TOKEN_RESERVED - 256
+    # the prompt keeps at least half of the window
+    assert fitter.get_prompt_budget(10**6) == limit - TOKEN_RESERVED - limit // 2
+
+
+def test_fitting_conversation_is_not_truncated(fitter, merges):
+    messages = build_conversation(3, words=10)
+    prompt = fitter.fit(messages)
+    assert prompt == MessageComposer(model=MODEL).merge(messages)
+    assert (fitter.dropped_messages, fitter.dropped_tokens) == (0, 0)
+    assert merges[0] == 1
+
+
+def test_long_conversation_is_truncated_in_the_middle(fitter, merges):
+    messages = build_conversation(40)
+    prompt = fitter.fit(messages, max_tokens=1000)
+    budget = fitter.get_prompt_budget(1000)
+    assert fitter.count_merged_tokens() <= budget
+    assert fitter.dropped_messages > 0 and fitter.dropped_tokens > 0
+
+    merged_messages = fitter.composer.messages
+    assert merged_messages[0] == messages[0]
+    assert merged_messages[1]["content"] == (
+        f"[{fitter.dropped_messages} earlier messages omitted]"
+    )
+    # the window starts at a user turn, and ends with the latest message
+    assert merged_messages[2]["role"] == "user"
+    assert merged_messages[-1] == messages[-1]
+    assert merged_messages[2:] == messages[-len(merged_messages[2:]) :]
+    assert prompt == fitter.composer.merged_str
+    # one merge of the whole conversation, and one to verify the cut
+    assert merges[0] == 2
+
+
+def test_low_estimates_are_corrected_with_one_more_merge(fitter, merges, monkeypatch):
+    estimate = fitter.estimate_message_tokens
+    monkeypatch.setattr(
+        fitter, "estimate_message_tokens", lambda message: estimate(message) // 2
+    )
+    fitter.fit(build_conversation(200), max_tokens=1000)
+    assert fitter.count_merged_tokens() <= fitter.get_prompt_budget(1000)
+    assert merges[0] == 3
+
+
+def test_cut_is_corrected_until_the_prompt_fits(fitter, merges, monkeypatch):
+    estimate = fitter.estimate_message_tokens
+    # each correction cuts a little too little, so 3 cuts are needed
+    monkeypatch.setattr(
+        fitter, "estimate_message_tokens", lambda message: estimate(message) - 100
+    )
+    messages = build_conversation(200)
+    fitter.fit(messages, max_tokens=1000)
+    assert fitter.count_merged_tokens() <= fitter.get_prompt_budget(1000)
+    assert merges[0] == 4
+    assert fitter.composer.messages[-1] == messages[-1]
+
+
+def test_latest_message_alone_over_budget_is_rejected(fitter):
+    messages = [
+        {"role": "system", "content": "Be nice."},
+        {"role": "user", "content": "short"},
+        {"role": "assistant", "content": "ok"},
+        {"role": "user", "content": "word " * 40000},
+    ]
+    with pytest.raises(HfApiException) as exc_info:
+        fitter.fit(messages)
+    assert exc_info.value.status_code == 400
+    assert "Prompt is too long" in exc_info.value.detail
+
+
+def test_system_messages_over_budget_are_rejected(fitter):
+    messages = [
+        {"role": "system", "content": "rule " * 40000},
+        {"role": "user", "content": "hello"},
+    ]
+    with pytest.raises(HfApiException) as exc_info:
+        fitter.fit(messages)
+    assert exc_info.value.status_code == 400
+
+
+@pytest.mark.parametrize("model", ["mixtral-8x7b", "gemma-7b"])
+def test_templates_concatenated_by_role(fake_tokenizers, model):
+    fitter = ContextWindowFitter(MessageComposer(model=model))
+    messages = build_conversation(40)[1:]
+    fitter.fit(messages, max_tokens=500)
+    assert fitter.count_merged_tokens() <= fitter.get_prompt_budget(500)
+    assert fitter.dropped_messages > 0
+    assert fitter.composer.messages[-1]["content"].endswith("final question")
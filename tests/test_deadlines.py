@@ -0,0 +1,240 @@
+import asyncio
+import json
+import time
+
+import httpx
+import pytest
+import requests
+
+from metrics.chat_metrics import DEADLINES_EXCEEDED_TOTAL
+from networks.deadlines import Deadline, MIN_TIMEOUT, is_timeout_error
+from networks.exceptions import DeadlineExceeded
+from networks.huggingface_streamer import HuggingfaceStreamer
+
+
+@pytest.fixture
+def fake_clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "perf_counter", lambda: now[0])
+    return now
+
+
+def test_remaining_cap_and_check(fake_clock):
+    deadline = Deadline(10)
+    assert deadline.remaining() == 10
+    assert deadline.cap(30) == 10
+    assert deadline.cap(3) == 3
+    deadline.check("compose")
+
+    fake_clock[0] += 9.5
+    assert deadline.remaining() == 0.5
+    assert deadline.upstream_timeout() == (0.5, 0.5)
+    assert deadline.httpx_timeout().read == 0.5
+
+    fake_clock[0] += 1
+    assert deadline.is_expired()
+    # never a zero timeout, which would mean no timeout to curl
+    assert deadline.cap(30) == MIN_TIMEOUT
+    with pytest.raises(DeadlineExceeded) as exc_info:
+        deadline.check("compose")
+    assert exc_info.value.status_code == 504
+    assert exc_info.value.phase == "compose"
+
+
+def test_no_deadline_by_default(fake_clock, monkeypatch):
+    monkeypatch.delenv("request_timeout", raising=False)
+    deadline = Deadline()
+    assert deadline.remaining() is None
+    fake_clock[0] += 10**6
+    assert not deadline.is_expired()
+    assert deadline.cap(30) == 30
+
+
+def test_total_is_clamped_by_request_timeout_max(monkeypatch):
+    monkeypatch.setenv("request_timeout_max", "60")
+    assert Deadline(600).total == 60
+    assert Deadline(30).total == 30
+    monkeypatch.setenv("request_timeout", "120")
+    assert Deadline().total == 60
+    monkeypatch.setenv("request_timeout_max", "0")
+    assert Deadline(600).total == 600
+
+
+def test_upstream_timeouts_from_config(monkeypatch):
+    monkeypatch.setenv("upstream_connect_timeout", "2")
+    monkeypatch.setenv("upstream_first_byte_timeout", "20")
+    deadline = Deadline(0)
+    assert deadline.upstream_timeout() == (2, 20)
+    timeout = deadline.httpx_timeout()
+    assert (timeout.connect, timeout.read, timeout.pool) == (2, 20, 2)
+
+
+def test_wait_for_raises_deadline_exceeded():
+    async def main():
+        assert await Deadline(1).wait_for(asyncio.sleep(0, "done"), "token") == "done"
+        with pytest.raises(DeadlineExceeded) as exc_info:
+            await Deadline(0.05).wait_for(asyncio.sleep(1), "token")
+        assert exc_info.value.phase == "token"
+        # the shorter of the phase timeout and the time left
+        with pytest.raises(DeadlineExceeded):
+            await Deadline(0).wait_for(asyncio.sleep(1), "connect", timeout=0.05)
+
+    asyncio.run(main())
+
+
+def test_is_timeout_error_follows_chains():
+    assert is_timeout_error(asyncio.TimeoutError())
+    assert is_timeout_error(httpx.ReadTimeout("read"))
+    assert is_timeout_error(requests.ReadTimeout())
+    assert not is_timeout_error(ValueError("bad"))
+    # requests re-raises read timeouts of streams as `ConnectionError`
+    try:
+        try:
+            raise requests.ReadTimeout()
+        except requests.ReadTimeout as e:
+            raise requests.ConnectionError() from e
+    except requests.ConnectionError as e:
+        assert is_timeout_error(e)
+    try:
+        try:
+            raise ValueError("bad")
+        except ValueError:
+            raise requests.ConnectionError()
+    except requests.ConnectionError as e:
+        assert not is_timeout_error(e)
+
+
+@pytest.fixture
+def chat_api_app():
+    from apis.chat_api import ChatAPIApp
+
+    return ChatAPIApp()
+
+
+async def delayed_chunks(delays: list[float], is_closed: list = None):
+    try:
+        for idx, delay in enumerate(delays):
+            await asyncio.sleep(delay)
+            yield f"chunk{idx}"
+    finally:
+        if is_closed is not None:
+            is_closed.append(True)
+
+
+def guarded_chunks(chat_api_app, generator, deadline: Deadline) -> list:
+    async def main():
+        streamer = HuggingfaceStreamer(model="nous-mixtral-8x7b")
+        return [
+            chunk
+            async for chunk in chat_api_app.guard_stream(generator, streamer, deadline)
+        ]
+
+    return asyncio.run(main())
+
+
+def finish_reason(chunk: str) -> str:
+    return json.loads(chunk)["choices"][0]["finish_reason"]
+
+
+def test_guard_stream_passes_chunks_through(chat_api_app):
+    chunks = guarded_chunks(chat_api_app, delayed_chunks([0, 0.01, 0]), Deadline(5))
+    assert chunks == ["chunk0", "chunk1", "chunk2"]
+
+
+@pytest.mark.parametrize(
+    "phase, delays, env, total, expected_chunks",
+    [
+        ("first_byte", [1], {"upstream_first_byte_timeout": "0.05"}, 0, 0),
+        ("idle", [0, 0, 1], {"upstream_idle_timeout": "0.05"}, 0, 2),
+        ("total", [0, 0.06, 1], {"upstream_idle_timeout": "0.5"}, 0.1, 2),
+    ],
+)
+def test_guard_stream_ends_with_a_timeout_chunk(
+    chat_api_app, monkeypatch, phase, delays, env, total, expected_chunks
+):
+    for key, value in env.items():
+        monkeypatch.setenv(key, value)
+    counter = DEADLINES_EXCEEDED_TOTAL.labels("nous-mixtral-8x7b", "huggingface", phase)
+    count = counter.value
+    is_closed = []
+    started_at = time.perf_counter()
+    chunks = guarded_chunks(
+        chat_api_app, delayed_chunks(delays, is_closed), Deadline(total)
+    )
+    assert time.perf_counter() - started_at < 0.5
+    assert chunks[:-1] == [f"chunk{idx}" for idx in range(expected_chunks)]
+    assert finish_reason(chunks[-1]) == "timeout"
+    assert is_closed == [True]
+    assert counter.value == count + 1
+
+
+def test_guard_stream_treats_upstream_read_timeouts_as_timeouts(chat_api_app):
+    async def timing_out_chunks():
+        yield "chunk0"
+        raise httpx.ReadTimeout("read")
+
+    chunks = guarded_chunks(chat_api_app, timing_out_chunks(), Deadline(5))
+    assert chunks[0] == "chunk0"
+    assert finish_reason(chunks[1]) == "timeout"
+
+
+def test_guard_stream_reraises_other_errors(chat_api_app):
+    async def failing_chunks():
+        yield "chunk0"
+        raise ValueError("upstream broke")
+
+    with pytest.raises(ValueError):
+        guarded_chunks(chat_api_app, failing_chunks(), Deadline(5))
+
+
+@pytest.fixture
+def chat_api(fake_upstream, fake_tokenizers, monkeypatch):
+    import apis.chat_api as chat_api
+
+    upstream, url = fake_upstream
+    monkeypatch.setenv("huggingface_api_base", url)
+    monkeypatch.setenv("response_cache", "false")
+    monkeypatch.setenv("request_coalescing", "false")
+    return chat_api, upstream
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_request_timeout_header_bounds_slow_upstreams(chat_api, monkeypatch, stream):
+    chat_api, upstream = chat_api
+    monkeypatch.setattr(upstream, "ttft_ms", 2000)
+
+    async def main():
+        transport = httpx.ASGITransport(app=chat_api.app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://test", timeout=30
+        ) as client:
+            try:
+                return await client.post(
+                    "/chat/completions",
+                    headers={
+                        "Authorization": "Bearer sk-test",
+                        "X-Request-Timeout": "0.3",
+                    },
+                    json={
+                        "model": "nous-mixtral-8x7b",
+                        "messages": [{"role": "user", "content": "Hello"}],
+                        "stream": stream,
+                    },
+                )
+            finally:
+                await chat_api.ASYNC_CLIENT_POOL.aclose()
+
+    started_at = time.perf_counter()
+    response = asyncio.run(main())
+    assert time.perf_counter() - started_at < 1.5
+    if stream:
+        # headers are sent before the first chunk, so the stream ends with a timeout
+        assert response.status_code == 200
+        frames = [
+            json.loads(line[len("data: ") :])
+            for line in response.text.splitlines()
+            if line.startswith("data: {")
+        ]
+        assert frames[-1]["choices"][0]["finish_reason"] == "timeout"
+    else:
+        assert response.status_code == 504
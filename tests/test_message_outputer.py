@@ -0,0 +1,87 @@
+import json
+
+import pytest
+
+from messagers.message_outputer import OpenaiStreamOutputer, to_sse_frame
+
+CONTENTS = [
+    "",
+    " Hello",
+    'quotes " and \\ backslashes \\"',
+    "new\nlines\r\n and\ttabs \b\f",
+    "controls \x00\x01\x1f\x7f",
+    "unicode café ünïcödé 中文 日本語",
+    "emoji 😀👍🏽 and zwj 👩‍💻",
+    "lone surrogate \ud800 and \udfff",
+    "</script> & <b>html</b>   ",
+    None,
+]
+
+
+def output_baseline(outputer: OpenaiStreamOutputer, content, content_type, **kwargs):
+    # the `output()` of before the envelopes: copy, nested dicts and json.dumps
+    data = outputer.default_data.copy()
+    if content_type == "Role":
+        delta, finish_reason = {"role": "assistant"}, None
+    elif content_type in [
+        "Completions",
+        "InternalSearchQuery",
+        "InternalSearchResult",
+        "SuggestedResponses",
+    ]:
+        if content_type in ["InternalSearchQuery", "InternalSearchResult"]:
+            content += "\n"
+        delta, finish_reason = {"content": content}, None
+    elif content_type == "Finished":
+        delta, finish_reason = {}, kwargs.get("finish_reason", "stop")
+    else:
+        delta, finish_reason = {}, None
+    data["choices"] = [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+    return json.dumps(data)
+
+
+@pytest.fixture(
+    params=[
+        ("huggingface", "nous-mixtral-8x7b"),
+        ("openai", "gpt-3.5-turbo"),
+        ('own"er\\', "modèle/日本-😀"),
+    ],
+    ids=["huggingface", "openai", "escaped"],
+)
+def outputer(request):
+    owned_by, model = request.param
+    return OpenaiStreamOutputer(owned_by=owned_by, model=model)
+
+
+@pytest.mark.parametrize("content", CONTENTS)
+def test_content_chunks_match_the_baseline(outputer, content):
+    output = outputer.output(content=content, content_type="Completions")
+    assert output == output_baseline(outputer, content, "Completions")
+    assert to_sse_frame(output) == f"data: {output}\r\n\r\n".encode("utf-8")
+
+
+@pytest.mark.parametrize(
+    "content_type",
+    ["InternalSearchQuery", "InternalSearchResult", "SuggestedResponses"],
+)
+@pytest.mark.parametrize("content", [c for c in CONTENTS if c is not None])
+def test_search_chunks_match_the_baseline(outputer, content, content_type):
+    output = outputer.output(content=content, content_type=content_type)
+    assert output == output_baseline(outputer, content, content_type)
+
+
+@pytest.mark.parametrize(
+    "content_type, kwargs",
+    [
+        ("Role", {}),
+        ("Finished", {}),
+        ("Finished", {"finish_reason": "stop"}),
+        ("Finished", {"finish_reason": "timeout"}),
+        ("Finished", {"finish_reason": None}),
+        ("Unknown", {}),
+    ],
+)
+def test_fixed_chunks_match_the_baseline(outputer, content_type, kwargs):
+    output = outputer.output(content_type=content_type, **kwargs)
+    assert output == output_baseline(outputer, None, content_type, **kwargs)
+    assert json.loads(output)["choices"][0]["index"] == 0
@@ -0,0 +1,92 @@
+import json
+
+import pytest
+
+from networks.openai_delta_extractor import (
+    OpenaiDeltaExtractor,
+    build_synthetic_events,
+)
+
+
+def message_event(content: str, status: str = "in_progress", role="assistant"):
+    # same layout as the events of `benchmarks.fake_upstream`
+    data = {
+        "message": {
+            "id": "00000000-0000-0000-0000-000000000000",
+            "author": {"role": role},
+            "content": {"content_type": "text", "parts": [content]},
+            "status": status,
+        },
+        "conversation_id": "00000000-0000-0000-0000-000000000000",
+        "error": None,
+    }
+    return json.dumps(data).encode("utf-8")
+
+
+def extract_all(extractor: OpenaiDeltaExtractor, events: list[bytes], fast=True):
+    if fast:
+        return [extractor.extract(event) for event in events]
+    return [extractor.extract_full(event) for event in events]
+
+
+def accumulate(tokens: list[str]) -> list[bytes]:
+    events, content = [], ""
+    for token in tokens:
+        content += token
+        events.append(message_event(content))
+    return events
+
+
+@pytest.mark.parametrize(
+    "tokens",
+    [
+        ["Hello", " world", "!"],
+        ['say "', 'hi"', " \\", "\\n", " done"],
+        ["你好", "，", "世界", " 🌍"],
+        ["line\n", "\tnext", "\r\n", "end"],
+        ["\\", '"', "\\", "u0041"],
+    ],
+    ids=["ascii", "quotes", "unicode", "whitespace", "escapes"],
+)
+def test_fast_path_matches_full_parse(tokens):
+    events = accumulate(tokens)
+    extractor = OpenaiDeltaExtractor()
+    deltas = extract_all(extractor, events)
+    assert deltas == extract_all(OpenaiDeltaExtractor(), events, fast=False)
+    assert "".join(deltas) == "".join(tokens)
+    assert extractor.fast
+
+
+def test_synthetic_benchmark_events():
+    events = build_synthetic_events(500)
+    extractor = OpenaiDeltaExtractor()
+    assert extract_all(extractor, events) == extract_all(
+        OpenaiDeltaExtractor(), events, fast=False
+    )
+    assert extractor.fast
+
+
+def test_skipped_events():
+    extractor = OpenaiDeltaExtractor()
+    assert extractor.extract(message_event("hi", role="user")) is None
+    assert extractor.extract(message_event("")) is None
+    assert extractor.extract(message_event("Hello")) == "Hello"
+    assert extractor.extract(message_event("Hello", "finished_successfully")) is None
+
+
+def test_new_message_restarts_from_its_start():
+    extractor = OpenaiDeltaExtractor()
+    baseline = OpenaiDeltaExtractor()
+    events = accumulate(["Searching", " the web"]) + accumulate(["Found", " it"])
+    assert extract_all(extractor, events) == extract_all(baseline, events, False)
+
+
+def test_unexpected_layout_falls_back_to_full_parse():
+    extractor = OpenaiDeltaExtractor()
+    assert extractor.extract(message_event("Hello")) == "Hello"
+    # two parts are not handled by the fast path
+    event = json.loads(message_event("Hello world"))
+    event["message"]["content"]["parts"].append("extra")
+    assert extractor.extract(json.dumps(event).encode("utf-8")) == " world"
+    assert not extractor.fast
+    assert extractor.extract(message_event("Hello world!")) == "!"
@@ -0,0 +1,167 @@
+import copy
+import re
+
+import pytest
+
+from messagers.message_composer import MessageComposer
+from messagers.prompt_templates import PROMPT_TEMPLATES
+from messagers.token_checker import TokenCountCache
+
+INST_ROLES = ["user", "system", "inst"]
+ANSWER_ROLES = ["assistant", "bot", "answer", "model"]
+
+
+def merge_baseline(model: str, messages: list[dict]) -> str:
+    # the hand-written f-string prompts of `MessageComposer.merge()`,
+    # before the compiled templates, kept as reference
+    composer = MessageComposer(model)
+    if model in ["mixtral-8x7b", "mistral-7b"]:
+        merged_str, cached_str = "", ""
+        for message in composer.concat_messages_by_role(messages):
+            role, content = message["role"], message["content"]
+            if role in ANSWER_ROLES:
+                merged_str += f"<s> {cached_str} {content} </s>\n"
+                cached_str = ""
+            else:
+                cached_str = f"[INST] {content} [/INST]"
+        return merged_str + cached_str
+    elif model in ["nous-mixtral-8x7b"]:
+        lines = []
+        for message in messages:
+            role, content = message["role"], message["content"]
+            if role not in ["system", "user", "assistant"]:
+                role = "user"
+            lines.append(f"<|im_start|>{role}\n{content}<|im_end|>")
+        lines.append("<|im_start|>assistant")
+        return "\n".join(lines)
+    elif model in ["openchat-3.5"]:
+        lines = []
+        for message in composer.concat_messages_by_role(messages):
+            role, content = message["role"], message["content"]
+            if role in ANSWER_ROLES:
+                lines.append(f"GPT4 Correct Assistant:\n{content}<|end_of_turn|>")
+            else:
+                lines.append(f"GPT4 Correct User:\n{content}<|end_of_turn|>")
+        lines.append("GPT4 Correct Assistant:\n")
+        return "\n".join(lines)
+    elif model in ["gemma-7b"]:
+        lines = []
+        for message in composer.concat_messages_by_role(messages):
+            role, content = message["role"], message["content"]
+            if role in ANSWER_ROLES:
+                lines.append(f"<start_of_turn>model\n{content}<end_of_turn>")
+            else:
+                lines.append(f"<start_of_turn>user\n{content}<end_of_turn>")
+        lines.append("<start_of_turn>model\n")
+        return "<bos>" + "\n".join(lines)
+    return "\n\n".join(
+        [f"{message['role']}: {message['content']}" for message in messages]
+    )
+
+
+CONVERSATIONS = {
+    "single": [{"role": "user", "content": "Hello, who are you?"}],
+    "system": [
+        {"role": "system", "content": "You are a helpful assistant."},
+        {"role": "user", "content": "Hello, who are you?"},
+    ],
+    "multi_turn": [
+        {"role": "system", "content": "Be brief."},
+        {"role": "user", "content": "Hi"},
+        {"role": "assistant", "content": "Hello! How can I help?"},
+        {"role": "user", "content": "Tell me a joke"},
+        {"role": "assistant", "content": "Why did the robot...?"},
+        {"role": "user", "content": "Why?"},
+    ],
+    "same_roles": [
+        {"role": "user", "content": "First part"},
+        {"role": "user", "content": "second part"},
+        {"role": "assistant", "content": "Answer"},
+        {"role": "bot", "content": "more answer"},
+        {"role": "user", "content": "Next"},
+    ],
+    "answer_first": [
+        {"role": "assistant", "content": "I start"},
+        {"role": "user", "content": "Ok"},
+    ],
+    "special_chars": [
+        {"role": "user", "content": "{{ jinja }} {% raw %} <|im_end|>\n\t你好 \"'"},
+        {"role": "assistant", "content": "  spaces  \n\n"},
+        {"role": "tool", "content": "unknown role"},
+    ],
+}
+
+MODELS = [
+    "mixtral-8x7b",
+    "mistral-7b",
+    "nous-mixtral-8x7b",
+    "openchat-3.5",
+    "gemma-7b",
+    "default",
+]
+
+
+@pytest.mark.parametrize("conversation", CONVERSATIONS.keys())
+@pytest.mark.parametrize("model", MODELS)
+def test_templates_are_byte_identical_to_baseline(model, conversation):
+    messages = CONVERSATIONS[conversation]
+    expected = merge_baseline(model, copy.deepcopy(messages))
+
+    template = PROMPT_TEMPLATES.get(model)
+    if template.concat_by_role:
+        rendered_messages = MessageComposer(model).concat_messages_by_role(messages)
+    else:
+        rendered_messages = messages
+    segments = PROMPT_TEMPLATES.render_segments(model, rendered_messages)
+    assert "".join(segments) == expected
+    assert template.render(rendered_messages) == expected
+
+
+@pytest.mark.parametrize("model", ["mixtral-8x7b", "nous-mixtral-8x7b", "gemma-7b"])
+def test_composer_merge_matches_baseline(model):
+    messages = CONVERSATIONS["multi_turn"]
+    snapshot = copy.deepcopy(messages)
+    composer = MessageComposer(model)
+    # twice, so the second merge is served from cached segments
+    for _ in range(2):
+        assert composer.merge(messages) == merge_baseline(
+            model, copy.deepcopy(messages)
+        )
+        assert "".join(composer.segments) == composer.merged_str
+    # the messages of the request are not modified
+    assert messages == snapshot
+
+
+class SpecialTokenizer:
+    """
+    Whitespace tokenizer, whose special tokens like `<s>` or `<|im_end|>` are
+    tokens of their own, as in the tokenizers of the models.
+    """
+
+    def encode(self, text: str, add_special_tokens: bool = True) -> list[str]:
+        tokens = []
+        for part in re.split(r"(<[^<>\s]+>)", text):
+            tokens.extend([part] if re.fullmatch(r"<[^<>\s]+>", part) else part.split())
+        if add_special_tokens:
+            tokens = ["<s>"] + tokens
+        return tokens
+
+
+@pytest.mark.parametrize("model", MODELS)
+def test_cached_segment_counts_match_full_tokenization(model):
+    tokenizer = SpecialTokenizer()
+    cache = TokenCountCache()
+    messages = CONVERSATIONS["multi_turn"] + CONVERSATIONS["special_chars"]
+    # the conversation grows turn by turn, as resent by clients,
+    # so each segment is counted as the last one, then from the cache as before it
+    for turn in range(1, len(messages) + 1):
+        composer = MessageComposer(model)
+        prompt = composer.merge(messages[:turn])
+        assert prompt == merge_baseline(composer.model, copy.deepcopy(messages[:turn]))
+        expected = len(tokenizer.encode(prompt))
+        assert cache.count(model, tokenizer, composer.segments) == expected
+    assert cache.hits > 0
+    # boundaries of the template prefix and suffix are counted as well
+    template = PROMPT_TEMPLATES.get(composer.model)
+    assert composer.segments[0] == template.prefix
+    assert composer.segments[-1] == template.suffix
@@ -0,0 +1,93 @@
+import base64
+import json
+
+from hashlib import sha3_512
+
+import pytest
+
+import networks.proof_worker as proof_worker
+
+from networks.proof_worker import (
+    ProofWorker,
+    calc_proof_token_baseline,
+    shutdown_process_pool,
+    solve_range,
+)
+
+SEED = "0.42665582693491433"
+
+
+@pytest.fixture
+def worker(monkeypatch):
+    worker = ProofWorker()
+    config = worker.get_config()
+    # the config is random per call, so both searches must see the same one
+    monkeypatch.setattr(worker, "get_config", lambda: list(config))
+    return worker
+
+
+def test_prefix_and_suffix_wrap_the_counter(worker):
+    prefix, suffix = worker.get_config_prefix_suffix()
+    config = worker.get_config()
+    for counter in [0, 7, 42, 12345, 99999]:
+        config[3] = counter
+        assert prefix + str(counter).encode() + suffix == json.dumps(config).encode()
+
+
+@pytest.mark.parametrize("difficulty", ["0fffff", "05cdf2", "00ffff", "003fff"])
+def test_same_token_as_baseline(worker, difficulty):
+    expected = calc_proof_token_baseline(worker, SEED, difficulty, 100000)
+    assert expected is not None
+    assert worker.calc_proof_token(SEED, difficulty, processes=1) == expected
+
+
+def test_unreachable_difficulty_matches_baseline(worker):
+    difficulty = "!" * 6
+    prefix, suffix = worker.get_config_prefix_suffix()
+    assert calc_proof_token_baseline(worker, SEED, difficulty, 2000) is None
+    assert solve_range(SEED, difficulty, prefix, suffix, 0, 2000) is None
+
+
+def test_search_ranges_split_at_any_counter(worker):
+    difficulty = "00ffff"
+    prefix, suffix = worker.get_config_prefix_suffix()
+    expected = solve_range(SEED, difficulty, prefix, suffix, 0, 100000)
+    # the counter of the first match, found again from a range starting there
+    counter = next(
+        idx
+        for idx in range(100000)
+        if solve_range(SEED, difficulty, prefix, suffix, idx, idx + 1)
+    )
+    assert solve_range(SEED, difficulty, prefix, suffix, counter, 100000) == expected
+    assert solve_range(SEED, difficulty, prefix, suffix, 0, counter) is None
+
+
+def test_process_pool_finds_a_valid_token(worker):
+    difficulty = "00ffff"
+    token = worker.calc_proof_token(SEED, difficulty, processes=2)
+    base = token[len("gAAAAAB") :]
+    digest = sha3_512((SEED + base).encode()).hexdigest()
+    assert digest[: len(difficulty) // 2] <= difficulty
+    assert json.loads(base64.b64decode(base))[4] == worker.get_config()[4]
+
+
+def test_process_pool_is_not_forked_and_is_shut_down(worker, monkeypatch):
+    pools = []
+
+    class RecordedPool(proof_worker.ProcessPoolExecutor):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            pools.append((self, kwargs["mp_context"].get_start_method()))
+
+    shutdown_process_pool()
+    monkeypatch.setattr(proof_worker, "ProcessPoolExecutor", RecordedPool)
+    worker.calc_proof_token(SEED, "00ffff", processes=2)
+    worker.calc_proof_token(SEED, "00ffff", processes=2)
+    # forking the threads of the server could deadlock the children
+    ((pool, start_method),) = pools
+    assert start_method in ("forkserver", "spawn")
+
+    shutdown_process_pool()
+    assert proof_worker.PROCESS_POOL is None
+    with pytest.raises(RuntimeError):
+        pool.submit(sum, [1])
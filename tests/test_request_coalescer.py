@@ -0,0 +1,298 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from networks.request_coalescer import RequestCoalescer
+
+
+class FakeStream:
+    """
+    Chunks released one by one with `release()`, and whether the stream was cancelled.
+    """
+
+    def __init__(self, chunks: list[str]):
+        self.chunks = chunks
+        self.opens = 0
+        self.is_cancelled = False
+        self.released = asyncio.Semaphore(0)
+
+    def release(self, count: int = 1):
+        for _ in range(count):
+            self.released.release()
+
+    async def generate(self):
+        try:
+            for chunk in self.chunks:
+                await self.released.acquire()
+                yield chunk
+        except asyncio.CancelledError:
+            self.is_cancelled = True
+            raise
+
+    async def open(self):
+        self.opens += 1
+        return self.generate()
+
+
+async def collect(subscription) -> list[str]:
+    return [chunk async for chunk in subscription.chunks()]
+
+
+def test_identical_requests_share_one_stream():
+    async def main():
+        coalescer = RequestCoalescer()
+        stream = FakeStream(["a", "b", "c"])
+        first = coalescer.join("key", stream.open)
+        second = coalescer.join("key", stream.open)
+        assert first.flight is second.flight
+        tasks = [asyncio.create_task(collect(s)) for s in [first, second]]
+        stream.release(3)
+        assert await asyncio.gather(*tasks) == [["a", "b", "c"]] * 2
+        assert stream.opens == 1
+        await asyncio.sleep(0)
+        assert coalescer.stats() == {
+            "in_flight": 0,
+            "subscribers": 0,
+            "upstream_calls": 1,
+            "upstream_calls_saved": 1,
+        }
+
+    asyncio.run(main())
+
+
+def test_late_subscriber_replays_from_the_first_chunk():
+    async def main():
+        coalescer = RequestCoalescer()
+        stream = FakeStream(["a", "b", "c"])
+        first = coalescer.join("key", stream.open)
+        chunks = first.chunks()
+        stream.release()
+        assert await anext(chunks) == "a"
+        second = coalescer.join("key", stream.open)
+        stream.release(2)
+        assert await collect(second) == ["a", "b", "c"]
+        assert [chunk async for chunk in chunks] == ["b", "c"]
+
+    asyncio.run(main())
+
+
+def test_upstream_is_cancelled_when_every_subscriber_leaves_before_iterating():
+    async def main():
+        coalescer = RequestCoalescer()
+        stream = FakeStream(["a", "b"])
+        subscriptions = [coalescer.join("key", stream.open) for _ in range(3)]
+        await subscriptions[0].flight.wait_opened()
+        stream.release()
+        await asyncio.sleep(0.01)
+        # e.g. deadlines before the first chunk, or early client disconnects
+        for subscription in subscriptions:
+            subscription.leave()
+            subscription.leave()
+        await asyncio.sleep(0.01)
+        assert stream.is_cancelled
+        assert subscriptions[0].flight.subscribers == 0
+        assert coalescer.stats()["in_flight"] == 0
+
+    asyncio.run(main())
+
+
+def test_request_joining_a_cancelling_flight_opens_a_new_one():
+    async def main():
+        coalescer = RequestCoalescer()
+        stream = FakeStream(["a", "b"])
+        first = coalescer.join("key", stream.open)
+        await first.flight.wait_opened()
+        first.leave()
+        # before the cancelled task has ended and removed its flight
+        second = coalescer.join("key", stream.open)
+        assert second.flight is not first.flight
+        stream.release(2)
+        assert await collect(second) == ["a", "b"]
+        assert stream.opens == 2
+        assert coalescer.stats()["upstream_calls_saved"] == 0
+
+    asyncio.run(main())
+
+
+def test_upstream_continues_while_a_subscriber_remains():
+    async def main():
+        coalescer = RequestCoalescer()
+        stream = FakeStream(["a", "b"])
+        leaving = coalescer.join("key", stream.open)
+        staying = coalescer.join("key", stream.open)
+        chunks = leaving.chunks()
+        stream.release()
+        assert await anext(chunks) == "a"
+        await chunks.aclose()
+        assert leaving.is_left
+        stream.release()
+        assert await collect(staying) == ["a", "b"]
+        assert not stream.is_cancelled
+        # left twice, through `chunks()` and the request cleanup
+        leaving.leave()
+        assert staying.flight.subscribers == 0
+
+    asyncio.run(main())
+
+
+def test_open_failures_reach_every_subscriber():
+    async def main():
+        coalescer = RequestCoalescer()
+
+        async def open_stream():
+            raise ValueError("upstream down")
+
+        subscriptions = [coalescer.join("key", open_stream) for _ in range(2)]
+        for subscription in subscriptions:
+            with pytest.raises(ValueError):
+                await subscription.flight.wait_opened()
+            with pytest.raises(ValueError):
+                await collect(subscription)
+        # a new request of the same key opens a new flight
+        stream = FakeStream(["a"])
+        subscription = coalescer.join("key", stream.open)
+        stream.release()
+        assert await collect(subscription) == ["a"]
+
+    asyncio.run(main())
+
+
+def test_keys_and_gating(monkeypatch):
+    coalescer = RequestCoalescer()
+    assert coalescer.get_key("request", "hf_a") != coalescer.get_key("request", "hf_b")
+    assert coalescer.get_key("request", None) == coalescer.get_key("request", "")
+    monkeypatch.setenv("request_coalescing", "false")
+    assert not coalescer.is_coalescable("nous-mixtral-8x7b", use_cache=True)
+    monkeypatch.setenv("request_coalescing", "true")
+    assert coalescer.is_coalescable("nous-mixtral-8x7b", use_cache=True)
+    assert not coalescer.is_coalescable("nous-mixtral-8x7b", use_cache=False)
+    monkeypatch.setenv("request_coalescing_models", '["mixtral-8x7b"]')
+    assert not coalescer.is_coalescable("nous-mixtral-8x7b", use_cache=True)
+
+
+@pytest.fixture
+def chat_api(fake_upstream, fake_tokenizers, monkeypatch):
+    import apis.chat_api as chat_api
+
+    upstream, url = fake_upstream
+    monkeypatch.setenv("huggingface_api_base", url)
+    monkeypatch.setenv("response_cache", "false")
+    monkeypatch.setattr(chat_api, "REQUEST_COALESCER", RequestCoalescer())
+    return chat_api, upstream
+
+
+def post_completions(chat_api, payloads: list[dict], headers: dict = None) -> list:
+    async def main():
+        transport = httpx.ASGITransport(app=chat_api.app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://test", timeout=30
+        ) as client:
+            try:
+                return await asyncio.gather(
+                    *[
+                        client.post(
+                            "/chat/completions",
+                            headers={
+                                "Authorization": "Bearer sk-test",
+                                **(headers or {}),
+                            },
+                            json=payload,
+                        )
+                        for payload in payloads
+                    ]
+                )
+            finally:
+                # clients of the pool are bound to the event loop of this run
+                await chat_api.ASYNC_CLIENT_POOL.aclose()
+
+    return asyncio.run(main())
+
+
+PAYLOAD = {
+    "model": "nous-mixtral-8x7b",
+    "messages": [{"role": "user", "content": "Hello"}],
+    "use_cache": True,
+    "stream": False,
+}
+
+
+def stream_content(text: str) -> tuple[str, str]:
+    contents, finish_reason = [], None
+    for line in text.splitlines():
+        if line.startswith("data: "):
+            choice = json.loads(line[len("data: ") :])["choices"][0]
+            contents.append(choice["delta"].get("content") or "")
+            finish_reason = choice["finish_reason"]
+    return "".join(contents), finish_reason
+
+
+def test_coalesced_responses_match_uncoalesced_ones(chat_api, monkeypatch):
+    chat_api, upstream = chat_api
+    monkeypatch.setenv("request_coalescing", "false")
+    (expected,) = post_completions(chat_api, [PAYLOAD])
+    assert expected.status_code == 200
+
+    monkeypatch.setenv("request_coalescing", "true")
+    requests_before = upstream.requests
+    responses = post_completions(
+        chat_api, [PAYLOAD, PAYLOAD, PAYLOAD, {**PAYLOAD, "stream": True}]
+    )
+    assert upstream.requests - requests_before == 1
+    assert [response.status_code for response in responses] == [200] * 4
+    for response in responses[:3]:
+        assert response.json() == expected.json()
+    content = expected.json()["choices"][0]["message"]["content"]
+    assert stream_content(responses[3].text) == (content, "stop")
+    assert chat_api.REQUEST_COALESCER.stats()["subscribers"] == 0
+
+
+def test_timed_out_subscribers_release_the_flight(chat_api, monkeypatch):
+    chat_api, upstream = chat_api
+    monkeypatch.setenv("request_coalescing", "true")
+    monkeypatch.setattr(upstream, "ttft_ms", 1000)
+    responses = post_completions(
+        chat_api,
+        [PAYLOAD, {**PAYLOAD, "stream": True}],
+        headers={"X-Request-Timeout": "0.3"},
+    )
+    # the stream has started when the deadline passes, so it ends with a timeout
+    assert [response.status_code for response in responses] == [504, 200]
+    assert stream_content(responses[1].text)[1] == "timeout"
+    assert chat_api.REQUEST_COALESCER.stats() == {
+        "in_flight": 0,
+        "subscribers": 0,
+        "upstream_calls": 1,
+        "upstream_calls_saved": 1,
+    }
+
+
+def test_different_tokens_do_not_share_a_flight(chat_api, monkeypatch):
+    chat_api, upstream = chat_api
+    monkeypatch.setenv("request_coalescing", "true")
+    monkeypatch.setitem(chat_api.SECRETS.secrets, "HF_LLM_API_KEY", "sk-test")
+
+    async def main():
+        transport = httpx.ASGITransport(app=chat_api.app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://test", timeout=30
+        ) as client:
+            try:
+                return await asyncio.gather(
+                    *[
+                        client.post(
+                            "/chat/completions",
+                            headers={"Authorization": f"Bearer {token}"},
+                            json=PAYLOAD,
+                        )
+                        for token in ["hf_token_a", "hf_token_b", "hf_token_a"]
+                    ]
+                )
+            finally:
+                await chat_api.ASYNC_CLIENT_POOL.aclose()
+
+    responses = asyncio.run(main())
+    assert [response.status_code for response in responses] == [200] * 3
+    stats = chat_api.REQUEST_COALESCER.stats()
+    assert (stats["upstream_calls"], stats["upstream_calls_saved"]) == (2, 1)
@@ -0,0 +1,63 @@
+import json
+import threading
+
+import pytest
+
+from metrics.request_log import RequestLogWriter
+
+
+@pytest.fixture
+def log_path(tmp_path, monkeypatch):
+    path = tmp_path / "requests.jsonl"
+    monkeypatch.setenv("request_log", "true")
+    monkeypatch.setenv("request_log_path", str(path))
+    return path
+
+
+def read_lines(path) -> list[dict]:
+    lines = []
+    for file in sorted(path.parent.glob(f"{path.name}*")):
+        if not file.name.endswith(".lock"):
+            lines.extend(json.loads(line) for line in file.read_text().splitlines())
+    return lines
+
+
+def test_disabled_by_default(monkeypatch):
+    monkeypatch.delenv("request_log", raising=False)
+    writer = RequestLogWriter()
+    writer.log({"idx": 0})
+    assert not writer.is_enabled()
+    assert writer.thread is None
+
+
+def test_batches_are_written_and_rotated(log_path, monkeypatch):
+    monkeypatch.setenv("request_log_max_bytes", "100")
+    monkeypatch.setenv("request_log_backups", "2")
+    writer = RequestLogWriter()
+    for idx in range(6):
+        writer.write_batch([{"idx": idx, "padding": "x" * 30}])
+    assert writer.rotations > 0
+    assert not log_path.with_name(f"{log_path.name}.3").exists()
+    assert json.loads(log_path.read_text().splitlines()[-1])["idx"] == 5
+    assert len(read_lines(log_path)) < 6
+
+
+def test_racing_rotations_keep_every_line(log_path, monkeypatch):
+    monkeypatch.setenv("request_log_max_bytes", "200")
+    monkeypatch.setenv("request_log_backups", "200")
+    # as the writers of two worker processes, and `close()` racing the thread
+    writers = [RequestLogWriter(), RequestLogWriter(), RequestLogWriter()]
+
+    def write(writer_idx: int, writer: RequestLogWriter):
+        for idx in range(100):
+            writer.write_batch([{"writer": writer_idx, "idx": idx}])
+
+    threads = [
+        threading.Thread(target=write, args=(writer_idx % 2, writer))
+        for writer_idx, writer in enumerate(writers + [writers[0]])
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(read_lines(log_path)) == 400
@@ -0,0 +1,112 @@
+import time
+
+import pytest
+
+from networks.response_cache import ResponseCache
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    monkeypatch.setenv("response_cache", "true")
+    monkeypatch.delenv("response_cache_sqlite_path", raising=False)
+    return ResponseCache()
+
+
+@pytest.fixture
+def fake_time(monkeypatch):
+    now = [1700000000.0]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+    return now
+
+
+def test_only_use_cache_requests_are_cacheable(cache, monkeypatch):
+    assert cache.is_cacheable(use_cache=True)
+    assert not cache.is_cacheable(use_cache=False)
+    monkeypatch.setenv("response_cache", "false")
+    assert not cache.is_cacheable(use_cache=True)
+
+
+def test_key_normalization(cache):
+    key = cache.get_key("nous-mixtral-8x7b", "prompt", 0.5, 0.95, 100)
+    assert key == cache.get_key("nous-mixtral-8x7b", "prompt", 0.50001, 0.95, 100)
+    assert cache.get_key("m", "p", max_tokens=None) == cache.get_key(
+        "m", "p", max_tokens=-1
+    )
+    assert key != cache.get_key("nous-mixtral-8x7b", "prompt!", 0.5, 0.95, 100)
+    assert key != cache.get_key("mixtral-8x7b", "prompt", 0.5, 0.95, 100)
+    assert key != cache.get_key("nous-mixtral-8x7b", "prompt", 0.5, 0.95, 200)
+
+
+def test_get_and_set(cache):
+    assert cache.get("a") is None
+    cache.set("a", "content")
+    assert cache.get("a") == "content"
+    # empty contents are not cached
+    cache.set("b", "")
+    assert cache.get("b") is None
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["stores"]) == (1, 2, 1)
+
+
+def test_lru_evicts_least_recently_used(cache, monkeypatch):
+    monkeypatch.setenv("response_cache_max_entries", "2")
+    cache.set("a", "1")
+    cache.set("b", "2")
+    assert cache.get("a") == "1"
+    cache.set("c", "3")
+    assert cache.get("b") is None
+    assert cache.get("a") == "1"
+    assert cache.get("c") == "3"
+
+
+def test_lru_is_bounded_by_bytes(cache, monkeypatch):
+    monkeypatch.setenv("response_cache_max_bytes", "10")
+    cache.set("a", "12345")
+    # 6 bytes in utf-8, so "a" is evicted
+    cache.set("b", "你好")
+    assert cache.stats()["bytes"] == 6
+    assert cache.get("a") is None
+    cache.set("b", "123")
+    assert cache.stats()["bytes"] == 3
+
+
+def test_entries_expire_after_ttl(cache, fake_time, monkeypatch):
+    monkeypatch.setenv("response_cache_ttl", "60")
+    cache.set("a", "content")
+    fake_time[0] += 59
+    assert cache.get("a") == "content"
+    fake_time[0] += 1
+    assert cache.get("a") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_sqlite_tier_is_shared_and_expires(tmp_path, fake_time, monkeypatch):
+    monkeypatch.setenv("response_cache", "true")
+    monkeypatch.setenv("response_cache_ttl", "60")
+    monkeypatch.setenv("response_cache_sqlite_path", str(tmp_path / "cache.db"))
+    writer, reader = ResponseCache(), ResponseCache()
+    writer.set("a", "content")
+
+    assert reader.get("a") == "content"
+    assert reader.stats()["disk_hits"] == 1
+    # promoted to the memory tier of the reader
+    assert reader.get("a") == "content"
+    assert reader.stats()["disk_hits"] == 1
+
+    writer.set("b", "other")
+    fake_time[0] += 60
+    assert reader.get("b") is None
+    count = reader.get_db().execute("SELECT COUNT(*) FROM responses").fetchone()
+    assert count == (1,)
+
+
+def test_sqlite_tier_is_bounded(tmp_path, fake_time, monkeypatch):
+    monkeypatch.setenv("response_cache", "true")
+    monkeypatch.setenv("response_cache_sqlite_path", str(tmp_path / "cache.db"))
+    monkeypatch.setenv("response_cache_sqlite_max_entries", "3")
+    cache = ResponseCache()
+    for idx in range(5):
+        fake_time[0] += 1
+        cache.set(f"key{idx}", f"content{idx}")
+    rows = cache.get_db().execute("SELECT key FROM responses ORDER BY key")
+    assert [key for (key,) in rows] == ["key2", "key3", "key4"]
@@ -0,0 +1,126 @@
+import pickle
+import time
+
+import pytest
+
+import networks.huggingchat_session_pool as huggingchat_session_pool
+import networks.openai_credential_pool as openai_credential_pool
+
+from networks.huggingchat_session_pool import HuggingchatSession, HuggingchatSessionPool
+from networks.openai_credential_pool import OpenaiCredentialPool
+from networks.openai_streamer import OpenaiRequester
+from networks.shared_state import SharedQueues
+
+EXECUTED = []
+
+
+def mark_executed():
+    EXECUTED.append(True)
+
+
+class Payload:
+    def __reduce__(self):
+        return (mark_executed, ())
+
+
+@pytest.fixture
+def workers(tmp_path, monkeypatch):
+    """
+    Two `SharedQueues`, each with its own connection to the same file,
+    as in two worker processes.
+    """
+    monkeypatch.setenv("shared_state_path", str(tmp_path / "shared.db"))
+    return SharedQueues(), SharedQueues()
+
+
+def test_items_are_popped_once_in_order_across_connections(workers):
+    first, second = workers
+    first.push("queue", {"idx": 0})
+    first.push("queue", {"idx": 1})
+    second.push("other", {"idx": 2})
+    assert first.count("queue", ttl=60) == 2
+    assert second.pop("queue", ttl=60) == ({"idx": 0}, 0)
+    assert first.pop("queue", ttl=60) == ({"idx": 1}, 0)
+    assert second.pop("queue", ttl=60) == (None, 0)
+    assert first.counts("") == {"other": 1}
+
+
+def test_expired_items_are_skipped_and_deleted(workers):
+    first, second = workers
+    first.push("queue", {"idx": 0}, created_at=time.time() - 120)
+    first.push("queue", {"idx": 1})
+    assert second.pop("queue", ttl=60) == ({"idx": 1}, 1)
+    first.push("prefix:queue", {"idx": 2}, created_at=time.time() - 120)
+    assert second.sweep("prefix:", ttl=60) == 1
+
+
+def test_pickled_rows_are_never_unpickled(workers):
+    first, second = workers
+    # as written by anyone else who can write the file
+    first.get_db().execute(
+        "INSERT INTO queue_items (name, item, created_at) VALUES (?, ?, ?)",
+        ("queue", pickle.dumps(Payload()), time.time()),
+    )
+    assert second.pop("queue", ttl=60) == (None, 0)
+    assert EXECUTED == []
+
+
+def test_huggingchat_sessions_are_handed_over_between_workers(workers, monkeypatch):
+    first, second = workers
+    provided = []
+
+    def provider(model: str, system_prompt: str) -> HuggingchatSession:
+        session = HuggingchatSession(
+            f"chat{len(provided)}", f"conversation{len(provided)}", "message", model
+        )
+        provided.append(session)
+        return session
+
+    monkeypatch.setenv("huggingchat_pool_size", "2")
+    refiller, acquirer = HuggingchatSessionPool(provider), HuggingchatSessionPool(None)
+    monkeypatch.setattr(acquirer, "start", lambda: None)
+
+    monkeypatch.setattr(huggingchat_session_pool, "SHARED_QUEUES", first)
+    key = refiller.get_key("mistral-7b", "Be nice.")
+    refiller.record_demand(key, "mistral-7b", "Be nice.")
+    refiller.refill()
+    assert len(provided) == 2
+
+    monkeypatch.setattr(huggingchat_session_pool, "SHARED_QUEUES", second)
+    session = acquirer.acquire("mistral-7b", "Be nice.")
+    assert session.to_dict() == provided[0].to_dict()
+    assert acquirer.stats()["ready"] == {key: 1}
+
+    assert acquirer.acquire("mistral-7b", "Be nice.").to_dict() == (
+        provided[1].to_dict()
+    )
+    # invalid rows are dropped, instead of failing the request
+    second.push(f"huggingchat:{key}", {"hf_chat_id": "chat"})
+    assert acquirer.acquire("mistral-7b", "Be nice.") is None
+    assert acquirer.stats()["ready"] == {}
+
+
+def test_openai_credentials_are_handed_over_between_workers(workers, monkeypatch):
+    first, second = workers
+
+    def provider() -> OpenaiRequester:
+        requester = OpenaiRequester()
+        requester.chat_requirements_token = "token"
+        requester.chat_requirements_seed = "0.42"
+        requester.chat_requirements_difficulty = "0fffff"
+        requester.proof_token = "gAAAAABproof"
+        return requester
+
+    refiller = OpenaiCredentialPool(provider, OpenaiRequester.from_dict)
+    acquirer = OpenaiCredentialPool(None, OpenaiRequester.from_dict)
+    monkeypatch.setattr(acquirer, "start", lambda: None)
+    refiller.last_acquire_at = time.time()
+
+    monkeypatch.setattr(openai_credential_pool, "SHARED_QUEUES", first)
+    refiller.refill()
+    assert first.count(OpenaiCredentialPool.SHARED_NAME, ttl=60) >= 1
+
+    monkeypatch.setattr(openai_credential_pool, "SHARED_QUEUES", second)
+    requester = acquirer.acquire()
+    assert requester.to_dict() == provider().to_dict() | {"uuid": requester.uuid}
+    assert requester.requests_headers["Oai-Device-Id"] == requester.uuid
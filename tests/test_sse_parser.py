@@ -0,0 +1,116 @@
+import json
+
+import pytest
+
+from benchmarks.hot_paths import (
+    build_huggingchat_chunks,
+    build_openai_chunks,
+    build_tgi_chunks,
+)
+from networks.sse_parser import SSEParser, find_string_field, iter_sse_events
+
+
+def parse(chunks: list[bytes]) -> list[tuple]:
+    return [(e.event, e.data, e.id) for e in iter_sse_events(chunks)]
+
+
+def parse_lines_baseline(stream: bytes) -> list[bytes]:
+    # the line-based parsing of `iter_lines()` the streamers used before
+    data_lines = []
+    for line in stream.splitlines():
+        if line.startswith(b"data:"):
+            data_lines.append(line[len(b"data:") :].lstrip())
+    return data_lines
+
+
+def split_every(stream: bytes, size: int) -> list[bytes]:
+    return [stream[i : i + size] for i in range(0, len(stream), size)]
+
+
+@pytest.mark.parametrize("newline", [b"\n", b"\r", b"\r\n"])
+def test_line_endings(newline):
+    stream = newline.join(
+        [b"data: a", b"", b"event: update", b"data: b", b"id: 7", b"", b""]
+    )
+    assert parse([stream]) == [
+        ("message", b"a", None),
+        ("update", b"b", "7"),
+    ]
+
+
+def test_multi_line_data_is_joined_with_lf():
+    stream = b"data: line 1\r\ndata:line 2\ndata: \r\n\r\n"
+    assert parse([stream]) == [("message", b"line 1\nline 2\n", None)]
+
+
+def test_comments_and_unknown_fields_are_ignored():
+    stream = b": ping\n\nretry: 1000\nfoo: bar\ndata: x\n\n: ping\n\n"
+    assert parse([stream]) == [("message", b"x", None)]
+
+
+def test_bare_json_lines_are_events():
+    stream = b'{"type":"status"}\n{"type":"stream","token":"hi"}\n'
+    assert [data for _, data, _ in parse([stream])] == [
+        b'{"type":"status"}',
+        b'{"type":"stream","token":"hi"}',
+    ]
+
+
+def test_event_without_trailing_blank_line_is_flushed():
+    assert parse([b"data: last"]) == [("message", b"last", None)]
+
+
+def test_crlf_split_across_chunks():
+    parser = SSEParser()
+    events = parser.feed(b"data: a\r")
+    events += parser.feed(b"\n\r")
+    events += parser.feed(b"\n")
+    assert [e.data for e in events] == [b"a"]
+    assert parser.flush() == []
+
+
+def test_done_event():
+    (event,) = list(iter_sse_events([b"data: [DONE]\n\n"]))
+    assert event.is_done
+
+
+@pytest.mark.parametrize(
+    "chunks",
+    [
+        build_tgi_chunks(n=40),
+        build_huggingchat_chunks(n=40),
+        build_openai_chunks(n=40),
+    ],
+    ids=["tgi", "huggingchat", "openai"],
+)
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 64, 4096])
+def test_split_chunks_match_whole_stream(chunks, size):
+    stream = b"".join(chunks)
+    expected = parse([stream])
+    assert expected
+    assert parse(split_every(stream, size)) == expected
+    assert parse(chunks) == expected
+
+
+@pytest.mark.parametrize("newline", [b"\n\n", b"\r\n\r\n"])
+def test_data_matches_line_based_baseline(newline):
+    chunks = build_tgi_chunks(n=40) + build_openai_chunks(n=40)
+    stream = b"".join(chunks).replace(b"\n\n", newline)
+    data = [data for _, data, _ in parse(split_every(stream, 5))]
+    assert data == parse_lines_baseline(stream)
+
+
+@pytest.mark.parametrize(
+    "value", ["plain", 'say "hi"', "back\\slash\\", "你好", "line\nbreak", ""]
+)
+def test_find_string_field_matches_json(value):
+    data = json.dumps({"type": "stream", "token": value}).encode("utf-8")
+    field = find_string_field(data, b"token")
+    assert field is not None
+    assert field[0] == value
+    assert data[field[1] :] == b"}"
+
+
+def test_find_string_field_missing_or_not_string():
+    assert find_string_field(b'{"a": 1}', b"b") is None
+    assert find_string_field(b'{"a": 1}', b"a") is None
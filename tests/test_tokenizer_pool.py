@@ -0,0 +1,92 @@
+import asyncio
+import threading
+
+import pytest
+
+from messagers.tokenizer_pool import TokenizerPool
+
+
+class SplitTokenizer:
+    def __init__(self):
+        self.texts = []
+
+    def encode(self, text: str, add_special_tokens: bool = True) -> list[str]:
+        self.texts.append(text)
+        return text.split()
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setenv("tokenizer_pool_workers", "1")
+    monkeypatch.setenv("tokenizer_pool_batch_ms", "20")
+    pool = TokenizerPool()
+    yield pool
+    if pool.executor:
+        pool.executor.shutdown(wait=True)
+
+
+def test_batched_lengths_are_returned_per_request_in_order(pool, monkeypatch):
+    tokenizer = SplitTokenizer()
+    requests = [
+        ["a", "a b", "a b c"],
+        ["a b c d e"],
+        [],
+        ["a b", "a b c d", "", "a"],
+    ]
+
+    async def main():
+        return await asyncio.gather(
+            *[pool.encode_lengths("tok", tokenizer, texts) for texts in requests]
+        )
+
+    assert asyncio.run(main()) == [[1, 2, 3], [5], [], [2, 4, 0, 1]]
+    assert (pool.batched_calls, pool.batch_jobs) == (4, 1)
+
+    # full batches are flushed at once, in the order of the requests
+    monkeypatch.setenv("tokenizer_pool_max_batch", "3")
+    monkeypatch.setenv("tokenizer_pool_batch_ms", "1000")
+    assert asyncio.run(main()) == [[1, 2, 3], [5], [], [2, 4, 0, 1]]
+    assert pool.batch_jobs == 3
+    assert pool.stats()["queued"] == 0
+
+
+def test_cancelled_waiters_do_not_leak_the_queue(pool):
+    tokenizer = SplitTokenizer()
+    started, release = threading.Event(), threading.Event()
+
+    def block():
+        started.set()
+        release.wait(5)
+
+    async def main():
+        blocker = asyncio.create_task(pool.run(block))
+        await asyncio.to_thread(started.wait, 5)
+        # queued behind the blocker, then cancelled by deadlines or disconnects
+        waiters = [asyncio.create_task(pool.run(len, "abc")) for _ in range(3)]
+        waiters.append(
+            asyncio.create_task(pool.encode_lengths("tok", tokenizer, ["a b"]))
+        )
+        await asyncio.sleep(0.05)
+        assert pool.stats()["queued"] == 4
+        for waiter in waiters:
+            waiter.cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+        # the flushed batch job, which other requests could still wait for
+        assert pool.stats()["queued"] == 1
+
+        # a waiter cancelled before its batch is flushed is not encoded
+        cancelled = asyncio.create_task(
+            pool.encode_lengths("tok", tokenizer, ["x y z"])
+        )
+        kept = asyncio.create_task(pool.encode_lengths("tok", tokenizer, ["a"]))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        release.set()
+        await blocker
+        assert await kept == [1]
+        await asyncio.gather(*pool.batch_tasks)
+
+    asyncio.run(main())
+    assert tokenizer.texts == ["a b", "a"]
+    stats = pool.stats()
+    assert (stats["queued"], stats["running"]) == (0, 0)